@@ -0,0 +1,193 @@
+"""
+load test of the read endpoints, WSGI (gunicorn, DRF views) against ASGI
+(uvicorn, documents.async_views), on the same seeded database:
+
+    python -m benchmarks.async_reads --documents 500 --concurrency 200
+
+Needs gunicorn and uvicorn. Both servers get the same number of worker
+processes; gunicorn runs --threads per worker, uvicorn one event loop.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+
+from .common import create_session, create_user, percentile, setup_database
+
+
+def setup(db, documents):
+    setup_database(db)
+    from documents.models import Document, DocumentVersion, Tag
+
+    user = create_user()
+    tags = [Tag.objects.create(name=f"tag-{i}") for i in range(5)]
+    ids = []
+    for i in range(documents):
+        doc = Document.objects.create(title=f"document {i}", owner=user)
+        for number in (1, 2):
+            dv = DocumentVersion.objects.create(
+                document=doc,
+                file=f"document/{doc.id}/v{number}/file.pdf",
+                version_number=number,
+                uploaded_by=user,
+                stage="DONE",
+            )
+        doc.latest_version = dv
+        doc.save()
+        doc.tags.set(tags)
+        ids.append(doc.id)
+    return create_session(user), ids
+
+
+async def fetch(reader, writer, host, path, cookie):
+    writer.write(
+        f"GET {path} HTTP/1.1\r\nHost: {host}\r\nCookie: sessionid={cookie}\r\n"
+        f"Connection: keep-alive\r\n\r\n".encode()
+    )
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = 0
+    chunked = False
+    for line in head.split(b"\r\n"):
+        name, _, value = line.partition(b":")
+        if name.lower() == b"content-length":
+            length = int(value)
+        elif name.lower() == b"transfer-encoding" and b"chunked" in value.lower():
+            chunked = True
+    if chunked:
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).strip(), 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                break
+    else:
+        await reader.readexactly(length)
+    return status
+
+
+async def load(port, paths, cookie, concurrency, requests):
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(paths[i % len(paths)])
+
+    async def client():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        while not queue.empty():
+            path = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                status = await fetch(reader, writer, f"127.0.0.1:{port}", path, cookie)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                errors += 1
+                writer.close()
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                continue
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors += 1
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            asyncio.run(asyncio.open_connection("127.0.0.1", port))
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--documents", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads")
+    parser.add_argument("--db", default="/tmp/doc_vault_benchmark.sqlite3")
+    args = parser.parse_args()
+
+    cookie, ids = setup(args.db, args.documents)
+    random.seed(0)
+    sample = random.sample(ids, min(len(ids), 50))
+    endpoints = {
+        "list": ("/api/v1/documents/", "/api/v1/async/documents/"),
+        "retrieve": ("/api/v1/documents/{}/", "/api/v1/async/documents/{}/"),
+        "download": (
+            "/api/v1/documents/{}/download/",
+            "/api/v1/async/documents/{}/download/",
+        ),
+    }
+    servers = {
+        "wsgi": [
+            "gunicorn",
+            "doc_vault.wsgi:application",
+            "--bind",
+            "127.0.0.1:8101",
+            "--workers",
+            str(args.workers),
+            "--threads",
+            str(args.threads),
+            "--worker-class",
+            "gthread",
+            "--log-level",
+            "warning",
+        ],
+        "asgi": [
+            "uvicorn",
+            "doc_vault.asgi:application",
+            "--port",
+            "8102",
+            "--workers",
+            str(args.workers),
+            "--log-level",
+            "warning",
+            "--no-access-log",
+        ],
+    }
+    ports = {"wsgi": 8101, "asgi": 8102}
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+
+    print(
+        f"{'server':6} {'endpoint':9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'errors':>6}"
+    )
+    for index, (name, command) in enumerate(servers.items()):
+        process = subprocess.Popen(command, env=env)
+        try:
+            wait_for_port(ports[name])
+            for endpoint, templates in endpoints.items():
+                paths = [templates[index].format(pk) for pk in sample]
+                # warm up caches and connections
+                asyncio.run(load(ports[name], paths, cookie, 10, 200))
+                latencies, errors, elapsed = asyncio.run(
+                    load(ports[name], paths, cookie, args.concurrency, args.requests)
+                )
+                print(
+                    f"{name:6} {endpoint:9} {len(latencies) / elapsed:8.0f} "
+                    f"{percentile(latencies, 50) * 1000:8.1f} "
+                    f"{percentile(latencies, 95) * 1000:8.1f} "
+                    f"{percentile(latencies, 99) * 1000:8.1f} {errors:6}"
+                )
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+import os
+
+import django
+
+
+def setup_database(db, settings_module="benchmarks.settings"):
+    """configure django for a fresh benchmark database at `db`"""
+    os.environ["DJANGO_SETTINGS_MODULE"] = settings_module
+    os.environ["BENCHMARK_DB"] = db
+    django.setup()
+    from django.core.management import call_command
+
+    if os.path.exists(db):
+        os.remove(db)
+    call_command("migrate", verbosity=0)
+
+
+def create_user(username="bench"):
+    from django.contrib.auth import get_user_model
+
+    return get_user_model().objects.create_user(username, password=username)
+
+
+def create_session(user):
+    """session key of a logged in session, for the sessionid cookie"""
+    from django.contrib.sessions.backends.db import SessionStore
+
+    session = SessionStore()
+    session["_auth_user_id"] = str(user.pk)
+    session["_auth_user_backend"] = "django.contrib.auth.backends.ModelBackend"
+    session["_auth_user_hash"] = user.get_session_auth_hash()
+    session.create()
+    return session.session_key
+
+
+def percentile(values, p):
+    """p-th percentile (1-99) of a list of numbers"""
+    import statistics
+
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
@@ -0,0 +1,184 @@
+"""
+synthetic documents for benchmarks, generated from a seed so every run
+processes the same bytes. Kinds:
+
+    text_pdf      pdf with a text layer
+    scanned_pdf   pdf of page images only (needs OCR)
+    docx          word document
+    image         png of a page (needs OCR)
+    text          plain utf-8 text
+"""
+
+import io
+import random
+from collections import namedtuple
+
+
+KINDS = ("text_pdf", "scanned_pdf", "docx", "image", "text")
+OCR_KINDS = ("scanned_pdf", "image")
+
+# pages per document for each size
+SIZES = {"small": 1, "medium": 10, "large": 50}
+
+CONTENT_TYPES = {
+    "text_pdf": "application/pdf",
+    "scanned_pdf": "application/pdf",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "image": "image/png",
+    "text": "text/plain",
+}
+EXTENSIONS = {
+    "text_pdf": "pdf",
+    "scanned_pdf": "pdf",
+    "docx": "docx",
+    "image": "png",
+    "text": "txt",
+}
+
+SyntheticDocument = namedtuple(
+    "SyntheticDocument", ["name", "kind", "size", "content_type", "data"]
+)
+
+LINES_PER_PAGE = 40
+
+WORDS = (
+    "invoice total amount contract party agreement payment due date customer "
+    "supplier order delivery shipment account balance tax rate period term "
+    "clause section annex schedule signature witness policy claim premium "
+    "report quarter revenue expense budget forecast audit review approval "
+    "project milestone deliverable budget owner status risk issue change"
+).split()
+
+
+def page_lines(rng, count=LINES_PER_PAGE):
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 12)))
+        for _ in range(count)
+    ]
+
+
+def text_pdf(pages):
+    """pdf bytes, one page of Helvetica text per item of `pages` (lines)"""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # pages, filled in once the page object numbers are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for lines in pages:
+        stream = ["BT /F1 10 Tf 14 TL 50 800 Td"]
+        for line in lines:
+            escaped = line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+            stream.append(f"({escaped}) Tj T*")
+        stream.append("ET")
+        content = "\n".join(stream).encode("latin-1")
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+        )
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % n for n in kids),
+        len(kids),
+    )
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(
+        b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+        % (len(objects) + 1, xref)
+    )
+    return out.getvalue()
+
+
+def page_image(lines, width=1240, height=1754):
+    """a4 page at 150 dpi with the lines drawn on it"""
+    from PIL import Image, ImageDraw
+
+    image = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((80, 80 + i * 38), line, fill=0)
+    return image
+
+
+def scanned_pdf(pages):
+    images = [page_image(lines) for lines in pages]
+    out = io.BytesIO()
+    # 150 dpi, so the pages are a4 like a real scan
+    images[0].save(
+        out, format="PDF", resolution=150, save_all=True, append_images=images[1:]
+    )
+    return out.getvalue()
+
+
+def docx(pages):
+    import docx as python_docx
+
+    document = python_docx.Document()
+    for lines in pages:
+        for line in lines:
+            document.add_paragraph(line)
+        document.add_page_break()
+    out = io.BytesIO()
+    document.save(out)
+    return out.getvalue()
+
+
+def image(pages):
+    out = io.BytesIO()
+    # a single image holds one page whatever the size
+    page_image(pages[0]).save(out, format="PNG")
+    return out.getvalue()
+
+
+def text(pages):
+    return "\n\n".join("\n".join(lines) for lines in pages).encode("utf-8")
+
+
+BUILDERS = {
+    "text_pdf": text_pdf,
+    "scanned_pdf": scanned_pdf,
+    "docx": docx,
+    "image": image,
+    "text": text,
+}
+
+
+def generate(count, kinds=KINDS, sizes=("small", "medium"), duplicates=0.0, seed=0):
+    """
+    `count` documents cycling through kinds and sizes. A `duplicates`
+    fraction of them repeat the bytes of an earlier document, which the
+    scan stage deduplicates
+    """
+    rng = random.Random(seed)
+    documents = []
+    for i in range(count):
+        if documents and rng.random() < duplicates:
+            original = rng.choice(documents)
+            documents.append(original._replace(name=f"{i:05d}-{original.name[6:]}"))
+            continue
+        kind = kinds[i % len(kinds)]
+        size = sizes[(i // len(kinds)) % len(sizes)]
+        pages = [page_lines(rng) for _ in range(SIZES[size])]
+        documents.append(
+            SyntheticDocument(
+                name=f"{i:05d}-{kind}-{size}.{EXTENSIONS[kind]}",
+                kind=kind,
+                size=size,
+                content_type=CONTENT_TYPES[kind],
+                data=BUILDERS[kind](pages),
+            )
+        )
+    return documents
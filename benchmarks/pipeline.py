@@ -0,0 +1,411 @@
+"""
+benchmark of the upload -> process -> search path on a synthetic corpus,
+with in-memory storage, a fake clamd and celery in eager or worker mode:
+
+    python -m benchmarks.pipeline --count 100 --mode worker --concurrency 4
+    python -m benchmarks.pipeline --save eager          # record a baseline
+    python -m benchmarks.pipeline --compare eager       # exit 1 on regression
+
+Reports per-stage latency percentiles (self time, nested stages excluded),
+database queries per call, end-to-end latency, docs/sec and peak RSS.
+Baselines are json files under benchmarks/baselines/.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from . import corpus
+from .common import create_user, percentile, setup_database
+
+
+BASELINE_DIR = Path(__file__).resolve().parent / "baselines"
+TERMINAL_STAGES = ("DONE", "QUARANTINED")
+
+
+class Recorder:
+    """
+    latency and query counts per label. Labels nest (an eager task runs
+    inside the request that queued it); time and queries are charged to the
+    innermost label only
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(int)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @property
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def start(self, label):
+        # [label, start, time spent in nested labels]
+        self.stack.append([label, time.perf_counter(), 0.0])
+
+    def stop(self):
+        label, start, nested = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        if self.stack:
+            self.stack[-1][2] += elapsed
+        with self.lock:
+            self.latencies[label].append(elapsed - nested)
+
+    @contextmanager
+    def measure(self, label):
+        self.start(label)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def count_query(self, execute, sql, params, many, context):
+        label = self.stack[-1][0] if self.stack else "unattributed"
+        with self.lock:
+            self.queries[label] += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        """count the queries of every connection, time every celery task"""
+        from celery.signals import task_postrun, task_prerun
+        from django.db import connection
+        from django.db.backends.signals import connection_created
+
+        def add_wrapper(connection, **kwargs):
+            if self.count_query not in connection.execute_wrappers:
+                connection.execute_wrappers.append(self.count_query)
+
+        connection_created.connect(add_wrapper, weak=False)
+        add_wrapper(connection)
+        task_prerun.connect(
+            lambda sender=None, **kwargs: self.start(sender.name.rsplit(".", 1)[-1]),
+            weak=False,
+        )
+        task_postrun.connect(lambda **kwargs: self.stop(), weak=False)
+
+    def summary(self):
+        stages = {}
+        for label, values in self.latencies.items():
+            stages[label] = {
+                "calls": len(values),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "mean_ms": sum(values) / len(values) * 1000,
+                "queries_per_call": self.queries.get(label, 0) / len(values),
+            }
+        return stages
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def ocr_mode(requested):
+    if requested == "auto":
+        return "tesseract" if shutil.which("tesseract") else "skip"
+    return requested
+
+
+def run(args):
+    os.environ["BENCHMARK_CELERY_MODE"] = args.mode
+    setup_database(args.db)
+    from django.db import connection
+    from rest_framework.test import APIClient
+
+    from documents.models import DocumentVersion
+    from documents.storage import get_storage
+
+    from .stubs import FakeScanner, install_ocr_stub
+
+    mode = ocr_mode(args.ocr)
+    kinds = [k for k in args.kinds if mode != "skip" or k not in corpus.OCR_KINDS]
+    if mode == "stub":
+        install_ocr_stub(args.ocr_delay)
+    FakeScanner.delay = args.scan_delay
+
+    documents = corpus.generate(
+        args.count, kinds, args.sizes, duplicates=args.duplicates, seed=args.seed
+    )
+    user = create_user()
+    client = APIClient(raise_request_exception=False)
+    client.force_authenticate(user)
+    storage = get_storage()
+    recorder = Recorder()
+    recorder.install()
+    rss_before = peak_rss_mb()
+
+    worker = None
+    if args.mode == "worker":
+        from celery.contrib.testing.worker import start_worker
+
+        from doc_vault.celery import app
+
+        queues = {route["queue"] for route in app.conf.task_routes.values()}
+        worker = start_worker(
+            app,
+            concurrency=args.concurrency,
+            pool="threads",
+            perform_ping_check=False,
+            queues=sorted(queues | {app.conf.task_default_queue}),
+        )
+        worker.__enter__()
+
+    completed_at = {}
+    failed = 0
+    start = time.perf_counter()
+    try:
+        for document in documents:
+            with recorder.measure("create_meta"):
+                response = client.post(
+                    "/api/v1/documents/create_meta/",
+                    {
+                        "title": document.name,
+                        "filename": document.name,
+                        "content_type": document.content_type,
+                    },
+                    format="json",
+                )
+            if response.status_code != 201:
+                failed += 1
+                continue
+            meta = response.json()
+            # what the client does with the presigned post
+            storage.save(meta["presigned_post"]["fields"]["key"], document.data)
+            completed_at[meta["version_id"]] = time.time()
+            with recorder.measure("complete_upload"):
+                response = client.post(
+                    f"/api/v1/documents/{meta['document_id']}/complete_upload/",
+                    {
+                        "version_id": meta["version_id"],
+                        "file_size": len(document.data),
+                        "file_hash": hashlib.sha256(document.data).hexdigest(),
+                    },
+                    format="json",
+                )
+            if response.status_code != 200:
+                failed += 1
+
+        deadline = time.monotonic() + args.timeout
+        versions = DocumentVersion.objects.filter(pk__in=completed_at)
+        while time.monotonic() < deadline:
+            if not versions.exclude(stage__in=TERMINAL_STAGES).exists():
+                break
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+    finally:
+        if worker is not None:
+            worker.__exit__(None, None, None)
+
+    end_to_end = []
+    stages = defaultdict(int)
+    for version in versions.only("id", "stage", "stage_updated_at"):
+        stages[version.stage] += 1
+        if version.stage in TERMINAL_STAGES and version.stage_updated_at:
+            end_to_end.append(
+                version.stage_updated_at.timestamp() - completed_at[version.id]
+            )
+
+    rng = random.Random(args.seed)
+    for _ in range(args.searches):
+        query = " ".join(rng.sample(corpus.WORDS, 2))
+        with recorder.measure("search"):
+            client.get("/api/v1/documents/search/", {"q": query})
+    connection.close()
+
+    done = stages.get("DONE", 0) + stages.get("QUARANTINED", 0)
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "mode": args.mode,
+            "concurrency": args.concurrency if args.mode == "worker" else 1,
+            "ocr": mode,
+            "kinds": kinds,
+            "sizes": list(args.sizes),
+            "count": args.count,
+            "duplicates": args.duplicates,
+            "seed": args.seed,
+        },
+        "documents": len(documents),
+        "corpus_bytes": sum(len(d.data) for d in documents),
+        "processed": done,
+        "unfinished": dict(
+            (k, v) for k, v in stages.items() if k not in TERMINAL_STAGES
+        ),
+        "failed_requests": failed,
+        "elapsed_s": elapsed,
+        "docs_per_sec": done / elapsed if elapsed else 0.0,
+        "rss_before_mb": rss_before,
+        "peak_rss_mb": peak_rss_mb(),
+        "end_to_end": {
+            "p50_ms": (percentile(end_to_end, 50) or 0) * 1000,
+            "p95_ms": (percentile(end_to_end, 95) or 0) * 1000,
+            "p99_ms": (percentile(end_to_end, 99) or 0) * 1000,
+        },
+        "stages": recorder.summary(),
+    }
+
+
+def report(result):
+    meta = result["meta"]
+    print(
+        f"{result['documents']} documents ({result['corpus_bytes'] / 1e6:.1f} MB), "
+        f"mode={meta['mode']} concurrency={meta['concurrency']} ocr={meta['ocr']}"
+    )
+    print(
+        f"{'stage':26} {'calls':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8}"
+    )
+    for label, stage in sorted(result["stages"].items()):
+        print(
+            f"{label:26} {stage['calls']:6} {stage['p50_ms']:9.1f} "
+            f"{stage['p95_ms']:9.1f} {stage['p99_ms']:9.1f} "
+            f"{stage['queries_per_call']:8.1f}"
+        )
+    e2e = result["end_to_end"]
+    print(
+        f"end to end p50/p95/p99: {e2e['p50_ms']:.0f}/{e2e['p95_ms']:.0f}/"
+        f"{e2e['p99_ms']:.0f} ms"
+    )
+    print(
+        f"processed {result['processed']} in {result['elapsed_s']:.1f}s, "
+        f"{result['docs_per_sec']:.2f} docs/sec, peak RSS {result['peak_rss_mb']:.0f} MB "
+        f"({result['rss_before_mb']:.0f} MB before the run)"
+    )
+    if result["unfinished"] or result["failed_requests"]:
+        print(
+            f"unfinished: {result['unfinished']}, "
+            f"failed requests: {result['failed_requests']}"
+        )
+
+
+def compare(result, baseline, tolerance, min_delta_ms=10.0):
+    """regressions of `result` against `baseline`, as readable lines"""
+    regressions = []
+    if result["docs_per_sec"] < baseline["docs_per_sec"] * (1 - tolerance):
+        regressions.append(
+            f"docs/sec {result['docs_per_sec']:.2f} < {baseline['docs_per_sec']:.2f}"
+        )
+    if result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(
+            f"peak RSS {result['peak_rss_mb']:.0f} MB > {baseline['peak_rss_mb']:.0f} MB"
+        )
+    for label, old in baseline["stages"].items():
+        new = result["stages"].get(label)
+        if new is None:
+            continue
+        for key in ("p50_ms", "p95_ms"):
+            # a few ms are run to run noise for the short stages
+            if new[key] > old[key] * (1 + tolerance) + min_delta_ms:
+                regressions.append(
+                    f"{label} {key[:3]} {new[key]:.1f} ms > {old[key]:.1f} ms"
+                )
+        # query counts do not depend on the machine, any growth is a change
+        if new["queries_per_call"] > old["queries_per_call"] * 1.05 + 0.1:
+            regressions.append(
+                f"{label} queries/call {new['queries_per_call']:.1f} > "
+                f"{old['queries_per_call']:.1f}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split("\n\n", 1)[1],
+    )
+    parser.add_argument("--count", type=int, default=40)
+    parser.add_argument(
+        "--kinds", nargs="+", choices=corpus.KINDS, default=corpus.KINDS
+    )
+    parser.add_argument(
+        "--sizes", nargs="+", choices=corpus.SIZES, default=("small", "medium")
+    )
+    parser.add_argument("--duplicates", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mode", choices=("eager", "worker"), default="eager")
+    parser.add_argument("--concurrency", type=int, default=4, help="worker threads")
+    parser.add_argument(
+        "--ocr",
+        choices=("auto", "tesseract", "stub", "skip"),
+        default="auto",
+        help="auto uses tesseract if installed and skips OCR kinds otherwise",
+    )
+    parser.add_argument("--ocr-delay", type=float, default=0.05)
+    parser.add_argument("--scan-delay", type=float, default=0.0)
+    parser.add_argument("--searches", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--db", default="/tmp/doc_vault_pipeline.sqlite3")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--save", metavar="NAME", help="save as baseline NAME")
+    parser.add_argument("--compare", metavar="NAME", help="compare with baseline NAME")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument(
+        "--min-delta-ms",
+        type=float,
+        default=10.0,
+        help="latency growth below this is not a regression",
+    )
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+    for path in filter(
+        None, [args.output, args.save and BASELINE_DIR / f"{args.save}.json"]
+    ):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(json.dumps(result, indent=2, sort_keys=True) + "\n")
+        print(f"saved {path}")
+    if args.compare:
+        baseline = json.loads((BASELINE_DIR / f"{args.compare}.json").read_text())
+        for key in ("mode", "concurrency", "ocr", "kinds", "sizes", "count", "seed"):
+            if baseline["meta"].get(key) != result["meta"][key]:
+                print(
+                    f"warning: {key} is {result['meta'][key]!r}, the baseline "
+                    f"ran with {baseline['meta'].get(key)!r}"
+                )
+        regressions = compare(result, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(
+                f"regressions against {args.compare} ({baseline['meta']['revision']}):"
+            )
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"no regressions against {args.compare} ({baseline['meta']['revision']})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,30 @@
+# settings for benchmark runs: a throwaway sqlite database, in-memory storage,
+# a fake virus scanner and no external broker. BENCHMARK_DB selects the
+# database file, BENCHMARK_CELERY_MODE "eager" (tasks run inline) or "worker"
+# (in-memory broker consumed by a worker thread)
+import os
+
+from doc_vault.settings import *  # noqa: F401,F403
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.environ.get("BENCHMARK_DB", "/tmp/doc_vault_benchmark.sqlite3"),
+        "OPTIONS": {"timeout": 30},
+    }
+}
+ALLOWED_HOSTS = ["*"]
+DEBUG = False
+DOCUMENT_STORAGE_BACKEND = "documents.storage.InMemoryStorage"
+DOCUMENT_SCANNER_BACKEND = "benchmarks.stubs.FakeScanner"
+# no beat runs the admission of bulk versions, every upload is interactive
+DOCUMENT_INTERACTIVE_RATE = 0
+
+if os.environ.get("BENCHMARK_CELERY_MODE", "eager") == "worker":
+    CELERY_TASK_ALWAYS_EAGER = False
+    CELERY_BROKER_URL = "memory://"
+    CELERY_RESULT_BACKEND = "cache+memory://"
+else:
+    CELERY_TASK_ALWAYS_EAGER = True
+    CELERY_TASK_EAGER_PROPAGATES = True
+LOGGING = {"version": 1, "disable_existing_loggers": False}
@@ -0,0 +1,148 @@
+"""
+process start up cost per role, each run in a fresh interpreter:
+
+    python -m benchmarks.startup --runs 5
+
+- web: django setup, url resolution (imports the views) and the import of
+  documents.tasks a first complete_upload does. "web (eager imports)" also
+  imports the extraction stack and boto3, as every web process did before
+  they were imported lazily
+- worker: django setup and the task modules, like a celery worker, then its
+  first and second extraction (a text pdf and a docx, text and previews).
+  With preload the worker_init / worker_process_init hooks of
+  documents.warmup run at start, without it the first task pays the imports
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from .corpus import generate
+
+
+HEAVY_MODULES = ("pdfplumber", "pypdfium2", "pytesseract", "docx", "PIL.Image", "boto3")
+
+ROLES = {
+    "web": {},
+    "web (eager imports)": {},
+    "worker, no preload": {"DOCUMENT_WORKER_PRELOAD": "0"},
+    "worker, preload": {"DOCUMENT_WORKER_PRELOAD": "1"},
+}
+
+
+def run_child(role, samples_dir):
+    """the measured process, prints its results as json"""
+    import resource
+
+    start = time.perf_counter()
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "doc_vault.settings")
+    import django
+
+    django.setup()
+    result = {}
+    if role.startswith("web"):
+        if role == "web (eager imports)":
+            from documents.warmup import PRELOAD_MODULES
+
+            for name in PRELOAD_MODULES:
+                __import__(name)
+        from django.urls import resolve
+
+        resolve("/api/v1/documents/")
+        import documents.tasks  # noqa: F401
+    else:
+        from doc_vault.celery import app
+
+        app.loader.import_default_modules()
+        from documents import warmup
+
+        # what the worker signals run, solo pool
+        warmup.preload_modules()
+        samples = [
+            (name, open(os.path.join(samples_dir, name), "rb").read())
+            for name in sorted(os.listdir(samples_dir))
+        ]
+        result["startup"] = time.perf_counter() - start
+        for key in ("first_task", "warm_task"):
+            task_start = time.perf_counter()
+            extract(samples)
+            result[key] = time.perf_counter() - task_start
+    result.setdefault("startup", time.perf_counter() - start)
+    result["rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["heavy"] = [name for name in HEAVY_MODULES if name in sys.modules]
+    print(json.dumps(result))
+
+
+def extract(samples):
+    """the extraction stage work of a task, without database or storage io"""
+    import io
+
+    from documents.extractors import extract_chunks
+    from documents.previews import iter_renders, preview_plan
+    from documents.storage import S3Storage, get_s3_client, get_storage
+
+    if isinstance(get_storage(), S3Storage):
+        get_s3_client()
+    for name, data in samples:
+        stream = io.BytesIO(data)
+        list(extract_chunks(None, stream, name))
+        list(iter_renders(stream, name, preview_plan()))
+
+
+def measure(role, samples_dir, runs):
+    env = dict(os.environ, **ROLES[role])
+    env.pop("DJANGO_SETTINGS_MODULE", None)
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.startup", "--child", role, samples_dir],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    summary = {"heavy": results[-1]["heavy"]}
+    for key in ("startup", "first_task", "warm_task", "rss_mb"):
+        values = [result[key] for result in results if key in result]
+        summary[key] = statistics.median(values) if values else None
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(*args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as samples_dir:
+        for document in generate(2, kinds=("text_pdf", "docx"), sizes=("small",)):
+            with open(os.path.join(samples_dir, document.name), "wb") as f:
+                f.write(document.data)
+
+        def ms(value):
+            return "-" if value is None else f"{value * 1000:.0f}"
+
+        print(
+            f"{'role':<22}{'startup ms':>12}{'1st task ms':>13}"
+            f"{'2nd task ms':>13}{'RSS MB':>9}  heavy modules loaded"
+        )
+        for role in ROLES:
+            summary = measure(role, samples_dir, args.runs)
+            print(
+                f"{role:<22}{ms(summary['startup']):>12}"
+                f"{ms(summary['first_task']):>13}{ms(summary['warm_task']):>13}"
+                f"{summary['rss_mb']:>9.0f}  {', '.join(summary['heavy']) or '-'}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# local stand-ins for the external services of the pipeline
+import time
+
+from documents.scanner import BaseScanner
+
+
+EICAR = b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"
+
+
+class FakeScanner(BaseScanner):
+    """
+    clamd stand-in, reads the whole stream like INSTREAM does and reports
+    the EICAR test string as infected. `delay` simulates clamd's per-scan
+    latency (seconds)
+    """
+
+    delay = 0.0
+    chunk_size = 64 * 1024
+
+    def scan(self, stream):
+        tail = b""
+        found = False
+        while True:
+            data = stream.read(self.chunk_size)
+            if not data:
+                break
+            found = found or EICAR in tail + data
+            tail = data[-len(EICAR) :]
+        if self.delay:
+            time.sleep(self.delay)
+        if found:
+            return "FOUND", "Eicar-Test-Signature"
+        return "OK", None
+
+    def signature_version(self):
+        return "benchmark/1"
+
+
+def install_ocr_stub(delay=0.05, text="scanned page text"):
+    """
+    replace tesseract with a fixed answer after `delay` seconds, for machines
+    without the binary. Pages are still rendered at full DPI
+    """
+    import pytesseract
+
+    def image_to_string(image, lang=None, **kwargs):
+        time.sleep(delay)
+        return text
+
+    pytesseract.image_to_string = image_to_string
@@ -0,0 +1,4 @@
+# load the celery app with django so shared_task uses its broker settings
+from .celery import app as celery_app
+
+__all__ = ("celery_app",)
@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "documents.metrics.metrics_middleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -134,3 +135,230 @@ CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379/
 CELERY_RESULT_BACKEND = os.environ.get(
     "CELERY_RESULT_BACKEND", "redis://localhost:6379/0"
 )
+# every processing stage has its own queue, so OCR can run on dedicated
+# high-CPU workers while scans stay low latency
+CELERY_TASK_ROUTES = {
+    "documents.tasks.process_document_version": {
+        "queue": "documents.fetch",
+        "routing_key": "documents.fetch",
+    },
+    "documents.tasks.fetch_version": {
+        "queue": "documents.fetch",
+        "routing_key": "documents.fetch",
+    },
+    "documents.tasks.scan_version": {
+        "queue": "documents.scan",
+        "routing_key": "documents.scan",
+    },
+    "documents.tasks.restore_chunked_blob": {
+        "queue": "documents.fetch",
+        "routing_key": "documents.fetch",
+    },
+    "documents.tasks.rescan_stale_blobs": {
+        "queue": "documents.scan",
+        "routing_key": "documents.scan",
+    },
+    "documents.tasks.extract_version": {
+        "queue": "documents.extract",
+        "routing_key": "documents.extract",
+    },
+    "documents.tasks.index_version": {
+        "queue": "documents.index",
+        "routing_key": "documents.index",
+    },
+}
+CELERY_BEAT_SCHEDULE = {
+    "collect-unreferenced-blobs": {
+        "task": "documents.tasks.collect_unreferenced_blobs",
+        "schedule": 60 * 60,
+    },
+    "rescan-stale-blobs": {
+        "task": "documents.tasks.rescan_stale_blobs",
+        "schedule": 60 * 60,
+    },
+    "abort-stale-uploads": {
+        "task": "documents.tasks.abort_stale_uploads",
+        "schedule": 60 * 60,
+    },
+    "chunk-superseded-blobs": {
+        "task": "documents.tasks.chunk_superseded_blobs",
+        "schedule": 24 * 60 * 60,
+    },
+    "archive-audit-log": {
+        "task": "documents.tasks.archive_audit_log",
+        "schedule": 24 * 60 * 60,
+    },
+    "admit-queued-versions": {
+        "task": "documents.tasks.admit_queued_versions",
+        "schedule": 10,
+    },
+    "index-pending-versions": {
+        "task": "documents.tasks.index_pending_versions",
+        "schedule": 5 * 60,
+    },
+}
+
+# celery workers import the extraction stack (pdfplumber, pdfium, tesseract,
+# python-docx, Pillow) and build their clients at start instead of on the
+# first task. Web processes never import it
+DOCUMENT_WORKER_PRELOAD = os.environ.get("DOCUMENT_WORKER_PRELOAD", "1") == "1"
+
+# scheduling, an owner's uploads are interactive up to a burst of
+# DOCUMENT_INTERACTIVE_BURST refilled at DOCUMENT_INTERACTIVE_RATE per minute
+# (0 = no limit). Others are bulk: admitted fairly between owners, at most
+# DOCUMENT_BULK_MAX_IN_FLIGHT processing, on the ".bulk" twin of every queue
+DOCUMENT_INTERACTIVE_RATE = int(os.environ.get("DOCUMENT_INTERACTIVE_RATE", 30))
+DOCUMENT_INTERACTIVE_BURST = int(os.environ.get("DOCUMENT_INTERACTIVE_BURST", 20))
+DOCUMENT_BULK_MAX_IN_FLIGHT = int(os.environ.get("DOCUMENT_BULK_MAX_IN_FLIGHT", 100))
+
+# OCR
+DOCUMENT_OCR_DPI = int(os.environ.get("DOCUMENT_OCR_DPI", 300))
+# max tesseract processes per task, keep celery concurrency * this <= cores
+# (each tesseract is single threaded, see documents.ocr)
+DOCUMENT_OCR_CONCURRENCY = int(os.environ.get("DOCUMENT_OCR_CONCURRENCY", 2))
+# pdf pages are classified one by one: text layer, OCR or blank
+DOCUMENT_OCR_MIN_TEXT_CHARS = 20  # fewer letters is not a usable text layer
+DOCUMENT_OCR_MIN_TEXT_DENSITY = 2  # letters per square inch over a page image
+DOCUMENT_OCR_MIN_IMAGE_COVERAGE = 0.1  # page fraction covered by images to OCR
+DOCUMENT_OCR_MIN_VECTOR_OBJECTS = 200  # curves etc. of text drawn as outlines
+# scanned pages are rendered at the resolution of their images, within
+# DOCUMENT_OCR_MIN_DPI..DOCUMENT_OCR_DPI and at most this many pixels
+DOCUMENT_OCR_MIN_DPI = 200
+DOCUMENT_OCR_MAX_PIXELS = 16_000_000
+DOCUMENT_OCR_BLANK_INK_RATIO = 0.0002  # rendered pages with less ink are blank
+
+# text extraction
+DOCUMENT_TEXT_CHUNK_SIZE = 4000  # chars per chunk for docx / plain text
+DOCUMENT_PAGE_BATCH_SIZE = 100  # DocumentPage rows per bulk insert
+DOCUMENT_TEXT_PAGE_RANGE_MAX = 50  # pages per call of the text endpoint
+
+# page previews (jpeg), the first page is rendered at every size (longest
+# edge, px) while processing, the next pages up to DOCUMENT_PREVIEW_PAGES at
+# the smallest. Other pages / sizes are rendered on request into a disk cache
+DOCUMENT_PREVIEW_SIZES = (160, 640, 1280)
+DOCUMENT_PREVIEW_PAGES = 20  # 0 renders previews on request only
+DOCUMENT_PREVIEW_QUALITY = 80
+DOCUMENT_PREVIEW_CACHE_DIR = os.environ.get("DOCUMENT_PREVIEW_CACHE_DIR") or None
+DOCUMENT_PREVIEW_CACHE_MAX_SIZE = int(
+    os.environ.get("DOCUMENT_PREVIEW_CACHE_MAX_SIZE", 512 * 1024 * 1024)
+)
+
+# deduplication, unreferenced blobs are kept this long (seconds) before the
+# stored object is deleted
+DOCUMENT_BLOB_GC_GRACE_PERIOD = 24 * 60 * 60
+
+# full-text search, dotted path to a documents.search backend class. Picked
+# from the database vendor when unset (sqlite fts5 / postgres tsvector)
+DOCUMENT_SEARCH_BACKEND = os.environ.get("DOCUMENT_SEARCH_BACKEND") or None
+DOCUMENT_INDEX_BATCH_SIZE = 500  # versions per index_pending_versions run
+
+# storage of uploaded files, documents.storage.S3Storage / LocalStorage /
+# InMemoryStorage
+DOCUMENT_STORAGE_BACKEND = os.environ.get(
+    "DOCUMENT_STORAGE_BACKEND", "documents.storage.S3Storage"
+)
+DOCUMENT_STORAGE_ROOT = os.environ.get("DOCUMENT_STORAGE_ROOT", BASE_DIR / "storage")
+AWS_STORAGE_BUCKET_NAME = os.environ.get("AWS_STORAGE_BUCKET_NAME")
+AWS_S3_REGION_NAME = os.environ.get("AWS_S3_REGION_NAME")
+AWS_S3_ENDPOINT_URL = os.environ.get("AWS_S3_ENDPOINT_URL")
+# connections kept per process by the shared S3 client
+AWS_S3_MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_S3_MAX_POOL_CONNECTIONS", 50))
+
+# downloads are buffered in memory up to this size before spilling to disk
+DOCUMENT_SPOOL_MAX_SIZE = int(
+    os.environ.get("DOCUMENT_SPOOL_MAX_SIZE", 32 * 1024 * 1024)
+)
+
+# when clamd is unavailable the scan stage retries (True) or lets the version
+# through unscanned (False)
+DOCUMENT_SCAN_REQUIRED = os.environ.get("DOCUMENT_SCAN_REQUIRED", "1") == "1"
+
+# clamd, scanned over INSTREAM with a pool of persistent sessions per worker.
+# Set CLAMD_HOST to use TCP instead of the unix socket
+CLAMD_SOCKET = os.environ.get("CLAMD_SOCKET", "/var/run/clamav/clamd.ctl")
+CLAMD_HOST = os.environ.get("CLAMD_HOST")
+CLAMD_PORT = int(os.environ.get("CLAMD_PORT", 3310))
+CLAMD_POOL_SIZE = 4
+CLAMD_MAX_IDLE = 20  # seconds, below clamd's IdleTimeout (30s by default)
+CLAMD_VERSION_TTL = 300  # how long the signature version is cached
+# clamd's StreamMaxLength (25MB by default, at most 4GB). Larger content is
+# not sent, with DOCUMENT_SCAN_REQUIRED its version stops at the scan stage.
+# Raise both together to scan large uploads
+CLAMD_STREAM_MAX_LENGTH = int(
+    os.environ.get("CLAMD_STREAM_MAX_LENGTH", 25 * 1024 * 1024)
+)
+# blobs up to this size are rescanned in batches after signature updates
+DOCUMENT_RESCAN_MAX_SIZE = 1024 * 1024
+
+# audit entries are buffered in process and bulk inserted by a background
+# thread within AUDIT_LOG_FLUSH_INTERVAL seconds, 0 writes them synchronously
+AUDIT_LOG_FLUSH_INTERVAL = float(os.environ.get("AUDIT_LOG_FLUSH_INTERVAL", 1.0))
+AUDIT_LOG_BATCH_SIZE = 200
+AUDIT_LOG_MAX_BUFFER = 10000  # the logging thread flushes itself beyond this
+# months of audit entries kept in the database, older months are archived
+# to gzipped json lines files under audit/ in document storage
+AUDIT_LOG_RETENTION_MONTHS = int(os.environ.get("AUDIT_LOG_RETENTION_MONTHS", 12))
+
+# shared cache (redis when REDIS_CACHE_URL is set), the document cache keeps
+# serialized documents and permissions here for DOCUMENT_CACHE_TTL seconds
+if os.environ.get("REDIS_CACHE_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["REDIS_CACHE_URL"],
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        }
+    }
+DOCUMENT_CACHE_ALIAS = "default"
+DOCUMENT_CACHE_TTL = 300
+# per-process tier in front of the shared cache, also the longest another
+# process may serve a document after it changed
+DOCUMENT_CACHE_LOCAL_TTL = 5
+DOCUMENT_CACHE_LOCAL_MAX_ENTRIES = 1000
+
+# presigned download urls, reused from an in-process cache for the first
+# half of their lifetime
+DOCUMENT_DOWNLOAD_URL_EXPIRATION = 3600
+DOCUMENT_PRESIGN_CACHE_MAX_ENTRIES = 10000
+DOCUMENT_PRESIGN_BATCH_MAX = 500  # version ids per presign_downloads call
+DOCUMENT_BULK_MAX = 500  # documents per bulk_* call
+
+# multipart uploads, for files too large for a single presigned POST. Parts
+# are DOCUMENT_UPLOAD_PART_SIZE (more for files above 10000 parts)
+DOCUMENT_UPLOAD_PART_SIZE = 16 * 1024 * 1024
+DOCUMENT_MULTIPART_MAX_SIZE = 50 * 1024 * 1024 * 1024
+DOCUMENT_UPLOAD_MAX_AGE = 24 * 60 * 60  # pending uploads are aborted after
+
+# diffs between version texts are cached by content hash pair, until the
+# text of either content is extracted again
+DOCUMENT_DIFF_CACHE_TTL = 24 * 60 * 60
+# content defined chunking of blobs only older versions use, unchanged
+# chunks are then stored once for all revisions
+DOCUMENT_CHUNKING_ENABLED = os.environ.get("DOCUMENT_CHUNKING_ENABLED", "0") == "1"
+DOCUMENT_CHUNKING_BATCH_SIZE = 100  # blobs per daily run
+DOCUMENT_CHUNK_MIN_SIZE = 16 * 1024
+DOCUMENT_CHUNK_AVG_SIZE = 64 * 1024
+DOCUMENT_CHUNK_MAX_SIZE = 256 * 1024
+# downloads of chunked blobs queue a restore and answer 202 until it is done
+DOCUMENT_RESTORE_LOCK_TTL = 300  # a lost restore is queued again after
+DOCUMENT_RESTORE_RETRY_AFTER = 5  # seconds, Retry-After of those answers
+
+# prometheus metrics at /metrics, set PROMETHEUS_MULTIPROC_DIR for gunicorn /
+# celery prefork. Celery workers serve theirs on METRICS_WORKER_PORT (0 = off)
+# /metrics answers clients in METRICS_ALLOWED_NETWORKS (comma separated
+# CIDRs) and requests with the METRICS_TOKEN bearer token, nobody by default
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+METRICS_ALLOWED_NETWORKS = [
+    network.strip()
+    for network in os.environ.get("METRICS_ALLOWED_NETWORKS", "").split(",")
+    if network.strip()
+]
+METRICS_WORKER_PORT = int(os.environ.get("METRICS_WORKER_PORT", 0))
+METRICS_QUEUE_DEPTH_TTL = 15
+METRICS_TOP_OWNERS = 20  # owners labelled in the per-owner queue depths
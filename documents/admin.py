@@ -1,7 +1,18 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import Document, DocumentVersion, Tag, AuditLog, SharedDocument
+from .models import (
+    AuditArchive,
+    BackfillCursor,
+    Blob,
+    Document,
+    DocumentVersion,
+    DocumentPage,
+    MultipartUpload,
+    Tag,
+    AuditLog,
+    SharedDocument,
+)
 
 
 @admin.register(Document)
@@ -18,8 +29,27 @@ class DocumentVersionAdmin(admin.ModelAdmin):
     # list_filter = ('created_at',)
 
 
+@admin.register(DocumentPage)
+class DocumentPageAdmin(admin.ModelAdmin):
+    list_display = ("id", "version", "page_number", "source", "created_at")
+    list_select_related = ("version__document",)
+
+    def get_queryset(self, request):
+        # page text is only loaded on the change form
+        queryset = super().get_queryset(request)
+        if request.resolver_match and request.resolver_match.url_name.endswith(
+            "changelist"
+        ):
+            queryset = queryset.defer("text")
+        return queryset
+
+
 # admin.site.register(Document)
 # admin.site.register(DocumentVersion)
 admin.site.register(Tag)
 admin.site.register(AuditLog)
 admin.site.register(SharedDocument)
+admin.site.register(Blob)
+admin.site.register(BackfillCursor)
+admin.site.register(AuditArchive)
+admin.site.register(MultipartUpload)
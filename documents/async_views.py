@@ -0,0 +1,139 @@
+# async read endpoints for ASGI deployments (uvicorn doc_vault.asgi:application).
+# They mirror list / retrieve / download of DocumentViewSet without DRF, so a
+# request waiting on the database, cache or S3 does not hold a worker thread.
+# Authentication is the session, like the browsable API.
+from functools import wraps
+
+from django.conf import settings
+from django.db.models import F
+from django.http import Http404, JsonResponse
+from django.views.decorators.http import require_GET
+from rest_framework.utils.encoders import JSONEncoder
+
+from .audit import alog_event
+from .cache import get_document_cache
+from .models import Document, DocumentVersion
+from .serializers import DocumentListSerializer, DocumentSerializer
+from .utils import ContentRestoring, agenerate_presigned_download, parse_id
+
+
+def json_response(data, status=200):
+    # DRF's encoder, so payloads match the synchronous endpoints
+    return JsonResponse(data, status=status, encoder=JSONEncoder, safe=False)
+
+
+def login_required_json(view):
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        user = await request.auser()
+        if not user.is_authenticated:
+            return json_response(
+                {"detail": "Authentication credentials were not provided."},
+                status=403,
+            )
+        try:
+            return await view(request, user, *args, **kwargs)
+        except Http404:
+            return json_response(
+                {"detail": "No Document matches the given query."}, status=404
+            )
+
+    return wrapper
+
+
+@require_GET
+@login_required_json
+async def document_list(request, user):
+    """
+    documents of the user, newest first
+    ?cursor=<id of the last document seen>&page_size=50
+    """
+    try:
+        page_size = min(max(int(request.GET.get("page_size", 50)), 1), 200)
+        cursor = int(request.GET["cursor"]) if request.GET.get("cursor") else None
+    except ValueError:
+        return json_response(
+            {"error": "cursor and page_size must be integers."}, status=400
+        )
+
+    querySet = (
+        Document.objects.filter(owner=user)
+        .select_related("owner", "latest_version")
+        .prefetch_related("tags")
+        .order_by("-id")
+    )
+    if cursor is not None:
+        querySet = querySet.filter(id__lt=cursor)
+    docs = [doc async for doc in querySet[: page_size + 1]]
+    next_url = None
+    if len(docs) > page_size:
+        docs = docs[:page_size]
+        next_url = request.build_absolute_uri(
+            f"{request.path}?cursor={docs[-1].id}&page_size={page_size}"
+        )
+    results = DocumentListSerializer(
+        docs, many=True, context={"request": request}
+    ).data
+    return json_response({"next": next_url, "results": results})
+
+
+@require_GET
+@login_required_json
+async def document_detail(request, user, pk):
+    cache = get_document_cache()
+    if not await cache.aget_permission(user, pk):
+        raise Http404
+    payload = await cache.aget_payload(
+        pk, lambda doc: DocumentSerializer(doc, context={"request": request}).data
+    )
+    if payload is None:
+        raise Http404
+    return json_response(payload)
+
+
+@require_GET
+@login_required_json
+async def document_download(request, user, pk):
+    """presigned download url of the latest version, or of ?version_id=<id>"""
+    if not await get_document_cache().aget_permission(user, pk):
+        raise Http404
+    versions = (
+        DocumentVersion.objects.select_related("blob")
+        .filter(document_id=pk)
+        .annotate(document_owner_id=F("document__owner_id"))
+    )
+    version_id = request.GET.get("version_id")
+    if version_id:
+        version_id = parse_id(version_id)
+        if version_id is None:
+            return json_response({"error": "version_id must be an integer."}, 400)
+        versions = versions.filter(pk=version_id)
+    else:
+        versions = versions.filter(
+            pk__in=Document.objects.filter(pk=pk).values("latest_version_id")
+        )
+    dv = await versions.afirst()
+    if dv is None:
+        raise Http404
+    if dv.stage == "QUARANTINED":
+        return json_response({"error": "version is quarantined."}, status=409)
+    if dv.stage not in DocumentVersion.SCANNED_STAGES:
+        return json_response({"error": "version has not been scanned yet."}, status=409)
+    try:
+        url, expires_at = await agenerate_presigned_download(
+            dv, getattr(settings, "DOCUMENT_DOWNLOAD_URL_EXPIRATION", None)
+        )
+    except ContentRestoring:
+        response = json_response({"version_id": dv.id, "status": "restoring"}, 202)
+        response["Retry-After"] = str(
+            getattr(settings, "DOCUMENT_RESTORE_RETRY_AFTER", 5)
+        )
+        return response
+    await alog_event(
+        "DOWNLOAD",
+        user=user,
+        document_id=pk,
+        document_owner_id=dv.document_owner_id,
+        version=dv,
+    )
+    return json_response({"version_id": dv.id, "url": url, "expires_at": expires_at})
@@ -0,0 +1,307 @@
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection
+from django.utils import timezone
+
+from .models import AuditArchive, AuditLog
+from .storage import get_storage
+from .streams import spooled_file
+
+
+logger = logging.getLogger(__name__)
+
+
+class AuditWriter:
+    """
+    buffers AuditLog rows in process and writes them with bulk_create from a
+    background thread, so logging costs a list append on the request path.
+    A batch is written once it holds AUDIT_LOG_BATCH_SIZE rows or its oldest
+    row waited AUDIT_LOG_FLUSH_INTERVAL seconds. Rows that fail to insert
+    stay buffered for the next flush; when the buffer reaches
+    AUDIT_LOG_MAX_BUFFER the logging thread flushes itself (back pressure
+    instead of dropping entries).
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None, max_buffer=None):
+        self.batch_size = batch_size or getattr(settings, "AUDIT_LOG_BATCH_SIZE", 200)
+        if flush_interval is None:
+            flush_interval = getattr(settings, "AUDIT_LOG_FLUSH_INTERVAL", 1.0)
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer or getattr(settings, "AUDIT_LOG_MAX_BUFFER", 10000)
+        self.buffer = []
+        self.oldest = None
+        self.lock = threading.Lock()
+        # serialises flushes, the buffer lock is never held during an insert
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = None
+
+    def add(self, entry):
+        if self.closed or not self.flush_interval:
+            # synchronous mode, or logging during interpreter shutdown
+            self._write([entry])
+            return
+        with self.lock:
+            if not self.buffer:
+                self.oldest = time.monotonic()
+            self.buffer.append(entry)
+            size = len(self.buffer)
+        self._ensure_thread()
+        if size >= self.max_buffer:
+            self.flush()
+        elif size >= self.batch_size:
+            self.wakeup.set()
+
+    def would_block(self):
+        """whether add() would write to the database on the calling thread"""
+        return (
+            self.closed
+            or not self.flush_interval
+            or len(self.buffer) + 1 >= self.max_buffer
+        )
+
+    def flush(self):
+        """write everything buffered so far, returns the number of rows written"""
+        with self.flush_lock:
+            with self.lock:
+                pending, self.buffer, self.oldest = self.buffer, [], None
+            if not pending:
+                return 0
+            written = self._write(pending)
+            if written < len(pending):
+                # keep the unwritten rows (the database is unavailable) in front
+                # of anything logged meanwhile, bounded by max_buffer
+                with self.lock:
+                    self.buffer = (pending[written:] + self.buffer)[-self.max_buffer :]
+                    self.oldest = time.monotonic()
+            return written
+
+    def close(self):
+        """stop the flush thread and write what is left, called on shutdown"""
+        self.closed = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        with self.lock:
+            lost, self.buffer = self.buffer, []
+        for entry in lost:
+            # last resort, the entries end up in the worker log at least
+            logger.error(
+                f"Audit entry not written: {entry.action} user={entry.user_id} "
+                f"document={entry.document_id} version={entry.version_id} "
+                f"at={entry.timestamp.isoformat()} extra={entry.extra}"
+            )
+
+    def _ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(
+                        target=self._run, name="audit-writer", daemon=True
+                    )
+                    self.thread.start()
+
+    def _run(self):
+        try:
+            while not self.closed:
+                with self.lock:
+                    oldest = self.oldest
+                timeout = self.flush_interval
+                if oldest is not None:
+                    timeout = max(oldest + self.flush_interval - time.monotonic(), 0)
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+                if self.closed:
+                    break
+                self.flush()
+        finally:
+            # the thread owns its own connection
+            connection.close()
+
+    def _write(self, entries):
+        """insert `entries` in batches, returns how many were handled"""
+        done = 0
+        for start in range(0, len(entries), self.batch_size):
+            batch = entries[start : start + self.batch_size]
+            try:
+                AuditLog.objects.bulk_create(batch)
+            except IntegrityError:
+                # e.g. a document deleted before the flush, insert row by row
+                # so one bad row does not take the batch down with it
+                for entry in batch:
+                    try:
+                        AuditLog.objects.bulk_create([entry])
+                    except IntegrityError as e:
+                        logger.error(f"Dropping audit entry {entry.action}: {e}")
+            except DatabaseError as e:
+                logger.error(f"Audit flush failed, {len(entries) - done} pending: {e}")
+                return done
+            done += len(batch)
+        return done
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_audit_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = AuditWriter()
+                atexit.register(_writer.close)
+    return _writer
+
+
+def reset_audit_writer():
+    """
+    forget the parent's writer in a forked child. Its buffered rows are
+    written by the parent, the child starts with an empty buffer
+    """
+    global _writer, _writer_lock
+    _writer = None
+    _writer_lock = threading.Lock()
+
+
+def flush_audit_log(**kwargs):
+    if _writer is not None:
+        _writer.close()
+
+
+os.register_at_fork(after_in_child=reset_audit_writer)
+
+
+def log_event(action, user=None, document=None, version=None, extra=None, **fields):
+    """
+    record an audit entry, it is written within AUDIT_LOG_FLUSH_INTERVAL.
+    The timestamp is taken now, not when the row is inserted
+    """
+    if user is not None and not user.is_authenticated:
+        user = None
+    if document is not None:
+        fields.setdefault("document_owner_id", document.owner_id)
+    entry = AuditLog(
+        user=user,
+        action=action,
+        document=document,
+        version=version,
+        extra=extra,
+        timestamp=timezone.now(),
+        **fields,
+    )
+    get_audit_writer().add(entry)
+    return entry
+
+
+async def alog_event(action, **kwargs):
+    """log_event for async views, only leaves the event loop to write"""
+    if get_audit_writer().would_block():
+        return await sync_to_async(log_event)(action, **kwargs)
+    return log_event(action, **kwargs)
+
+
+def month_start(value, offset=0):
+    """first moment of the month of `value`, shifted by `offset` months"""
+    index = value.year * 12 + value.month - 1 + offset
+    return value.replace(
+        year=index // 12,
+        month=index % 12 + 1,
+        day=1,
+        hour=0,
+        minute=0,
+        second=0,
+        microsecond=0,
+    )
+
+
+def archive_audit_month(start, batch_size=2000):
+    """
+    write the entries of the month starting at `start` to a gzipped json
+    lines file in storage, then delete them. Returns the AuditArchive, None
+    when the month has no entries. Entries logged for the month later on
+    (e.g. from a backlog) end up in a further file on the next run
+    """
+    end = month_start(start, 1)
+    rows = AuditLog.objects.filter(timestamp__gte=start, timestamp__lt=end)
+    values = rows.order_by("id").values(
+        "id",
+        "timestamp",
+        "action",
+        "user_id",
+        "document_id",
+        "version_id",
+        "document_owner_id",
+        "details",
+        "ip_address",
+        "extra",
+    )
+    # ids of the written rows. An id range would also cover rows that were
+    # not committed yet while the month was read
+    ids = array("q")
+    with spooled_file() as spool:
+        with gzip.GzipFile(fileobj=spool, mode="wb") as out:
+            for row in values.iterator(chunk_size=batch_size):
+                row["timestamp"] = row["timestamp"].isoformat()
+                out.write(json.dumps(row).encode() + b"\n")
+                ids.append(row["id"])
+        count = len(ids)
+        if not count:
+            return None
+        first_id, last_id = ids[0], ids[-1]
+        size = spool.tell()
+        spool.seek(0)
+        digest = hashlib.file_digest(spool, "sha256").hexdigest()
+        spool.seek(0)
+        key = f"audit/{start:%Y-%m}/{first_id}-{last_id}.jsonl.gz"
+        get_storage().save(key, spool)
+
+    archive = AuditArchive.objects.create(
+        month=start.date(),
+        key=key,
+        row_count=count,
+        first_id=first_id,
+        last_id=last_id,
+        size=size,
+        sha256=digest,
+    )
+    for offset in range(0, count, batch_size):
+        batch = list(ids[offset : offset + batch_size])
+        AuditLog.objects.filter(id__in=batch).delete()
+    logger.info(f"Archived {count} audit entries of {start:%Y-%m} to {key}")
+    return archive
+
+
+def archive_audit_log(retention_months=None):
+    """
+    archive every month older than the retention period, oldest first.
+    Returns the archives written
+    """
+    if retention_months is None:
+        retention_months = getattr(settings, "AUDIT_LOG_RETENTION_MONTHS", 12)
+    cutoff = month_start(timezone.now(), -retention_months)
+    archives = []
+    while True:
+        oldest = (
+            AuditLog.objects.filter(timestamp__lt=cutoff)
+            .order_by("timestamp")
+            .values_list("timestamp", flat=True)
+            .first()
+        )
+        if oldest is None:
+            return archives
+        archive = archive_audit_month(month_start(oldest))
+        if archive is not None:
+            archives.append(archive)
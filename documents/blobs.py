@@ -0,0 +1,169 @@
+import logging
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .chunking import release_blob_chunks
+from .models import Blob, DocumentPage
+
+
+logger = logging.getLogger(__name__)
+
+# clamd status -> Blob.scan_status
+SCAN_STATUSES = {"OK": "CLEAN", "FOUND": "INFECTED"}
+
+
+def blob_key(sha256):
+    """
+    content addressed key of a blob. Upload urls are only ever signed for
+    version keys, so no client can write to it
+    """
+    return f"blobs/{sha256[:2]}/{sha256}"
+
+
+def incoming_key(version):
+    """key an upload is moved to before it is hashed and scanned"""
+    return f"blobs/incoming/{version.pk}"
+
+
+def attach_blob(version, sha256, key, size=None):
+    """
+    point `version` at the blob for `sha256`, creating it with `key` as its
+    stored object when the content is new. Returns (blob, created).
+    Calling it again for the same version is a no-op, so task retries do not
+    inflate the reference count.
+    """
+    with transaction.atomic():
+        try:
+            blob, created = Blob.objects.get_or_create(
+                sha256=sha256, defaults={"key": key, "size": size}
+            )
+        except IntegrityError:
+            # lost a race with a concurrent upload of the same content
+            blob, created = Blob.objects.get(sha256=sha256), False
+
+        if version.blob_id != blob.id:
+            if version.blob_id:
+                detach_blob(version.blob_id)
+            Blob.objects.filter(pk=blob.pk).update(
+                ref_count=F("ref_count") + 1, updated_at=timezone.now()
+            )
+            version.blob = blob
+            version.file_hash = sha256
+            version.save(update_fields=["blob", "file_hash"])
+
+    blob.refresh_from_db()
+    return blob, created
+
+
+def place_blob(blob, source, storage):
+    """
+    store the content of a blob at its blob_key from `source`, a scanned copy
+    of the same bytes, unless it is there already. Blobs archived as chunks
+    are restored, blobs stored at the upload key of their first version
+    (before blob keys) are moved. Returns whether the object was written
+    """
+    key = blob_key(blob.sha256)
+    if blob.key == key and not blob.chunked and storage.size(key) is not None:
+        return False
+    storage.copy(source, key)
+    old_key, chunked = blob.key, blob.chunked
+    Blob.objects.filter(pk=blob.pk).update(key=key, chunked=False)
+    blob.key, blob.chunked = key, False
+    if old_key != key and not chunked:
+        storage.delete(old_key)
+    return True
+
+
+def detach_blob(blob_id):
+    """drop one reference, unreferenced blobs are removed by the collector"""
+    Blob.objects.filter(pk=blob_id, ref_count__gt=0).update(
+        ref_count=F("ref_count") - 1, updated_at=timezone.now()
+    )
+
+
+def detach_blobs(counts):
+    """detach_blob for {blob id: references to drop}, in one update"""
+    if not counts:
+        return
+    dropped = Case(*(When(pk=pk, then=Value(count)) for pk, count in counts.items()))
+    Blob.objects.filter(pk__in=counts).update(
+        ref_count=Greatest(F("ref_count") - dropped, 0), updated_at=timezone.now()
+    )
+
+
+def has_current_verdict(blob, signature):
+    """whether the blob was scanned with the current signature database"""
+    return (
+        signature is not None
+        and blob.scan_status in ("CLEAN", "INFECTED")
+        and blob.scan_signature == signature
+    )
+
+
+def record_scan(blob, status, virus_name=None, signature=""):
+    """store a clamd verdict on the blob so duplicates can reuse it"""
+    blob.scan_status = SCAN_STATUSES.get(status, "ERROR")
+    blob.scan_result = {"status": status, "virus": virus_name}
+    blob.scan_signature = signature or ""
+    blob.save(update_fields=["scan_status", "scan_result", "scan_signature"])
+
+
+def copy_extracted_text(source, target, batch_size=500):
+    """copy the page rows of an already processed duplicate"""
+    DocumentPage.objects.filter(version=target).delete()
+    pending = []
+    for page in DocumentPage.objects.filter(version=source).iterator(
+        chunk_size=batch_size
+    ):
+        pending.append(
+            DocumentPage(
+                version=target,
+                page_number=page.page_number,
+                text=page.text,
+                source=page.source,
+            )
+        )
+        if len(pending) >= batch_size:
+            DocumentPage.objects.bulk_create(pending)
+            pending = []
+    if pending:
+        DocumentPage.objects.bulk_create(pending)
+
+
+def collect_unreferenced_blobs(delete_object, grace_period):
+    """
+    delete blobs without references that were last touched before the grace
+    period, `delete_object(key)` removes the stored object. Returns the number
+    of blobs removed.
+    """
+    cutoff = timezone.now() - grace_period
+    candidates = Blob.objects.filter(ref_count=0, updated_at__lt=cutoff)
+    removed = 0
+    for blob_id in candidates.values_list("id", flat=True).iterator():
+        with transaction.atomic():
+            blob = (
+                Blob.objects.select_for_update()
+                .filter(pk=blob_id, ref_count=0)
+                .first()
+            )
+            if blob is None:
+                # referenced again in the meantime
+                continue
+            in_use = blob.versions.count()
+            if in_use:
+                # the counter drifted, repair it instead of deleting
+                logger.warning(f"Blob {blob.sha256} has {in_use} untracked refs")
+                blob.ref_count = in_use
+                blob.save(update_fields=["ref_count"])
+                continue
+            if not blob.chunked:
+                delete_object(blob.key)
+            for key in blob.previews.values_list("key", flat=True):
+                delete_object(key)
+            release_blob_chunks(blob)
+            blob.delete()
+            removed += 1
+    return removed
@@ -0,0 +1,281 @@
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .metrics import CACHE_EVENTS
+from .models import Document, SharedDocument
+
+
+logger = logging.getLogger(__name__)
+
+# permission values, sharing permissions are stored as is ("VIEW", ...)
+OWNER = "OWNER"
+NO_ACCESS = ""
+
+
+class LRUCache:
+    """small in-process cache, least recently used entries go first"""
+
+    def __init__(self, max_entries=1000, ttl=5):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DocumentCache:
+    """
+    read-through cache of serialized documents and per (user, document)
+    permissions, in two tiers: a short lived per-process LRU in front of
+    the shared django cache (redis in production).
+    Keys embed a per-document generation. Changing a document, its
+    versions, tags or shares bumps the generation, which orphans every
+    entry of the document at once; orphans expire by TTL / LRU.
+    """
+
+    def __init__(self, alias=None, ttl=None, local_ttl=None, local_max_entries=None):
+        self.alias = alias or getattr(settings, "DOCUMENT_CACHE_ALIAS", "default")
+        self.ttl = ttl or getattr(settings, "DOCUMENT_CACHE_TTL", 300)
+        if local_ttl is None:
+            local_ttl = getattr(settings, "DOCUMENT_CACHE_LOCAL_TTL", 5)
+        self.local = LRUCache(
+            max_entries=local_max_entries
+            or getattr(settings, "DOCUMENT_CACHE_LOCAL_MAX_ENTRIES", 1000),
+            ttl=local_ttl,
+        )
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def generation(self, document_id):
+        key = f"doc:{document_id}:gen"
+        generation = self.local.get(key)
+        if generation is None:
+            generation = self._shared_get(key)
+            if generation is None:
+                # never restart at a small number, entries of an evicted
+                # generation could still be cached
+                generation = time.time_ns()
+                self._shared_call("add", key, generation, None)
+                generation = self._shared_get(key) or generation
+            self.local.set(key, generation)
+        return generation
+
+    def invalidate(self, document_id):
+        """orphan everything cached for the document"""
+        key = f"doc:{document_id}:gen"
+        self.local.delete(key)
+        try:
+            self.shared.incr(key)
+        except ValueError:
+            # not cached, the next read starts a new generation
+            pass
+        except Exception as e:
+            logger.warning(f"Document cache unavailable: {e}")
+        self.count("invalidations")
+
+    def get_permission(self, user, document_id):
+        """OWNER, the shared permission or NO_ACCESS. None if not found"""
+        key = f"perm:{document_id}:{self.generation(document_id)}:{user.pk}"
+        return self._get(
+            "permission", key, lambda: self._load_permission(user, document_id)
+        )
+
+    def get_payload(self, document_id, serialize):
+        """serialize(document) output, None if the document does not exist"""
+        key = f"doc:{document_id}:{self.generation(document_id)}:payload"
+        return self._get(
+            "payload", key, lambda: self._load_payload(document_id, serialize)
+        )
+
+    # async variants for the ASGI views, same keys and tiers. Local hits do
+    # not leave the event loop
+
+    async def ageneration(self, document_id):
+        key = f"doc:{document_id}:gen"
+        generation = self.local.get(key)
+        if generation is None:
+            generation = await self._ashared_call("get", key)
+            if generation is None:
+                generation = time.time_ns()
+                await self._ashared_call("add", key, generation, None)
+                generation = await self._ashared_call("get", key) or generation
+            self.local.set(key, generation)
+        return generation
+
+    async def aget_permission(self, user, document_id):
+        key = f"perm:{document_id}:{await self.ageneration(document_id)}:{user.pk}"
+        return await self._aget(
+            "permission", key, lambda: self._aload_permission(user, document_id)
+        )
+
+    async def aget_payload(self, document_id, serialize):
+        key = f"doc:{document_id}:{await self.ageneration(document_id)}:payload"
+        return await self._aget(
+            "payload", key, lambda: self._aload_payload(document_id, serialize)
+        )
+
+    def count(self, name, value=1):
+        with self.stats_lock:
+            self.stats[name] += value
+        CACHE_EVENTS.labels(name).inc(value)
+
+    def get_stats(self):
+        """hit / miss counters of this process"""
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def _get(self, kind, key, load):
+        value = self.local.get(key)
+        if value is not None:
+            self.count(f"{kind}_local_hits")
+            return value
+        value = self._shared_get(key)
+        if value is not None:
+            self.count(f"{kind}_hits")
+        else:
+            self.count(f"{kind}_misses")
+            value = load()
+            if value is None:
+                return None
+            self._shared_call("set", key, value, self.ttl)
+        self.local.set(key, value)
+        return value
+
+    async def _aget(self, kind, key, load):
+        value = self.local.get(key)
+        if value is not None:
+            self.count(f"{kind}_local_hits")
+            return value
+        value = await self._ashared_call("get", key)
+        if value is not None:
+            self.count(f"{kind}_hits")
+        else:
+            self.count(f"{kind}_misses")
+            value = await load()
+            if value is None:
+                return None
+            await self._ashared_call("set", key, value, self.ttl)
+        self.local.set(key, value)
+        return value
+
+    def _load_permission(self, user, document_id):
+        owner_id = (
+            Document.objects.filter(pk=document_id)
+            .values_list("owner_id", flat=True)
+            .first()
+        )
+        if owner_id is None:
+            return None
+        if owner_id == user.pk:
+            return OWNER
+        permission = (
+            SharedDocument.objects.filter(document_id=document_id, user=user)
+            .values_list("permission", flat=True)
+            .first()
+        )
+        return permission or NO_ACCESS
+
+    def _load_payload(self, document_id, serialize):
+        doc = (
+            Document.objects.select_related("owner")
+            .prefetch_related("tags", "versions")
+            .filter(pk=document_id)
+            .first()
+        )
+        return None if doc is None else serialize(doc)
+
+    async def _aload_permission(self, user, document_id):
+        owner_id = (
+            await Document.objects.filter(pk=document_id)
+            .values_list("owner_id", flat=True)
+            .afirst()
+        )
+        if owner_id is None:
+            return None
+        if owner_id == user.pk:
+            return OWNER
+        permission = (
+            await SharedDocument.objects.filter(document_id=document_id, user=user)
+            .values_list("permission", flat=True)
+            .afirst()
+        )
+        return permission or NO_ACCESS
+
+    async def _aload_payload(self, document_id, serialize):
+        docs = [
+            doc
+            async for doc in Document.objects.select_related("owner")
+            .prefetch_related("tags", "versions")
+            .filter(pk=document_id)
+        ]
+        # prefetched, serializing does not query
+        return serialize(docs[0]) if docs else None
+
+    def _shared_get(self, key):
+        return self._shared_call("get", key)
+
+    def _shared_call(self, method, *args):
+        # a cache outage degrades to database reads instead of failing requests
+        try:
+            return getattr(self.shared, method)(*args)
+        except Exception as e:
+            self.count("errors")
+            logger.warning(f"Document cache unavailable: {e}")
+            return None
+
+    async def _ashared_call(self, method, *args):
+        try:
+            return await getattr(self.shared, f"a{method}")(*args)
+        except Exception as e:
+            self.count("errors")
+            logger.warning(f"Document cache unavailable: {e}")
+            return None
+
+
+_document_cache = None
+_document_cache_lock = threading.Lock()
+
+
+def get_document_cache():
+    global _document_cache
+    if _document_cache is None:
+        with _document_cache_lock:
+            if _document_cache is None:
+                _document_cache = DocumentCache()
+    return _document_cache
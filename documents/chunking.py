@@ -0,0 +1,269 @@
+import hashlib
+import io
+import logging
+import random
+from collections import Counter
+from contextlib import closing
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Blob, BlobChunk, ContentChunk, Document, DocumentVersion
+from .storage import get_storage
+
+
+logger = logging.getLogger(__name__)
+
+# gear hash table, fixed so chunk boundaries are stable across processes
+_rng = random.Random(0x646F6376)
+GEAR = [_rng.getrandbits(64) for _ in range(256)]
+MASK_64 = (1 << 64) - 1
+
+
+def _masks(avg_size):
+    # FastCDC normalized chunking: harder to cut before the average size,
+    # easier after it, which narrows the chunk size distribution
+    bits = max(avg_size.bit_length() - 1, 3)
+    hard = ((1 << (bits + 2)) - 1) << (64 - bits - 2)
+    easy = ((1 << (bits - 2)) - 1) << (64 - bits + 2)
+    return hard, easy
+
+
+def find_cut_point(data, start, end, min_size, avg_size, max_size):
+    """
+    offset in `data` where the chunk starting at `start` ends. The gear hash
+    runs a byte at a time in Python, a few MB/s: fine for the daily archive
+    of superseded blobs, not for anything in a request
+    """
+    size = end - start
+    if size <= min_size:
+        return end
+    hard, easy = _masks(avg_size)
+    normal = start + min(avg_size, size)
+    end = start + min(max_size, size)
+    gear = GEAR
+    fingerprint = 0
+    # the first min_size bytes can never hold a boundary and are not hashed
+    i = start + min_size
+    with memoryview(data) as view:
+        # iterating a view slice yields the bytes as ints, without copies
+        for byte in view[i:normal]:
+            fingerprint = ((fingerprint << 1) + gear[byte]) & MASK_64
+            i += 1
+            if not fingerprint & hard:
+                return i
+        for byte in view[normal:end]:
+            fingerprint = ((fingerprint << 1) + gear[byte]) & MASK_64
+            i += 1
+            if not fingerprint & easy:
+                return i
+    return end
+
+
+def iter_content_chunks(stream, min_size=None, avg_size=None, max_size=None):
+    """
+    split a binary stream into content defined chunks. An edit only moves
+    the boundaries next to it, so unchanged regions of two revisions
+    produce the same chunks
+    """
+    min_size = min_size or getattr(settings, "DOCUMENT_CHUNK_MIN_SIZE", 16 * 1024)
+    avg_size = avg_size or getattr(settings, "DOCUMENT_CHUNK_AVG_SIZE", 64 * 1024)
+    max_size = max_size or getattr(settings, "DOCUMENT_CHUNK_MAX_SIZE", 256 * 1024)
+    # consumed from the front in place, rather than copied for every chunk
+    buffer = bytearray()
+    eof = False
+    while buffer or not eof:
+        while not eof and len(buffer) < max_size:
+            data = stream.read(max_size * 4)
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            break
+        cut = find_cut_point(buffer, 0, len(buffer), min_size, avg_size, max_size)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+def chunk_key(sha256):
+    return f"chunks/{sha256[:2]}/{sha256}"
+
+
+def store_blob_chunks(blob):
+    """
+    write the manifest of a blob, storing only chunks not stored before.
+    Returns the number of new chunk bytes
+    """
+    if BlobChunk.objects.filter(blob=blob).exists():
+        return 0
+    storage = get_storage()
+    manifest = []
+    stored = 0
+    offset = 0
+    with closing(storage.open(blob.key)) as body:
+        for data in iter_content_chunks(body):
+            sha256 = hashlib.sha256(data).hexdigest()
+            chunk = ContentChunk.objects.filter(sha256=sha256).first()
+            if chunk is None:
+                # the object goes first, a row always has its object
+                storage.save(chunk_key(sha256), io.BytesIO(data))
+                stored += len(data)
+                chunk, _ = ContentChunk.objects.get_or_create(
+                    sha256=sha256, defaults={"size": len(data)}
+                )
+            manifest.append(
+                BlobChunk(
+                    blob=blob, position=len(manifest), offset=offset, chunk=chunk
+                )
+            )
+            offset += len(data)
+
+    with transaction.atomic():
+        BlobChunk.objects.bulk_create(manifest)
+        refs = Counter(entry.chunk_id for entry in manifest)
+        for chunk_id, count in refs.items():
+            ContentChunk.objects.filter(pk=chunk_id).update(
+                ref_count=F("ref_count") + count, updated_at=timezone.now()
+            )
+    return stored
+
+
+def release_blob_chunks(blob):
+    """drop the manifest of a blob, unreferenced chunks are collected later"""
+    with transaction.atomic():
+        refs = Counter(
+            BlobChunk.objects.filter(blob=blob).values_list("chunk_id", flat=True)
+        )
+        for chunk_id, count in refs.items():
+            ContentChunk.objects.filter(pk=chunk_id).update(
+                ref_count=F("ref_count") - count, updated_at=timezone.now()
+            )
+        BlobChunk.objects.filter(blob=blob).delete()
+
+
+class ChunkReader:
+    """readable stream over the chunks of a blob, in manifest order"""
+
+    def __init__(self, blob, storage=None):
+        self.storage = storage or get_storage()
+        self.keys = iter(
+            chunk_key(sha256)
+            for sha256 in BlobChunk.objects.filter(blob=blob)
+            .order_by("position")
+            .values_list("chunk__sha256", flat=True)
+        )
+        self.current = None
+
+    def read(self, size=-1):
+        parts = []
+        while size < 0 or size > 0:
+            if self.current is None:
+                key = next(self.keys, None)
+                if key is None:
+                    break
+                self.current = self.storage.open(key)
+            data = self.current.read(size)
+            if not data:
+                self.current.close()
+                self.current = None
+                continue
+            parts.append(data)
+            if size > 0:
+                size -= len(data)
+        return b"".join(parts)
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+
+def open_blob(blob):
+    """readable stream of a blob's content, wherever it is stored"""
+    if blob.chunked:
+        return ChunkReader(blob)
+    return get_storage().open(blob.key)
+
+
+def restore_blob(blob):
+    """
+    store the whole object of a chunked blob again, e.g. to presign it. A
+    blob that is still superseded keeps its manifest, the next chunking run
+    drops the object again without hashing it a second time. Otherwise its
+    chunks are released
+    """
+    with closing(ChunkReader(blob)) as reader:
+        get_storage().save(blob.key, reader)
+    with transaction.atomic():
+        Blob.objects.filter(pk=blob.pk).update(chunked=False)
+        if not superseded_blobs().filter(pk=blob.pk).exists():
+            release_blob_chunks(blob)
+    blob.chunked = False
+
+
+def request_restore(blob):
+    """
+    queue restore_blob for a chunked blob, once per DOCUMENT_RESTORE_LOCK_TTL
+    however many downloads ask for it. Reassembly never runs in a request
+    """
+    from .tasks import restore_chunked_blob
+
+    ttl = getattr(settings, "DOCUMENT_RESTORE_LOCK_TTL", 300)
+    if caches["default"].add(f"restore:{blob.pk}", 1, timeout=ttl):
+        restore_chunked_blob.delay(blob.pk)
+
+
+def superseded_blobs():
+    """clean blobs that no document has as its latest version"""
+    latest = DocumentVersion.objects.filter(
+        pk__in=Document.objects.filter(latest_version__isnull=False).values(
+            "latest_version_id"
+        ),
+        blob__isnull=False,
+    ).values("blob_id")
+    return (
+        Blob.objects.filter(chunked=False, scan_status="CLEAN", ref_count__gt=0)
+        .exclude(pk__in=latest)
+        .order_by("pk")
+    )
+
+
+def chunk_blob(blob):
+    """
+    replace the whole object of a blob with its chunks. Returns the bytes
+    saved in storage, chunks shared with other revisions are stored once
+    """
+    stored = store_blob_chunks(blob)
+    with transaction.atomic():
+        # a version may have become latest again meanwhile
+        if not superseded_blobs().filter(pk=blob.pk).exists():
+            release_blob_chunks(blob)
+            return 0
+        Blob.objects.filter(pk=blob.pk).update(chunked=True)
+    get_storage().delete(blob.key)
+    blob.chunked = True
+    return (blob.size or 0) - stored
+
+
+def collect_unreferenced_chunks(grace_period):
+    """delete chunks no manifest references, returns how many were removed"""
+    cutoff = timezone.now() - grace_period
+    storage = get_storage()
+    removed = 0
+    candidates = ContentChunk.objects.filter(ref_count__lte=0, updated_at__lt=cutoff)
+    for chunk_id in candidates.values_list("id", flat=True).iterator():
+        with transaction.atomic():
+            chunk = (
+                ContentChunk.objects.select_for_update()
+                .filter(pk=chunk_id, ref_count__lte=0)
+                .first()
+            )
+            if chunk is None or BlobChunk.objects.filter(chunk=chunk).exists():
+                continue
+            storage.delete(chunk_key(chunk.sha256))
+            chunk.delete()
+            removed += 1
+    return removed
@@ -0,0 +1,173 @@
+import difflib
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import DocumentPage
+
+
+# versions whose text is extracted (and so can be compared)
+EXTRACTED_STAGES = ("INDEX", "DONE")
+
+WORD_RE = re.compile(r"\s+|\w+|[^\w\s]")
+
+
+class DiffError(Exception):
+    pass
+
+
+def version_lines(version):
+    """extracted text of a version as lines, from the page table"""
+    lines = []
+    pages = DocumentPage.objects.filter(version=version).order_by("page_number")
+    for text in pages.values_list("text", flat=True).iterator(chunk_size=200):
+        lines.extend(text.splitlines())
+    return lines
+
+
+def _opcodes(a, b):
+    """
+    difflib opcodes of two lists. The common head and tail are cut off
+    first, so a small revision of a large document leaves little to match
+    """
+    start = 0
+    end_a, end_b = len(a), len(b)
+    while start < end_a and start < end_b and a[start] == b[start]:
+        start += 1
+    while end_a > start and end_b > start and a[end_a - 1] == b[end_b - 1]:
+        end_a -= 1
+        end_b -= 1
+
+    opcodes = []
+    if start:
+        opcodes.append(("equal", 0, start, 0, start))
+    matcher = difflib.SequenceMatcher(
+        None, a[start:end_a], b[start:end_b], autojunk=False
+    )
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        opcodes.append((tag, i1 + start, i2 + start, j1 + start, j2 + start))
+    if end_a < len(a):
+        opcodes.append(("equal", end_a, len(a), end_b, len(b)))
+    return opcodes
+
+
+def diff_words(old, new):
+    """[(op, text)] for two strings, op is "=", "-" or "+" """
+    a, b = WORD_RE.findall(old), WORD_RE.findall(new)
+    segments = []
+    for tag, i1, i2, j1, j2 in _opcodes(a, b):
+        if tag == "equal":
+            segments.append(("=", "".join(a[i1:i2])))
+            continue
+        if i2 > i1:
+            segments.append(("-", "".join(a[i1:i2])))
+        if j2 > j1:
+            segments.append(("+", "".join(b[j1:j2])))
+    return segments
+
+
+def diff_lines(old, new, context=3, words=False):
+    """
+    hunks of a line diff, like a unified diff. With `words`, replaced line
+    ranges also carry a word level diff of the range
+    """
+    hunks = []
+    added = removed = 0
+    for group in _group_opcodes(_opcodes(old, new), context):
+        hunk = {
+            "old_start": group[0][1] + 1,
+            "old_lines": group[-1][2] - group[0][1],
+            "new_start": group[0][3] + 1,
+            "new_lines": group[-1][4] - group[0][3],
+            "lines": [],
+        }
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                hunk["lines"].extend([" ", line] for line in old[i1:i2])
+                continue
+            hunk["lines"].extend(["-", line] for line in old[i1:i2])
+            hunk["lines"].extend(["+", line] for line in new[j1:j2])
+            removed += i2 - i1
+            added += j2 - j1
+            if words and tag == "replace":
+                hunk.setdefault("words", []).append(
+                    {
+                        "old_start": i1 + 1,
+                        "new_start": j1 + 1,
+                        "segments": diff_words(
+                            "\n".join(old[i1:i2]), "\n".join(new[j1:j2])
+                        ),
+                    }
+                )
+        hunks.append(hunk)
+    return {"added": added, "removed": removed, "hunks": hunks}
+
+
+def _group_opcodes(opcodes, context):
+    # difflib.SequenceMatcher.get_grouped_opcodes for precomputed opcodes
+    matcher = difflib.SequenceMatcher(None, "", "")
+    matcher.opcodes = opcodes
+    if not opcodes:
+        return []
+    return list(matcher.get_grouped_opcodes(context))
+
+
+def content_id(version):
+    """what cached diffs are keyed by, the content hash when there is a blob"""
+    return version.blob.sha256 if version.blob_id else f"v{version.pk}"
+
+
+def get_diff_cache():
+    return caches[getattr(settings, "DOCUMENT_CACHE_ALIAS", "default")]
+
+
+def text_generation(cache, content):
+    """
+    generation of the extracted text of a content, part of the diff keys so
+    re-extracting it orphans every diff it is in
+    """
+    key = f"diff:gen:{content}"
+    generation = cache.get(key)
+    if generation is None:
+        generation = time.time_ns()
+        cache.add(key, generation, None)
+        generation = cache.get(key) or generation
+    return generation
+
+
+def forget_diffs(version):
+    """orphan the cached diffs of the version's content, its text changed"""
+    get_diff_cache().delete(f"diff:gen:{content_id(version)}")
+
+
+def diff_versions(old, new, granularity="line", context=3):
+    """
+    diff of the extracted text of two versions. Results are cached by the
+    content hashes of both versions, so they are computed once per pair of
+    contents whichever versions or documents carry them, until the text of
+    either is extracted again
+    """
+    for version in (old, new):
+        if version.stage not in EXTRACTED_STAGES:
+            raise DiffError(
+                f"Version {version.version_number} is not extracted yet"
+            )
+    words = granularity == "word"
+    cache = get_diff_cache()
+    old_hash, new_hash = content_id(old), content_id(new)
+    generations = (
+        f"{text_generation(cache, old_hash)}:{text_generation(cache, new_hash)}"
+    )
+    key = f"diff:{old_hash}:{new_hash}:{generations}:{granularity}:{context}"
+    result = cache.get(key)
+    if result is None:
+        if old_hash == new_hash:
+            result = {"added": 0, "removed": 0, "hunks": []}
+        else:
+            result = diff_lines(
+                version_lines(old), version_lines(new), context=context, words=words
+            )
+        cache.set(key, result, getattr(settings, "DOCUMENT_DIFF_CACHE_TTL", 86400))
+    return result
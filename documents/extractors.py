@@ -0,0 +1,139 @@
+import io
+from collections import deque, namedtuple
+
+from django.conf import settings
+
+from .metrics import PAGES_OCR, PAGES_SKIPPED, timed
+from .ocr import PageOCREngine, classify_page, is_blank_image
+
+
+# a piece of extracted text, a pdf page or a run of docx paragraphs / text lines
+Chunk = namedtuple("Chunk", ["page_number", "text", "source"])
+
+
+def get_chunk_size():
+    return getattr(settings, "DOCUMENT_TEXT_CHUNK_SIZE", 4000)
+
+
+def extract_chunks(version, stream, name):
+    """
+    pick an extractor for the file and yield its text chunks in order.
+    `stream` is a seekable binary file object, `name` the uploaded file name
+    """
+    stream.seek(0)
+    head = stream.read(8192)
+    stream.seek(0)
+    name = name.lower()
+    if name.endswith(".pdf") or head.startswith(b"%PDF-"):
+        return iter_pdf_chunks(version, stream)
+    if name.endswith(".docx"):
+        return iter_docx_chunks(stream)
+    return iter_plain_or_image_chunks(stream, head)
+
+
+def iter_pdf_chunks(version, stream):
+    """
+    yield one chunk per page, in order. Every page is classified on its own:
+    pages with a usable text layer are taken as they are, scanned pages are
+    OCR'd at a resolution matching their images and blank pages are skipped.
+    OCR starts as soon as a page is classified, and a page is yielded once
+    the pages before it are; classifying runs at most 2 * the OCR
+    concurrency pages ahead of the oldest page not yielded yet
+    """
+    import pdfplumber
+
+    with pdfplumber.open(stream) as pdf, PageOCREngine(version, pdf) as ocr:
+        look_ahead = 2 * ocr.concurrency
+        pending = deque()  # (page_number, text), text None for pages to OCR
+
+        def take():
+            page_number, page_text = pending.popleft()
+            if page_text is None:
+                return Chunk(page_number, ocr.result(page_number), "OCR")
+            return Chunk(page_number, page_text, "TEXT")
+
+        for page_number, page in enumerate(pdf.pages, start=1):
+            with timed("pdfplumber"):
+                page_text = page.extract_text() or ""
+            plan = classify_page(page, page_text)
+            # release the parsed page objects, they are not needed anymore
+            page.flush_cache()
+            if plan.action == "OCR":
+                ocr.submit(page_number, plan.dpi)
+                pending.append((page_number, None))
+            elif plan.action == "TEXT":
+                PAGES_SKIPPED.labels("text_layer").inc()
+                pending.append((page_number, page_text))
+            else:
+                PAGES_SKIPPED.labels("blank").inc()
+                pending.append((page_number, ""))
+            while pending and (
+                len(pending) > look_ahead
+                or pending[0][1] is not None
+                or ocr.done(pending[0][0])
+            ):
+                yield take()
+        while pending:
+            yield take()
+
+
+def iter_docx_chunks(stream):
+    """yield docx paragraphs grouped into chunks of roughly `chunk_size` chars"""
+    import docx
+
+    with timed("docx"):
+        doc = docx.Document(stream)
+    yield from _group_lines((p.text for p in doc.paragraphs), get_chunk_size())
+
+
+def iter_plain_or_image_chunks(stream, head):
+    """stream a utf-8 text file, or OCR the file if it is an image"""
+    try:
+        # only the first block is checked, a multi-byte char may be cut off
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        if e.start < len(head) - 4:
+            yield from iter_image_chunks(stream)
+            return
+
+    text = io.TextIOWrapper(stream, encoding="utf-8", errors="replace")
+    try:
+        lines = (line.rstrip("\n") for line in text)
+        yield from _group_lines(lines, get_chunk_size())
+    finally:
+        # hand the stream back to the caller instead of closing it
+        text.detach()
+
+
+def iter_image_chunks(stream):
+    import pytesseract
+    from PIL import Image
+
+    try:
+        with Image.open(stream) as im:
+            if is_blank_image(im):
+                PAGES_SKIPPED.labels("blank_render").inc()
+                text = ""
+            else:
+                with timed("tesseract"):
+                    text = pytesseract.image_to_string(im)
+                PAGES_OCR.inc()
+    except Exception:
+        text = ""
+    yield Chunk(1, text, "OCR")
+
+
+def _group_lines(lines, chunk_size):
+    buffer = []
+    size = 0
+    page_number = 1
+    for line in lines:
+        buffer.append(line)
+        size += len(line) + 1
+        if size >= chunk_size:
+            yield Chunk(page_number, "\n".join(buffer), "TEXT")
+            page_number += 1
+            buffer = []
+            size = 0
+    if buffer:
+        yield Chunk(page_number, "\n".join(buffer), "TEXT")
@@ -0,0 +1,171 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from kombu.exceptions import ChannelError
+
+from documents.models import BackfillCursor, DocumentVersion
+from documents.scheduling import queue_bulk, stage_queue
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-run processing (or only search indexing) for existing document "
+        "versions. Ids are read in keyset pages, versions to process wait for "
+        "admission like bulk uploads and reindexing sends one task per version "
+        "to the bulk index queue. The position is saved after every batch so "
+        "an interrupted run resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--task",
+            choices=["process", "index"],
+            default="process",
+            help="process: full pipeline, index: search indexing only",
+        )
+        parser.add_argument("--name", help="cursor name, defaults to the task")
+        parser.add_argument(
+            "--reset", action="store_true", help="start again from the first id"
+        )
+        parser.add_argument("--unindexed", action="store_true")
+        parser.add_argument("--content-type")
+        parser.add_argument("--since", help="created at or after (date/datetime)")
+        parser.add_argument("--until", help="created before (date/datetime)")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--queue", help="index queue, defaults to the bulk index queue"
+        )
+        parser.add_argument(
+            "--max-queue-depth",
+            type=int,
+            default=5000,
+            help=(
+                "pause while more versions than this wait for admission (or "
+                "messages in the index queue), 0 disables"
+            ),
+        )
+        parser.add_argument("--limit", type=int, help="stop after N versions")
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        from documents import tasks
+
+        task = (
+            tasks.process_document_version
+            if options["task"] == "process"
+            else tasks.index_version
+        )
+        name = options["name"] or options["task"]
+        queue = options["queue"] or stage_queue(task, "BULK")
+        cursor, _ = BackfillCursor.objects.get_or_create(name=name)
+        if options["reset"]:
+            cursor.last_id = 0
+            cursor.enqueued = 0
+            cursor.save()
+
+        versions = self.get_queryset(options)
+        remaining = versions.filter(pk__gt=cursor.last_id).count()
+        if options["limit"]:
+            remaining = min(remaining, options["limit"])
+        self.stdout.write(
+            f"{remaining} versions to enqueue for '{name}', "
+            f"resuming after id {cursor.last_id}"
+        )
+
+        started = time.monotonic()
+        last_id = cursor.last_id
+        enqueued = 0
+        while enqueued < remaining:
+            batch_size = min(options["batch_size"], remaining - enqueued)
+            ids = list(
+                versions.filter(pk__gt=last_id)
+                .order_by("pk")
+                .values_list("pk", flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+            enqueued += len(ids)
+
+            if not options["dry_run"]:
+                if options["task"] == "process":
+                    if options["max_queue_depth"]:
+                        self.wait_for_admission(options["max_queue_depth"])
+                    # admitted fairly with bulk uploads, on the bulk queues
+                    queue_bulk(ids)
+                else:
+                    if options["max_queue_depth"]:
+                        self.wait_for_queue(queue, options["max_queue_depth"])
+                    # a message per version, each retried on its own
+                    for pk in ids:
+                        task.apply_async((pk,), queue=queue)
+                # saved only once the batch is enqueued, a crash in between
+                # enqueues the batch twice rather than skipping it
+                cursor.last_id = last_id
+                cursor.enqueued += len(ids)
+                cursor.save(update_fields=["last_id", "enqueued", "updated_at"])
+
+            elapsed = time.monotonic() - started
+            rate = enqueued / elapsed if elapsed else 0
+            eta = (remaining - enqueued) / rate if rate else 0
+            self.stdout.write(
+                f"{enqueued}/{remaining} enqueued (last id {last_id}), "
+                f"{rate:.0f} versions/s, eta {eta:.0f}s"
+            )
+
+        self.stdout.write(self.style.SUCCESS(f"Done, {enqueued} versions enqueued"))
+
+    def get_queryset(self, options):
+        versions = DocumentVersion.objects.all()
+        if options["unindexed"]:
+            versions = versions.filter(indexed=False)
+        if options["content_type"]:
+            versions = versions.filter(content_type=options["content_type"])
+        if options["since"]:
+            versions = versions.filter(created_at__gte=self.parse(options["since"]))
+        if options["until"]:
+            versions = versions.filter(created_at__lt=self.parse(options["until"]))
+        return versions
+
+    def parse(self, value):
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            if day is None:
+                raise CommandError(f"Invalid date: {value}")
+            parsed = datetime.combine(day, datetime.min.time())
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+
+    def wait_for_admission(self, max_depth):
+        """block while more than max_depth versions wait for admission"""
+        while True:
+            depth = DocumentVersion.objects.filter(stage="QUEUED").count()
+            if depth <= max_depth:
+                return
+            self.stdout.write(f"{depth} versions wait for admission, waiting")
+            time.sleep(5)
+
+    def wait_for_queue(self, queue, max_depth):
+        """block while the broker queue is deeper than max_depth"""
+        from doc_vault.celery import app
+
+        while True:
+            try:
+                with app.connection_for_read() as conn:
+                    depth = conn.default_channel.queue_declare(
+                        queue=queue, passive=True
+                    ).message_count
+            except ChannelError:
+                # the queue does not exist until something is published to it
+                return
+            except Exception as e:
+                raise CommandError(f"Could not read depth of queue {queue}: {e}")
+            if depth <= max_depth:
+                return
+            self.stdout.write(f"Queue {queue} holds {depth} messages, waiting")
+            time.sleep(5)
@@ -0,0 +1,352 @@
+"""
+prometheus metrics of the web and celery processes.
+
+With several processes per host (gunicorn workers, celery prefork children)
+set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by them before
+they start: every process writes its samples there and /metrics (or the
+worker's METRICS_WORKER_PORT) aggregates them.
+"""
+
+import ipaddress
+import logging
+import os
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import sync_and_async_middleware
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+
+logger = logging.getLogger(__name__)
+
+# tasks and pipeline steps run from milliseconds to minutes (OCR)
+TASK_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+REQUEST_DURATION = Histogram(
+    "docvault_http_request_duration_seconds",
+    "time to respond, per view / action",
+    ["view", "method", "status"],
+)
+TASK_DURATION = Histogram(
+    "docvault_task_duration_seconds",
+    "celery task run time, per task and final state",
+    ["task", "state"],
+    buckets=TASK_BUCKETS,
+)
+STEP_DURATION = Histogram(
+    "docvault_pipeline_step_duration_seconds",
+    "time spent in a step of a pipeline stage: download, hash, clamd, "
+    "pdfplumber, docx, pdf_render, tesseract",
+    ["step"],
+    buckets=TASK_BUCKETS,
+)
+TASKS_IN_FLIGHT = Gauge(
+    "docvault_tasks_in_flight",
+    "celery tasks running",
+    ["task"],
+    multiprocess_mode="livesum",
+)
+TASK_RETRIES = Counter("docvault_task_retries", "task retries", ["task"])
+TASK_FAILURES = Counter(
+    "docvault_task_failures", "tasks that failed for good", ["task"]
+)
+BYTES_PROCESSED = Counter(
+    "docvault_bytes_processed", "bytes read from storage, per stage", ["stage"]
+)
+PAGES_OCR = Counter("docvault_pages_ocr", "pages / images run through tesseract")
+PAGES_SKIPPED = Counter(
+    "docvault_pages_ocr_skipped",
+    "pages not run through tesseract: text_layer, blank (from the pdf "
+    "objects) or blank_render (no ink once rendered)",
+    ["reason"],
+)
+VIRUS_DETECTED = Counter(
+    "docvault_virus_detected", "versions quarantined by a virus scan"
+)
+SUBMISSIONS = Counter(
+    "docvault_uploads_submitted",
+    "uploads handed to the pipeline, per priority class",
+    ["priority"],
+)
+PIPELINE_LATENCY = Histogram(
+    "docvault_pipeline_latency_seconds",
+    "time from upload completion to done / quarantined, per priority class",
+    ["priority"],
+    buckets=TASK_BUCKETS + (1800, 3600, 4 * 3600, 12 * 3600),
+)
+CACHE_EVENTS = Counter(
+    "docvault_document_cache_events",
+    "document cache lookups, e.g. payload_hits or permission_misses",
+    ["event"],
+)
+
+
+def multiprocess_enabled():
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+def timed(step):
+    """context manager observing the duration of a pipeline step"""
+    return STEP_DURATION.labels(step).time()
+
+
+def observe_step(step, seconds):
+    STEP_DURATION.labels(step).observe(seconds)
+
+
+# request metrics
+
+
+def observe_request(request, response, start):
+    match = request.resolver_match
+    view = match.view_name if match else "unmatched"
+    REQUEST_DURATION.labels(view, request.method, response.status_code).observe(
+        time.perf_counter() - start
+    )
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """time every request, labelled with the url name it resolved to"""
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            start = time.perf_counter()
+            response = await get_response(request)
+            observe_request(request, response, start)
+            return response
+
+    else:
+
+        def middleware(request):
+            start = time.perf_counter()
+            response = get_response(request)
+            observe_request(request, response, start)
+            return response
+
+    return middleware
+
+
+# celery task metrics, connected to the signals in tasks.py
+
+_task_started = {}
+
+
+def _task_name(task):
+    return task.name.rsplit(".", 1)[-1] if task is not None else "unknown"
+
+
+def task_started(task_id=None, task=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+    TASKS_IN_FLIGHT.labels(_task_name(task)).inc()
+
+
+def task_finished(task_id=None, task=None, state=None, **kwargs):
+    name = _task_name(task)
+    TASKS_IN_FLIGHT.labels(name).dec()
+    start = _task_started.pop(task_id, None)
+    if start is not None:
+        TASK_DURATION.labels(name, state or "UNKNOWN").observe(
+            time.perf_counter() - start
+        )
+
+
+def task_retried(sender=None, **kwargs):
+    TASK_RETRIES.labels(_task_name(sender)).inc()
+
+
+def task_failed(sender=None, **kwargs):
+    TASK_FAILURES.labels(_task_name(sender)).inc()
+
+
+def mark_process_dead(pid=None, **kwargs):
+    """drop the live gauges of an exited process from the multiprocess dir"""
+    if multiprocess_enabled():
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+def start_worker_server(**kwargs):
+    """serve the metrics of a celery worker and its children on METRICS_WORKER_PORT"""
+    port = getattr(settings, "METRICS_WORKER_PORT", 0)
+    if not port:
+        return
+    from prometheus_client import start_http_server
+
+    start_http_server(port, registry=get_registry())
+    logger.info(f"Serving worker metrics on port {port}")
+
+
+# queue depth, read from the broker when scraped
+
+
+class QueueDepthCollector:
+    """
+    messages waiting in each celery queue. Read from the broker at scrape
+    time and reused for METRICS_QUEUE_DEPTH_TTL seconds, so frequent or
+    parallel scrapes do not each open a broker connection
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fetched_at = None
+        self.depths = []
+
+    def collect(self):
+        gauge = GaugeMetricFamily(
+            "docvault_queue_depth", "messages waiting in a celery queue", labels=["queue"]
+        )
+        for queue, depth in self.get_depths():
+            gauge.add_metric([queue], depth)
+        yield gauge
+
+    def get_depths(self):
+        ttl = getattr(settings, "METRICS_QUEUE_DEPTH_TTL", 15)
+        with self.lock:
+            now = time.monotonic()
+            if self.fetched_at is None or now - self.fetched_at >= ttl:
+                self.fetched_at = now
+                self.depths = self.read_depths()
+            return self.depths
+
+    def read_depths(self):
+        from doc_vault.celery import app
+
+        from .scheduling import BULK_QUEUE_SUFFIX
+
+        queues = {route["queue"] for route in app.conf.task_routes.values()}
+        # bulk versions run on a twin of every stage queue
+        queues |= {queue + BULK_QUEUE_SUFFIX for queue in queues}
+        queues.add(app.conf.task_default_queue)
+        depths = []
+        try:
+            with app.connection_for_read(connect_timeout=2) as conn:
+                for queue in sorted(queues):
+                    # a failed passive declare closes the channel, one each
+                    with conn.channel() as channel:
+                        try:
+                            depth = channel.queue_declare(queue, passive=True)[1]
+                        except conn.channel_errors:
+                            depth = 0  # not declared yet
+                    depths.append((queue, depth))
+        except Exception as e:
+            logger.warning(f"Could not read queue depths: {e}")
+            return []
+        return depths
+
+
+class OwnerDepthCollector:
+    """
+    versions waiting for admission or processing per owner, priority class
+    and stage, from the database at scrape time (cached like the queue
+    depths). The METRICS_TOP_OWNERS owners with the most are labelled by
+    id, the others are summed up as "other"
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fetched_at = None
+        self.depths = []
+
+    def collect(self):
+        gauge = GaugeMetricFamily(
+            "docvault_owner_queue_depth",
+            "versions waiting in a pipeline stage, per owner",
+            labels=["owner", "priority", "stage"],
+        )
+        for labels, depth in self.get_depths():
+            gauge.add_metric(labels, depth)
+        yield gauge
+
+    def get_depths(self):
+        ttl = getattr(settings, "METRICS_QUEUE_DEPTH_TTL", 15)
+        with self.lock:
+            now = time.monotonic()
+            if self.fetched_at is None or now - self.fetched_at >= ttl:
+                self.fetched_at = now
+                self.depths = self.read_depths()
+            return self.depths
+
+    def read_depths(self):
+        from django.db.models import Count
+
+        from .models import DocumentVersion
+        from .scheduling import ACTIVE_STAGES
+
+        try:
+            rows = list(
+                DocumentVersion.objects.filter(stage__in=("QUEUED",) + ACTIVE_STAGES)
+                .order_by()
+                .values_list("document__owner_id", "priority", "stage")
+                .annotate(count=Count("id"))
+            )
+        except Exception as e:
+            logger.warning(f"Could not read owner queue depths: {e}")
+            return []
+        totals = {}
+        for owner_id, _, _, count in rows:
+            totals[owner_id] = totals.get(owner_id, 0) + count
+        top = sorted(totals, key=totals.get, reverse=True)
+        top = set(top[: getattr(settings, "METRICS_TOP_OWNERS", 20)])
+        depths = {}
+        for owner_id, priority, stage, count in rows:
+            owner = str(owner_id) if owner_id in top else "other"
+            key = (owner, priority, stage)
+            depths[key] = depths.get(key, 0) + count
+        return sorted(depths.items())
+
+
+_queue_registry = CollectorRegistry(auto_describe=False)
+_queue_registry.register(QueueDepthCollector())
+_queue_registry.register(OwnerDepthCollector())
+
+
+def get_registry():
+    """the metrics of this process, or of all processes in multiprocess mode"""
+    if not multiprocess_enabled():
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def in_allowed_network(address):
+    """whether `address` is in one of METRICS_ALLOWED_NETWORKS"""
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(
+        address in ipaddress.ip_network(network, strict=False)
+        for network in getattr(settings, "METRICS_ALLOWED_NETWORKS", ())
+    )
+
+
+def metrics_view(request):
+    """
+    prometheus scrape endpoint, for clients in METRICS_ALLOWED_NETWORKS or
+    with the METRICS_TOKEN bearer token. Nobody else, by default
+    """
+    if not in_allowed_network(request.META.get("REMOTE_ADDR", "")):
+        token = getattr(settings, "METRICS_TOKEN", "")
+        if not token:
+            return HttpResponse(status=403)
+        if not constant_time_compare(
+            request.headers.get("Authorization", ""), f"Bearer {token}"
+        ):
+            return HttpResponse(status=401)
+    data = generate_latest(get_registry()) + generate_latest(_queue_registry)
+    return HttpResponse(data, content_type=CONTENT_TYPE_LATEST)
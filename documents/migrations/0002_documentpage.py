@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-18 04:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='auditlog',
+            name='action',
+            field=models.CharField(choices=[('UPLOAD', 'Upload'), ('DOWNLOAD', 'Download'), ('DELETE', 'Delete'), ('UPDATE', 'Update'), ('TAG', 'Tag'), ('ADDTAG', 'Tag Added'), ('REMOVETAG', 'Tag Removed'), ('VIRUS_DETECTED', 'Virus Detected'), ('VIRUS_SCAN_PASSED', 'Virus Scan Passed')], max_length=50),
+        ),
+        migrations.CreateModel(
+            name='DocumentPage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page_number', models.PositiveIntegerField()),
+                ('text', models.TextField(blank=True)),
+                ('source', models.CharField(choices=[('TEXT', 'Text layer'), ('OCR', 'OCR')], default='TEXT', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pages', to='documents.documentversion')),
+            ],
+            options={
+                'ordering': ['page_number'],
+                'unique_together': {('version', 'page_number')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS documents_search USING fts5("
+            "body, version_id UNINDEXED, document_id UNINDEXED, "
+            "page_number UNINDEXED, tokenize='porter unicode61')"
+        )
+    elif schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS documents_documentpage_text_fts "
+            "ON documents_documentpage USING gin (to_tsvector('english', text))"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS documents_search")
+    elif schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS documents_documentpage_text_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("documents", "0003_blob"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
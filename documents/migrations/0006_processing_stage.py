@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-18 04:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0005_backfillcursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentversion',
+            name='stage',
+            field=models.CharField(choices=[('PENDING', 'Waiting for upload'), ('FETCH', 'Fetch'), ('SCAN', 'Hash & virus scan'), ('EXTRACT', 'Text extraction'), ('INDEX', 'Search indexing'), ('DONE', 'Done'), ('QUARANTINED', 'Quarantined')], default='PENDING', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='stage_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='stage_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 04:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0006_processing_stage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='scan_signature',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,76 @@
+from django.db import migrations
+from django.db.models import Exists, OuterRef
+
+
+def move_version_text(apps, schema_editor):
+    # versions extracted before pages were stored get their text as page 1,
+    # and are indexed again by index_pending_versions
+    DocumentVersion = apps.get_model("documents", "DocumentVersion")
+    DocumentPage = apps.get_model("documents", "DocumentPage")
+    legacy = (
+        DocumentVersion.objects.exclude(ocr_text="")
+        .exclude(Exists(DocumentPage.objects.filter(version=OuterRef("pk"))))
+        .only("id", "ocr_text")
+    )
+    pending, moved = [], []
+    for version in legacy.iterator(chunk_size=100):
+        moved.append(version.id)
+        pending.append(
+            DocumentPage(
+                version_id=version.id,
+                page_number=1,
+                text=version.ocr_text,
+                source="TEXT",
+            )
+        )
+        if len(pending) >= 100:
+            DocumentPage.objects.bulk_create(pending)
+            pending = []
+    DocumentPage.objects.bulk_create(pending)
+    DocumentVersion.objects.filter(id__in=moved).update(indexed=False)
+
+
+def restore_version_text(apps, schema_editor):
+    DocumentVersion = apps.get_model("documents", "DocumentVersion")
+    DocumentPage = apps.get_model("documents", "DocumentPage")
+    versions = DocumentVersion.objects.filter(
+        Exists(DocumentPage.objects.filter(version=OuterRef("pk")))
+    )
+    for version in versions.only("id").iterator(chunk_size=100):
+        pages = DocumentPage.objects.filter(version=version).order_by("page_number")
+        version.ocr_text = "\n".join(pages.values_list("text", flat=True))
+        version.save(update_fields=["ocr_text"])
+
+
+def compress_page_text(apps, schema_editor):
+    # postgres compresses large values itself (TOAST). lz4 is much faster to
+    # decompress than the default pglz, for values written from now on
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql" or connection.pg_version < 140000:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 'lz4' = ANY(enumvals) FROM pg_settings "
+            "WHERE name = 'default_toast_compression'"
+        )
+        row = cursor.fetchone()
+    if row and row[0]:
+        schema_editor.execute(
+            "ALTER TABLE documents_documentpage ALTER COLUMN text SET COMPRESSION lz4"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("documents", "0011_content_chunks"),
+    ]
+
+    operations = [
+        migrations.RunPython(move_version_text, restore_version_text),
+        migrations.RemoveField(
+            model_name="documentversion",
+            name="ocr_text",
+        ),
+        migrations.RunPython(compress_page_text, migrations.RunPython.noop),
+    ]
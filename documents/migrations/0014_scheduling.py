@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-18 05:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0013_pagepreview'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentversion',
+            name='priority',
+            field=models.CharField(choices=[('INTERACTIVE', 'Interactive'), ('BULK', 'Bulk')], default='INTERACTIVE', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='submitted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='documentversion',
+            name='stage',
+            field=models.CharField(choices=[('PENDING', 'Waiting for upload'), ('QUEUED', 'Waiting for admission'), ('FETCH', 'Fetch'), ('SCAN', 'Hash & virus scan'), ('EXTRACT', 'Text extraction'), ('INDEX', 'Search indexing'), ('DONE', 'Done'), ('QUARANTINED', 'Quarantined')], db_index=True, default='PENDING', max_length=20),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations
+from django.utils import timezone
+
+
+def set_legacy_stages(apps, schema_editor):
+    # versions processed before the pipeline stages were added stayed at the
+    # PENDING default. Only the scan attaches a blob, so those with one went
+    # through processing, and infected content is quarantined
+    DocumentVersion = apps.get_model("documents", "DocumentVersion")
+    legacy = DocumentVersion.objects.filter(stage="PENDING", blob__isnull=False)
+    now = timezone.now()
+    legacy.filter(blob__scan_status="INFECTED").update(
+        stage="QUARANTINED", stage_updated_at=now
+    )
+    legacy.update(stage="DONE", stage_updated_at=now)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("documents", "0014_scheduling"),
+    ]
+
+    operations = [
+        migrations.RunPython(set_legacy_stages, migrations.RunPython.noop),
+    ]
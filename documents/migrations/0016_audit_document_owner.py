@@ -0,0 +1,37 @@
+# Generated by Django 5.2.7 on 2026-10-18 05:53
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def set_document_owners(apps, schema_editor):
+    AuditLog = apps.get_model("documents", "AuditLog")
+    Document = apps.get_model("documents", "Document")
+    AuditLog.objects.filter(document__isnull=False).update(
+        document_owner=Subquery(
+            Document.objects.filter(pk=OuterRef("document_id")).values("owner_id")
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0015_legacy_version_stages'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='auditlog',
+            name='document_owner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['document_owner', '-timestamp'], name='documents_a_documen_c7f6d8_idx'),
+        ),
+        migrations.RunPython(set_document_owners, migrations.RunPython.noop),
+    ]
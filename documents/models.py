@@ -44,8 +44,92 @@ def upload_to_document_version(instance, filename):
     # return f'documents/{instance.document.id}/versions/{filename}'
 
 
+# content addressed stored object, shared by every version with the same bytes
+class Blob(models.Model):
+    SCAN_STATUS_CHOICES = [
+        ("PENDING", "Pending"),
+        ("CLEAN", "Clean"),
+        ("INFECTED", "Infected"),
+        ("ERROR", "Error"),
+    ]
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    # storage key of the object (blobs.blob_key), never handed out for uploads
+    key = models.CharField(max_length=1024)
+    size = models.BigIntegerField(null=True, blank=True)
+    ref_count = models.PositiveIntegerField(default=0)
+    scan_status = models.CharField(
+        max_length=20, choices=SCAN_STATUS_CHOICES, default="PENDING"
+    )
+    scan_result = models.JSONField(null=True, blank=True)
+    # clamd signature database version the verdict was made with, verdicts
+    # are only reused while the signatures are unchanged
+    scan_signature = models.CharField(max_length=100, blank=True)
+    # version whose extracted text is copied to later duplicates
+    text_source = models.ForeignKey(
+        "DocumentVersion",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="+",
+    )
+    # the object was replaced by its content defined chunks (BlobChunk)
+    chunked = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.ref_count} refs)"
+
+
+# content defined chunk of stored objects, shared by every blob containing it
+class ContentChunk(models.Model):
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.PositiveIntegerField()
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.size} bytes)"
+
+
+# manifest entry, blob content = its chunks in position order
+class BlobChunk(models.Model):
+    blob = models.ForeignKey(Blob, on_delete=models.CASCADE, related_name="chunks")
+    position = models.PositiveIntegerField()
+    offset = models.BigIntegerField()
+    chunk = models.ForeignKey(ContentChunk, on_delete=models.PROTECT, related_name="+")
+
+    class Meta:
+        unique_together = ("blob", "position")
+        ordering = ["position"]
+
+    def __str__(self):
+        return f"{self.blob} #{self.position} @{self.offset}"
+
+
 # tracks versions of a document
 class DocumentVersion(models.Model):
+    # processing pipeline, `stage` is the next stage to run
+    STAGE_CHOICES = [
+        ("PENDING", "Waiting for upload"),
+        ("QUEUED", "Waiting for admission"),
+        ("FETCH", "Fetch"),
+        ("SCAN", "Hash & virus scan"),
+        ("EXTRACT", "Text extraction"),
+        ("INDEX", "Search indexing"),
+        ("DONE", "Done"),
+        ("QUARANTINED", "Quarantined"),
+    ]
+    # interactive uploads skip the admission queue and use their own queues
+    PRIORITY_CHOICES = [
+        ("INTERACTIVE", "Interactive"),
+        ("BULK", "Bulk"),
+    ]
+    # the content passed the scan stage, only these versions are served
+    SCANNED_STAGES = ("EXTRACT", "INDEX", "DONE")
+
     document = models.ForeignKey(
         Document, on_delete=models.CASCADE, related_name="versions"
     )
@@ -58,8 +142,25 @@ class DocumentVersion(models.Model):
     file_size = models.BigIntegerField(null=True, blank=True)
     content_type = models.CharField(max_length=200, blank=True)
     file_hash = models.CharField(max_length=128, blank=True)
-    ocr_text = models.TextField(blank=True)
     indexed = models.BooleanField(default=False)
+    blob = models.ForeignKey(
+        Blob,
+        null=True,
+        blank=True,
+        on_delete=models.PROTECT,
+        related_name="versions",
+    )
+    stage = models.CharField(
+        max_length=20, choices=STAGE_CHOICES, default="PENDING", db_index=True
+    )
+    priority = models.CharField(
+        max_length=20, choices=PRIORITY_CHOICES, default="INTERACTIVE"
+    )
+    # when the upload was completed and handed to the scheduler
+    submitted_at = models.DateTimeField(null=True, blank=True)
+    # set when `stage` gave up retrying, cleared when the stage is queued again
+    stage_error = models.TextField(blank=True)
+    stage_updated_at = models.DateTimeField(null=True, blank=True)
 
     class meta:
         # ensure unique version numbers per document/ prevent duplicate
@@ -70,6 +171,82 @@ class DocumentVersion(models.Model):
     def __str__(self):
         return f"{self.document} v{self.version_number}"
 
+    @property
+    def storage_key(self):
+        """key of the stored object, shared with other versions once deduplicated"""
+        if self.blob_id:
+            return self.blob.key
+        return self.file if isinstance(self.file, str) else self.file.name
+
+
+# extracted text of a single page of a document version. OCR results are
+# written page by page so a retried task can resume where it stopped
+class DocumentPage(models.Model):
+    SOURCE_CHOICES = [
+        ("TEXT", "Text layer"),
+        ("OCR", "OCR"),
+    ]
+
+    version = models.ForeignKey(
+        DocumentVersion, on_delete=models.CASCADE, related_name="pages"
+    )
+    page_number = models.PositiveIntegerField()
+    text = models.TextField(blank=True)
+    source = models.CharField(max_length=10, choices=SOURCE_CHOICES, default="TEXT")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("version", "page_number")
+        ordering = ["page_number"]
+
+    def __str__(self):
+        return f"{self.version} p{self.page_number}"
+
+
+# rendered image of a page of a blob, shared by every version of the content.
+# `size` is the bounding box (longest edge, px) the image was rendered to
+class PagePreview(models.Model):
+    blob = models.ForeignKey(Blob, on_delete=models.CASCADE, related_name="previews")
+    page_number = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    key = models.CharField(max_length=1024)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("blob", "page_number", "size")
+
+    def __str__(self):
+        return f"{self.blob} p{self.page_number} {self.size}px"
+
+
+# S3 multipart upload of a version, for large files uploaded in parallel parts
+class MultipartUpload(models.Model):
+    STATUS_CHOICES = [
+        ("PENDING", "Pending"),
+        ("COMPLETED", "Completed"),
+        ("ABORTED", "Aborted"),
+    ]
+
+    version = models.OneToOneField(
+        DocumentVersion, on_delete=models.CASCADE, related_name="multipart_upload"
+    )
+    key = models.CharField(max_length=1024)
+    upload_id = models.CharField(max_length=1024)
+    file_size = models.BigIntegerField()  # declared when the upload started
+    part_size = models.BigIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="PENDING")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key} ({self.status})"
+
+    @property
+    def part_count(self):
+        return max(-(-self.file_size // self.part_size), 1)
+
 
 # Tracks user actions for auditing
 class AuditLog(models.Model):
@@ -93,15 +270,54 @@ class AuditLog(models.Model):
     version = models.ForeignKey(
         DocumentVersion, on_delete=models.SET_NULL, null=True, blank=True
     )
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # owner of the document, kept when the document is deleted so its owner
+    # still sees its history
+    document_owner = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    # set when the event happens, rows are inserted later in batches
+    timestamp = models.DateTimeField(default=timezone.now)
     details = models.TextField(blank=True)
     ip_address = models.GenericIPAddressField(null=True, blank=True)
     extra = models.JSONField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # history of one document / one user, newest first
+            models.Index(fields=["document", "-timestamp"]),
+            models.Index(fields=["user", "-timestamp"]),
+            models.Index(fields=["document_owner", "-timestamp"]),
+            # time range scans, used by the archival job and unfiltered queries
+            models.Index(fields=["-timestamp"]),
+        ]
+
     def __str__(self):
         return f"{self.user} {self.action} {self.document} @ {self.timestamp}"
 
 
+class AuditArchive(models.Model):
+    """a month of audit entries moved out of AuditLog into a compressed file"""
+
+    month = models.DateField()  # first day of the month
+    key = models.CharField(max_length=1024, unique=True)  # storage key
+    row_count = models.BigIntegerField()
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    size = models.BigIntegerField()  # compressed bytes
+    sha256 = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-month", "-last_id"]
+
+    def __str__(self):
+        return f"{self.month:%Y-%m} ({self.row_count} entries)"
+
+
 # Manages sharing documents with different users and permissions
 class SharedDocument(models.Model):
     PERMISSION_CHOICES = [
@@ -123,3 +339,15 @@ class SharedDocument(models.Model):
     class Meta:
         # Prevents sharing the same document with the same user twice.
         unique_together = ("document", "user")
+
+
+# resumable position of a bulk reprocess / reindex run (manage.py reprocess_versions)
+class BackfillCursor(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    enqueued = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.last_id}"
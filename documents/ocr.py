@@ -0,0 +1,203 @@
+import logging
+import math
+import re
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from .metrics import PAGES_OCR, PAGES_SKIPPED, timed
+from .models import DocumentPage
+
+
+logger = logging.getLogger(__name__)
+
+def get_ocr_dpi():
+    return getattr(settings, "DOCUMENT_OCR_DPI", 300)
+
+
+def get_ocr_concurrency():
+    return getattr(settings, "DOCUMENT_OCR_CONCURRENCY", 2)
+
+
+# how the text of a pdf page is obtained: "TEXT" (its text layer), "OCR" at
+# `dpi`, or "BLANK" (nothing to read)
+PagePlan = namedtuple("PagePlan", ["action", "dpi"])
+
+# glyphs pdfplumber could not map to unicode, not usable text
+CID_RE = re.compile(r"\(cid:\d+\)")
+
+
+def classify_page(page, text):
+    """
+    plan for a parsed pdfplumber page and its extracted `text`, from the
+    page objects only (nothing is rendered). A page is taken from its text
+    layer when it has enough text for its images, e.g. a scanned page with
+    only a stamp or a stray character is still OCR'd
+    """
+    letters = len(CID_RE.sub("", text)) - sum(c.isspace() for c in text)
+    area = page.width * page.height  # points
+    images = [image for image in page.images if image["x1"] > image["x0"]]
+    image_area = sum(
+        (min(image["x1"], page.width) - max(image["x0"], 0))
+        * (min(image["bottom"], page.height) - max(image["top"], 0))
+        for image in images
+    )
+    coverage = min(max(image_area / area, 0), 1) if area else 0
+    density = letters / (area / 72**2) if area else 0  # per square inch
+
+    if letters >= getattr(settings, "DOCUMENT_OCR_MIN_TEXT_CHARS", 20) and (
+        coverage < 0.5
+        or density >= getattr(settings, "DOCUMENT_OCR_MIN_TEXT_DENSITY", 2)
+    ):
+        return PagePlan("TEXT", None)
+    if coverage >= getattr(settings, "DOCUMENT_OCR_MIN_IMAGE_COVERAGE", 0.1):
+        return PagePlan("OCR", render_dpi(page, images))
+    # text drawn as outlines has no chars and no images, only curves
+    vectors = len(page.curves) + len(page.rects) + len(page.lines)
+    if vectors >= getattr(settings, "DOCUMENT_OCR_MIN_VECTOR_OBJECTS", 200):
+        return PagePlan("OCR", render_dpi(page, []))
+    return PagePlan("BLANK", None)
+
+
+def render_dpi(page, images):
+    """
+    resolution to render a page at for OCR: that of its sharpest image
+    (rendering above it adds pixels, not detail) between DOCUMENT_OCR_MIN_DPI
+    and DOCUMENT_OCR_DPI, lowered for large pages to DOCUMENT_OCR_MAX_PIXELS
+    """
+    max_dpi = get_ocr_dpi()
+    dpi = max_dpi
+    native = [
+        image["srcsize"][0] / ((image["x1"] - image["x0"]) / 72)
+        for image in images
+        if image.get("srcsize") and image["srcsize"][0]
+    ]
+    if native:
+        min_dpi = getattr(settings, "DOCUMENT_OCR_MIN_DPI", 200)
+        dpi = min(max_dpi, max(min_dpi, max(native)))
+    max_pixels = getattr(settings, "DOCUMENT_OCR_MAX_PIXELS", 16_000_000)
+    pixels = (page.width / 72 * dpi) * (page.height / 72 * dpi)
+    if pixels > max_pixels:
+        dpi *= math.sqrt(max_pixels / pixels)
+    return max(int(dpi), 72)
+
+
+def is_blank_image(image):
+    """
+    whether a rendered page has (almost) no ink, below
+    DOCUMENT_OCR_BLANK_INK_RATIO of dark pixels. Much cheaper than tesseract
+    """
+    histogram = image.convert("L").histogram()
+    dark = sum(histogram[:128])
+    ratio = getattr(settings, "DOCUMENT_OCR_BLANK_INK_RATIO", 0.0002)
+    return dark <= ratio * image.width * image.height
+
+
+class PageOCREngine:
+    """
+    OCR pages of a pdf in parallel, as they are submitted.
+
+    Pages are rendered one at a time in the calling thread (pdfium is not
+    thread safe) and handed to a thread pool. tesseract runs as a separate
+    process per call, so the pool keeps up to `concurrency` tesseract
+    processes busy on their own cores. Threads are used instead of a process
+    pool because celery prefork children are daemonic and cannot fork.
+
+    Every finished page is checkpointed as a DocumentPage row, a retried task
+    only OCRs the pages that are still missing. fetch_version drops the
+    checkpoints when a version is processed again from the start.
+
+        with PageOCREngine(version, pdf) as ocr:
+            ocr.submit(3, dpi=200)
+            text = ocr.result(3)
+    """
+
+    def __init__(self, version, pdf, dpi=None, concurrency=None, lang=None):
+        self.version = version
+        self.pdf = pdf
+        self.dpi = dpi or get_ocr_dpi()
+        self.concurrency = max(1, concurrency or get_ocr_concurrency())
+        self.lang = lang or getattr(settings, "DOCUMENT_OCR_LANG", None)
+        self.pool = None
+        self.checkpointed = None
+        self.futures = {}  # page number -> future, not collected yet
+        self.ready = {}  # page number -> text, checkpointed but not taken yet
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pool is not None:
+            # pages not started are dropped, running tesseracts are waited for
+            self.pool.shutdown(cancel_futures=True)
+
+    def submit(self, page_number, dpi=None):
+        """render a (1-based) page and queue it, unless it is checkpointed"""
+        if self.checkpointed is None:
+            self.checkpointed = set(
+                DocumentPage.objects.filter(
+                    version=self.version, source="OCR"
+                ).values_list("page_number", flat=True)
+            )
+            if self.checkpointed:
+                logger.info(
+                    f"Resuming OCR for version {self.version.pk}: "
+                    f"{len(self.checkpointed)} pages checkpointed"
+                )
+        if page_number in self.checkpointed:
+            return
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        page = self.pdf.pages[page_number - 1]
+        with timed("pdf_render"):
+            image = page.to_image(resolution=dpi or self.dpi).original
+        self.futures[page_number] = self.pool.submit(self._ocr_image, image)
+
+    def done(self, page_number):
+        """whether result() returns without waiting for tesseract"""
+        future = self.futures.get(page_number)
+        return future is None or future.done()
+
+    def result(self, page_number):
+        """text of a submitted page, waits for it if needed"""
+        if page_number in self.futures:
+            wait([self.futures[page_number]])
+            self._collect()
+        if page_number in self.ready:
+            return self.ready.pop(page_number)
+        return self._load(page_number)
+
+    def _ocr_image(self, image):
+        import pytesseract
+
+        if is_blank_image(image):
+            PAGES_SKIPPED.labels("blank_render").inc()
+            return ""
+        with timed("tesseract"):
+            if self.lang:
+                text = pytesseract.image_to_string(image, lang=self.lang)
+            else:
+                text = pytesseract.image_to_string(image)
+        PAGES_OCR.inc()
+        return text
+
+    def _load(self, page_number):
+        return DocumentPage.objects.get(
+            version=self.version, page_number=page_number
+        ).text
+
+    def _collect(self):
+        # checkpoint every finished page from the calling thread, db
+        # connections are per thread
+        for page_number, future in list(self.futures.items()):
+            if not future.done():
+                continue
+            del self.futures[page_number]
+            text = future.result()
+            DocumentPage.objects.update_or_create(
+                version=self.version,
+                page_number=page_number,
+                defaults={"text": text, "source": "OCR"},
+            )
+            self.ready[page_number] = text
@@ -0,0 +1,19 @@
+from rest_framework.pagination import CursorPagination
+
+
+class DocumentCursorPagination(CursorPagination):
+    """keyset pagination on id, stable while documents are being added"""
+
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+    ordering = "-id"
+
+
+class AuditLogCursorPagination(CursorPagination):
+    """keyset pagination on timestamp, matches the (…, -timestamp) indexes"""
+
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+    ordering = "-timestamp"
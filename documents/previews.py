@@ -0,0 +1,291 @@
+"""
+page previews of pdfs and images.
+
+While a version is extracted its first page is rendered at every
+DOCUMENT_PREVIEW_SIZES size and the following pages up to
+DOCUMENT_PREVIEW_PAGES at the smallest one. They are stored next to the blob
+(shared by duplicates) and served by presigned url. Other pages and sizes
+are rendered on request into a disk cache local to the web process.
+"""
+
+import hashlib
+import io
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import closing
+from pathlib import Path
+
+from django.conf import settings
+
+from .chunking import open_blob
+from .metrics import CACHE_EVENTS, timed
+from .models import DocumentPage, PagePreview
+from .storage import get_storage
+from .streams import spooled_file
+
+
+logger = logging.getLogger(__name__)
+
+# pdfium is not thread safe
+_pdfium_lock = threading.Lock()
+
+
+def get_preview_sizes():
+    return tuple(sorted(getattr(settings, "DOCUMENT_PREVIEW_SIZES", (160, 640, 1280))))
+
+
+def preview_plan():
+    """{page_number: sizes} rendered while processing"""
+    sizes = get_preview_sizes()
+    pages = getattr(settings, "DOCUMENT_PREVIEW_PAGES", 20)
+    if not pages:
+        return {}
+    plan = {page_number: sizes[:1] for page_number in range(2, pages + 1)}
+    plan[1] = sizes
+    return plan
+
+
+def has_preview(name, content_type=""):
+    """whether previews can be rendered for a file, from its name / type"""
+    content_type = content_type or mimetypes.guess_type(name)[0] or ""
+    return (
+        name.lower().endswith(".pdf")
+        or content_type == "application/pdf"
+        or content_type.startswith("image/")
+    )
+
+
+def preview_key(blob, page_number, size):
+    return f"{blob.key}.previews/{page_number}-{size}.jpg"
+
+
+def iter_renders(stream, name, plan):
+    """
+    yield (page_number, size, image) for `plan` {page_number: sizes} in page
+    order. A page is rendered once at its largest size and scaled down for
+    the others, pages past the end are skipped. Nothing is yielded for files
+    without previews (docx, text)
+    """
+    stream.seek(0)
+    head = stream.read(8)
+    stream.seek(0)
+    if name.lower().endswith(".pdf") or head.startswith(b"%PDF-"):
+        yield from _iter_pdf_renders(stream, plan)
+    elif 1 in plan:
+        yield from _iter_image_renders(stream, plan[1])
+
+
+def _iter_pdf_renders(stream, plan):
+    import pypdfium2
+
+    # the lock is not held while the caller handles a yielded image
+    with _pdfium_lock:
+        pdf = pypdfium2.PdfDocument(stream, autoclose=False)
+        page_count = len(pdf)
+    try:
+        for page_number in sorted(plan):
+            if page_number > page_count:
+                break
+            sizes = sorted(plan[page_number], reverse=True)
+            with _pdfium_lock, timed("preview_render"):
+                page = pdf[page_number - 1]
+                try:
+                    scale = sizes[0] / max(page.get_size())
+                    image = page.render(scale=scale).to_pil()
+                finally:
+                    page.close()
+            for size in sizes:
+                yield page_number, size, _fit(image, size)
+    finally:
+        with _pdfium_lock:
+            pdf.close()
+
+
+def _iter_image_renders(stream, sizes):
+    from PIL import Image, ImageOps
+
+    sizes = sorted(sizes, reverse=True)
+    try:
+        with Image.open(stream) as im, timed("preview_render"):
+            # jpeg decodes straight at a fraction of the resolution
+            im.draft("RGB", (sizes[0], sizes[0]))
+            image = ImageOps.exif_transpose(im)
+            image.thumbnail((sizes[0], sizes[0]))
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, "white")
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            image = image.convert("RGB")
+    except Exception as e:
+        logger.info(f"Not an image, no preview: {e}")
+        return
+    for size in sizes:
+        yield 1, size, _fit(image, size)
+
+
+def _fit(image, size):
+    if max(image.size) <= size:
+        return image
+    image = image.copy()
+    image.thumbnail((size, size))
+    return image
+
+
+def encode(image):
+    buffer = io.BytesIO()
+    quality = getattr(settings, "DOCUMENT_PREVIEW_QUALITY", 80)
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def generate_previews(version, stream, name):
+    """
+    render and store the previews of `preview_plan` for a version, from its
+    downloaded content in `stream`. Content whose previews exist already
+    (duplicates) is skipped. Returns the number of previews stored
+    """
+    blob = version.blob
+    if blob is None or PagePreview.objects.filter(blob=blob).exists():
+        return 0
+    storage = get_storage()
+    previews = []
+    for page_number, size, image in iter_renders(stream, name, preview_plan()):
+        key = preview_key(blob, page_number, size)
+        storage.save(key, io.BytesIO(encode(image)), content_type="image/jpeg")
+        previews.append(
+            PagePreview(
+                blob=blob,
+                page_number=page_number,
+                size=size,
+                width=image.width,
+                height=image.height,
+                key=key,
+            )
+        )
+    PagePreview.objects.bulk_create(previews, ignore_conflicts=True)
+    return len(previews)
+
+
+def render_preview(version, page_number, size):
+    """
+    jpeg bytes of a page that has no stored preview, rendered from the
+    version content and kept in the disk cache. None when the file or the
+    page has no preview
+    """
+    name = version.file if isinstance(version.file, str) else version.file.name
+    if version.blob is None or not has_preview(name, version.content_type):
+        return None
+    # pages are known once extracted, no download for a page out of range
+    if not DocumentPage.objects.filter(
+        version=version, page_number=page_number
+    ).exists():
+        return None
+
+    cache = get_preview_cache()
+    cache_key = f"{version.blob.sha256}/{page_number}/{size}"
+    data = cache.get(cache_key)
+    if data is not None:
+        CACHE_EVENTS.labels("preview_hits").inc()
+        return data
+    CACHE_EVENTS.labels("preview_misses").inc()
+    with spooled_file() as spool:
+        with closing(open_blob(version.blob)) as body, timed("download"):
+            shutil.copyfileobj(body, spool)
+        for _, _, image in iter_renders(spool, name, {page_number: [size]}):
+            data = encode(image)
+    if data is not None:
+        cache.set(cache_key, data)
+    return data
+
+
+class DiskLRUCache:
+    """
+    files under `root`, the least recently used are deleted once they take
+    more than `max_size` bytes. Reads touch a file's mtime, so every process
+    sharing the directory sees the same recency. The total size is tracked
+    per process between scans of the directory, processes may overshoot
+    `max_size` by what the others wrote since their last scan
+    """
+
+    def __init__(self, root, max_size):
+        self.root = Path(root)
+        self.max_size = max_size
+        self.size = None  # bytes, unknown until the first scan
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self.root / digest[:2] / digest
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # missing, or evicted by another process meanwhile
+            return None
+        return data
+
+    def set(self, key, data):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # readers never see a partially written file
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            if self.size is None:
+                self.evict()
+            else:
+                self.size += len(data)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """delete the least recently used files down to 90% of max_size"""
+        entries = []
+        for path in self.root.glob("*/*"):
+            if path.name.startswith(".tmp"):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_size:
+            entries.sort()
+            target = self.max_size * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+        self.size = total
+
+
+_preview_cache = None
+_preview_cache_lock = threading.Lock()
+
+
+def get_preview_cache():
+    global _preview_cache
+    if _preview_cache is None:
+        with _preview_cache_lock:
+            if _preview_cache is None:
+                _preview_cache = DiskLRUCache(
+                    getattr(settings, "DOCUMENT_PREVIEW_CACHE_DIR", None)
+                    or Path(tempfile.gettempdir()) / "doc_vault_previews",
+                    getattr(
+                        settings, "DOCUMENT_PREVIEW_CACHE_MAX_SIZE", 512 * 1024 * 1024
+                    ),
+                )
+    return _preview_cache
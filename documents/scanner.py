@@ -0,0 +1,243 @@
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class ScannerError(Exception):
+    pass
+
+
+class ScanLimitError(ScannerError):
+    """the content is larger than clamd scans (StreamMaxLength), never retried"""
+
+
+def parse_reply(reply):
+    """'stream: Eicar-Signature FOUND' -> ('FOUND', 'Eicar-Signature')"""
+    _, _, result = reply.rpartition("stream: ")
+    if result == "OK":
+        return "OK", None
+    if result.endswith(" FOUND"):
+        return "FOUND", result[: -len(" FOUND")]
+    return "ERROR", reply
+
+
+def raise_for_error(result):
+    """raise for an ("ERROR", reply) scan result, it is not a verdict"""
+    status, reply = result
+    if status != "ERROR":
+        return
+    if "size limit exceeded" in (reply or ""):
+        raise ScanLimitError(reply)
+    raise ScannerError(f"clamd could not scan: {reply}")
+
+
+class ClamdConnection:
+    """
+    one clamd socket in IDSESSION mode. Commands share the connection and
+    replies carry the id of the command they answer, so several INSTREAM
+    scans can be in flight on it at once.
+    """
+
+    def __init__(self, address, timeout=None):
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.sock.sendall(b"zIDSESSION\0")
+        self.next_id = 1
+        self.buffer = b""
+        self.last_used = time.monotonic()
+
+    def send(self, command):
+        self.sock.sendall(b"z" + command + b"\0")
+        return self._take_id()
+
+    def send_stream(self, stream, chunk_size, max_length=None):
+        self.sock.sendall(b"zINSTREAM\0")
+        sent = 0
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            sent += len(chunk)
+            if max_length and sent > max_length:
+                # clamd would answer "INSTREAM size limit exceeded" and hang up
+                raise ScanLimitError(f"Content is larger than {max_length} bytes")
+            self.sock.sendall(struct.pack("!L", len(chunk)) + chunk)
+        self.sock.sendall(struct.pack("!L", 0))
+        return self._take_id()
+
+    def read_reply(self):
+        """(command id, reply text) of the next reply clamd sends"""
+        while b"\0" not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ScannerError("clamd closed the connection")
+            self.buffer += data
+        reply, _, self.buffer = self.buffer.partition(b"\0")
+        command_id, _, text = reply.decode("utf-8", "replace").partition(": ")
+        self.last_used = time.monotonic()
+        return int(command_id), text
+
+    def close(self):
+        try:
+            self.sock.sendall(b"zEND\0")
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _take_id(self):
+        command_id = self.next_id
+        self.next_id += 1
+        return command_id
+
+
+class BaseScanner:
+    """virus scanner used by the scan stage"""
+
+    def scan(self, stream):
+        """scan a binary stream, returns (status, virus_name)"""
+        raise NotImplementedError
+
+    def scan_many(self, streams):
+        """scan several streams, returns one (status, virus_name) per stream"""
+        return [self.scan(stream) for stream in streams]
+
+    def signature_version(self):
+        """version of the signature database verdicts were made with"""
+        raise NotImplementedError
+
+
+class ClamdScanner(BaseScanner):
+    """
+    keeps up to CLAMD_POOL_SIZE persistent clamd sessions per process and
+    streams content over INSTREAM, so clamd does not need to see our files.
+    Connections idle longer than CLAMD_MAX_IDLE are dropped before clamd's
+    own IdleTimeout closes them under us.
+    """
+
+    def __init__(self, address=None, pool_size=None, timeout=None, max_idle=None):
+        if address is None:
+            host = getattr(settings, "CLAMD_HOST", None)
+            if host:
+                address = (host, getattr(settings, "CLAMD_PORT", 3310))
+            else:
+                address = getattr(
+                    settings, "CLAMD_SOCKET", "/var/run/clamav/clamd.ctl"
+                )
+        self.address = address
+        self.pool_size = pool_size or getattr(settings, "CLAMD_POOL_SIZE", 4)
+        self.timeout = timeout or getattr(settings, "CLAMD_TIMEOUT", 60)
+        self.max_idle = max_idle or getattr(settings, "CLAMD_MAX_IDLE", 20)
+        self.chunk_size = getattr(settings, "CLAMD_CHUNK_SIZE", 1024 * 1024)
+        self.max_length = getattr(
+            settings, "CLAMD_STREAM_MAX_LENGTH", 25 * 1024 * 1024
+        )
+        self.version_ttl = getattr(settings, "CLAMD_VERSION_TTL", 300)
+        self.idle = queue.LifoQueue()
+        self._version = None
+        self._version_checked = 0
+        self._version_lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        conn = None
+        while conn is None:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = ClamdConnection(self.address, timeout=self.timeout)
+                break
+            if time.monotonic() - conn.last_used > self.max_idle:
+                conn.close()
+                conn = None
+        try:
+            yield conn
+        except Exception:
+            # the session state is unknown, never hand it out again
+            conn.close()
+            raise
+        if self.idle.qsize() < self.pool_size:
+            self.idle.put(conn)
+        else:
+            conn.close()
+
+    def scan(self, stream):
+        return self.scan_many([stream])[0]
+
+    def scan_many(self, streams, window=8):
+        """
+        pipeline up to `window` INSTREAM commands on one session before
+        reading replies, for batches of small files
+        """
+        streams = list(streams)
+        results = {}
+        with self.connection() as conn:
+            pending = {}
+            for index, stream in enumerate(streams):
+                command_id = conn.send_stream(stream, self.chunk_size, self.max_length)
+                pending[command_id] = index
+                while len(pending) >= window:
+                    self._collect(conn, pending, results)
+            while pending:
+                self._collect(conn, pending, results)
+        return [results[index] for index in range(len(streams))]
+
+    def signature_version(self):
+        """
+        signature database version, e.g. '27123' from
+        'ClamAV 1.0.5/27123/Mon Dec 11 08:24:54 2023'. Cached for
+        CLAMD_VERSION_TTL seconds
+        """
+        with self._version_lock:
+            if (
+                self._version is None
+                or time.monotonic() - self._version_checked > self.version_ttl
+            ):
+                with self.connection() as conn:
+                    conn.send(b"VERSION")
+                    _, reply = conn.read_reply()
+                parts = reply.split("/")
+                self._version = parts[1] if len(parts) > 1 else reply
+                self._version_checked = time.monotonic()
+            return self._version
+
+    def _collect(self, conn, pending, results):
+        command_id, reply = conn.read_reply()
+        if command_id not in pending:
+            raise ScannerError(f"Unexpected clamd reply {command_id}: {reply}")
+        results[pending.pop(command_id)] = parse_reply(reply)
+
+
+_scanner = None
+_scanner_lock = threading.Lock()
+
+
+def get_scanner():
+    """the configured scanner, one per process (and so one pool per worker)"""
+    global _scanner
+    if _scanner is None:
+        with _scanner_lock:
+            if _scanner is None:
+                path = getattr(settings, "DOCUMENT_SCANNER_BACKEND", None)
+                _scanner = import_string(path or "documents.scanner.ClamdScanner")()
+    return _scanner
+
+
+def reset_scanner():
+    global _scanner, _scanner_lock
+    _scanner = None
+    _scanner_lock = threading.Lock()
+
+
+# pooled sockets must not be shared with forked celery children
+os.register_at_fork(after_in_child=reset_scanner)
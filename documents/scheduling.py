@@ -0,0 +1,197 @@
+"""
+admission of uploads into the processing pipeline.
+
+Uploads are interactive while their owner submits at most
+DOCUMENT_INTERACTIVE_BURST of them in a row, refilled at
+DOCUMENT_INTERACTIVE_RATE per minute. Interactive versions are queued right
+away. Bulk versions (beyond that, or asked for) wait in the QUEUED stage and
+are admitted by admit_queued_versions, at most DOCUMENT_BULK_MAX_IN_FLIGHT
+at a time and shared fairly between owners. Every stage of a bulk version
+runs on the `.bulk` twin of the stage queue, so a tenant importing thousands
+of scans never sits in front of single uploads.
+"""
+
+import heapq
+import logging
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count
+from django.utils import timezone
+
+from . import metrics
+from .models import DocumentVersion
+
+
+logger = logging.getLogger(__name__)
+
+BULK_QUEUE_SUFFIX = ".bulk"
+
+# stages a version holds a pipeline slot in
+ACTIVE_STAGES = ("FETCH", "SCAN", "EXTRACT", "INDEX")
+
+
+def get_cache():
+    return caches[getattr(settings, "DOCUMENT_CACHE_ALIAS", "default")]
+
+
+def stage_queue(task, priority):
+    """queue of a pipeline task for a priority class"""
+    routes = getattr(settings, "CELERY_TASK_ROUTES", {})
+    queue = routes.get(task.name, {}).get("queue") or task.app.conf.task_default_queue
+    return queue + BULK_QUEUE_SUFFIX if priority == "BULK" else queue
+
+
+def take_token(owner_id):
+    """
+    whether `owner_id` may submit one more interactive upload. A token bucket
+    kept in the shared cache as the time it is full again (GCRA), concurrent
+    requests of an owner may both get the last token
+    """
+    rate = getattr(settings, "DOCUMENT_INTERACTIVE_RATE", 30) / 60
+    if rate <= 0:
+        return True
+    burst = getattr(settings, "DOCUMENT_INTERACTIVE_BURST", 20)
+    interval = 1 / rate
+    key = f"docvault:bucket:{owner_id}"
+    cache = get_cache()
+    now = time.time()
+    full_at = max(cache.get(key) or now, now)
+    if full_at - now > (burst - 1) * interval:
+        return False
+    full_at += interval
+    cache.set(key, full_at, timeout=int(full_at - now) + 1)
+    return True
+
+
+def submit(version, owner_id, bulk=False):
+    """
+    start processing an uploaded version, returns its priority class.
+    Interactive versions are queued now, bulk ones wait for admission
+    """
+    priority = "BULK" if bulk or not take_token(owner_id) else "INTERACTIVE"
+    now = timezone.now()
+    fields = dict(
+        priority=priority, submitted_at=now, stage_error="", stage_updated_at=now
+    )
+    if priority == "BULK":
+        fields["stage"] = "QUEUED"
+    DocumentVersion.objects.filter(pk=version.pk).update(**fields)
+    for name, value in fields.items():
+        setattr(version, name, value)
+    metrics.SUBMISSIONS.labels(priority).inc()
+
+    if priority == "BULK":
+        request_admission()
+    else:
+        from .tasks import process_document_version
+
+        process_document_version.delay(version.pk)
+    return priority
+
+
+def queue_bulk(version_ids):
+    """
+    process uploaded versions again as bulk work, they wait for admission
+    like bulk uploads. Returns the number of versions queued
+    """
+    now = timezone.now()
+    queued = (
+        DocumentVersion.objects.filter(pk__in=version_ids)
+        .exclude(stage="PENDING")
+        .update(
+            stage="QUEUED",
+            priority="BULK",
+            submitted_at=now,
+            stage_error="",
+            stage_updated_at=now,
+        )
+    )
+    if queued:
+        request_admission()
+    return queued
+
+
+def request_admission():
+    """run admit_queued_versions soon, at most once a second"""
+    if get_cache().add("docvault:admission", 1, timeout=1):
+        from .tasks import admit_queued_versions
+
+        admit_queued_versions.delay()
+
+
+def finished(version):
+    """a version left the pipeline (done or quarantined), its slot is free"""
+    if version.submitted_at:
+        metrics.PIPELINE_LATENCY.labels(version.priority).observe(
+            (timezone.now() - version.submitted_at).total_seconds()
+        )
+    if version.priority == "BULK":
+        request_admission()
+
+
+def fair_shares(slots, waiting, in_flight):
+    """
+    split `slots` between owners {owner: versions waiting}: one at a time to
+    the owner with the fewest versions in flight, counting those given so far
+    """
+    heap = [(in_flight.get(owner, 0), owner) for owner, count in waiting.items()]
+    heapq.heapify(heap)
+    shares = Counter()
+    while slots and heap:
+        load, owner = heapq.heappop(heap)
+        shares[owner] += 1
+        slots -= 1
+        if shares[owner] < waiting[owner]:
+            heapq.heappush(heap, (load + 1, owner))
+    return shares
+
+
+def count_by_owner(versions):
+    return dict(
+        versions.order_by()
+        .values("document__owner_id")
+        .annotate(count=Count("id"))
+        .values_list("document__owner_id", "count")
+    )
+
+
+def admit_queued_versions():
+    """
+    move QUEUED versions into the pipeline while fewer than
+    DOCUMENT_BULK_MAX_IN_FLIGHT bulk versions are processing, oldest first
+    per owner. Returns the number of versions admitted
+    """
+    from .tasks import advance_stage
+
+    max_in_flight = getattr(settings, "DOCUMENT_BULK_MAX_IN_FLIGHT", 100)
+    # versions whose stage gave up retrying do not hold a slot
+    in_flight = count_by_owner(
+        DocumentVersion.objects.filter(
+            priority="BULK", stage__in=ACTIVE_STAGES, stage_error=""
+        )
+    )
+    slots = max_in_flight - sum(in_flight.values())
+    if slots <= 0:
+        return 0
+    queued = DocumentVersion.objects.filter(stage="QUEUED")
+    shares = fair_shares(slots, count_by_owner(queued), in_flight)
+
+    admitted = 0
+    for owner_id, share in shares.items():
+        versions = queued.filter(document__owner_id=owner_id).order_by(
+            "submitted_at", "pk"
+        )[:share]
+        for dv in versions:
+            # claimed first, a concurrent run admits a version only once
+            claimed = DocumentVersion.objects.filter(pk=dv.pk, stage="QUEUED").update(
+                stage="FETCH"
+            )
+            if claimed:
+                advance_stage(dv, "FETCH")
+                admitted += 1
+    if admitted:
+        logger.info(f"Admitted {admitted} queued versions of {len(shares)} owners")
+    return admitted
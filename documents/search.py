@@ -0,0 +1,299 @@
+import logging
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection
+from django.utils.html import escape
+from django.utils.module_loading import import_string
+
+from .models import Document, DocumentPage, DocumentVersion, SharedDocument
+from .sinks import TextSink, drain
+
+
+logger = logging.getLogger(__name__)
+
+SearchHit = namedtuple(
+    "SearchHit", ["document_id", "version_id", "page_number", "score", "highlight"]
+)
+
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+
+# backends delimit matches with these, the snippet is html escaped before
+# they become HIGHLIGHT_START/END. Removed from the text itself
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+
+def unmarked(text):
+    return text.replace(MATCH_START, "").replace(MATCH_END, "")
+
+
+def render_highlight(snippet):
+    """escaped snippet, page text is user content and must not become markup"""
+    return (
+        escape(snippet or "")
+        .replace(MATCH_START, HIGHLIGHT_START)
+        .replace(MATCH_END, HIGHLIGHT_END)
+    )
+
+
+def search_hits(rows):
+    """(document_id, version_id, page_number, score, snippet) rows -> [SearchHit]"""
+    return [SearchHit(*row[:4], render_highlight(row[4])) for row in rows]
+
+
+def accessible_documents(user):
+    """documents the user owns or that were shared with them"""
+    shared = SharedDocument.objects.filter(user=user).values("document_id")
+    return Document.objects.filter(owner=user) | Document.objects.filter(
+        pk__in=shared
+    )
+
+
+def searchable_versions(user, all_versions=False):
+    """
+    ids of indexed versions a user may search, the latest ones by default.
+    Quarantined versions are left out, like their downloads
+    """
+    documents = accessible_documents(user)
+    if all_versions:
+        return (
+            DocumentVersion.objects.filter(document__in=documents, indexed=True)
+            .exclude(stage="QUARANTINED")
+            .values("id")
+        )
+    return (
+        documents.filter(latest_version__indexed=True)
+        .exclude(latest_version__stage="QUARANTINED")
+        .values("latest_version_id")
+    )
+
+
+def query_terms(query):
+    return re.findall(r"\w+", query.lower())
+
+
+class BaseSearchBackend:
+    """
+    search index over DocumentPage text. Backends receive pages in batches
+    while a version is extracted, or from index_document_version.
+    """
+
+    def clear_version(self, version_id):
+        pass
+
+    def index_pages(self, version, pages):
+        """pages is a list of (page_number, text)"""
+        pass
+
+    def search(self, query, versions, limit=20, offset=0):
+        """versions: queryset of version ids to search in, returns [SearchHit]"""
+        raise NotImplementedError
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """
+    FTS5 virtual table (created in migration 0004), ranked with bm25. The
+    rowid packs version id and page number so a version's rows can be
+    replaced with a rowid range scan.
+    """
+
+    table = "documents_search"
+    page_bits = 20
+
+    def _rowid_range(self, version_id):
+        start = version_id << self.page_bits
+        return start, start + (1 << self.page_bits) - 1
+
+    def clear_version(self, version_id):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {self.table} WHERE rowid BETWEEN %s AND %s",
+                self._rowid_range(version_id),
+            )
+
+    def index_pages(self, version, pages):
+        rows = [
+            (
+                (version.id << self.page_bits) + page_number,
+                unmarked(text),
+                version.id,
+                version.document_id,
+                page_number,
+            )
+            for page_number, text in pages
+            if text.strip()
+        ]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO {self.table} "
+                f"(rowid, body, version_id, document_id, page_number) "
+                f"VALUES (%s, %s, %s, %s, %s)",
+                rows,
+            )
+
+    def search(self, query, versions, limit=20, offset=0):
+        terms = query_terms(query)
+        if not terms:
+            return []
+        # quote every term so user input can't use fts5 query syntax
+        match = " ".join(f'"{term}"' for term in terms)
+        versions_sql, versions_params = versions.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT document_id, version_id, page_number, -rank, "
+                f"snippet({self.table}, 0, %s, %s, '…', 16) "
+                f"FROM {self.table} "
+                f"WHERE {self.table} MATCH %s AND version_id IN ({versions_sql}) "
+                f"ORDER BY rank LIMIT %s OFFSET %s",
+                [MATCH_START, MATCH_END, match]
+                + list(versions_params)
+                + [limit, offset],
+            )
+            return search_hits(cursor.fetchall())
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    searches DocumentPage.text directly, migration 0004 adds a GIN index on
+    to_tsvector(config, text) so the table itself is the index.
+    """
+
+    config = "english"
+
+    def search(self, query, versions, limit=20, offset=0):
+        terms = query_terms(query)
+        if not terms:
+            return []
+        versions_sql, versions_params = versions.query.sql_with_params()
+        page_table = DocumentPage._meta.db_table
+        version_table = DocumentVersion._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT v.document_id, p.version_id, p.page_number, "
+                f"ts_rank(to_tsvector('{self.config}', p.text), q) AS score, "
+                f"ts_headline('{self.config}', translate(p.text, %s, ''), q, %s) "
+                f"FROM {page_table} p "
+                f"JOIN {version_table} v ON v.id = p.version_id, "
+                f"plainto_tsquery('{self.config}', %s) q "
+                f"WHERE to_tsvector('{self.config}', p.text) @@ q "
+                f"AND p.version_id IN ({versions_sql}) "
+                f"ORDER BY score DESC LIMIT %s OFFSET %s",
+                [
+                    MATCH_START + MATCH_END,
+                    f"StartSel={MATCH_START}, StopSel={MATCH_END}",
+                    " ".join(terms),
+                ]
+                + list(versions_params)
+                + [limit, offset],
+            )
+            return search_hits(cursor.fetchall())
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """unindexed icontains fallback for databases without full-text search"""
+
+    def search(self, query, versions, limit=20, offset=0):
+        terms = query_terms(query)
+        if not terms:
+            return []
+        pages = DocumentPage.objects.filter(version_id__in=versions)
+        for term in terms:
+            pages = pages.filter(text__icontains=term)
+        pages = pages.values_list(
+            "version__document_id", "version_id", "page_number", "text"
+        ).order_by("-version_id", "page_number")[offset : offset + limit]
+        return search_hits(
+            (document_id, version_id, page_number, 1.0, _snippet(text, terms))
+            for document_id, version_id, page_number, text in pages
+        )
+
+
+def _snippet(text, terms, width=80):
+    text = unmarked(text)
+    lowered = text.lower()
+    position = min(
+        (lowered.find(term) for term in terms if term in lowered), default=0
+    )
+    start = max(position - width, 0)
+    snippet = text[start : position + width]
+    for term in terms:
+        snippet = re.sub(
+            f"({re.escape(term)})",
+            f"{MATCH_START}\\1{MATCH_END}",
+            snippet,
+            flags=re.IGNORECASE,
+        )
+    return snippet
+
+
+BACKENDS = {
+    "sqlite": SQLiteFTSBackend,
+    "postgresql": PostgresSearchBackend,
+}
+
+
+@lru_cache(maxsize=None)
+def get_backend():
+    path = getattr(settings, "DOCUMENT_SEARCH_BACKEND", None)
+    if path:
+        return import_string(path)()
+    return BACKENDS.get(connection.vendor, DatabaseSearchBackend)()
+
+
+class SearchIndexSink(TextSink):
+    """indexes pages while a version is being extracted"""
+
+    def __init__(self, version, batch_size=None):
+        super().__init__(version)
+        self.batch_size = batch_size or getattr(
+            settings, "DOCUMENT_PAGE_BATCH_SIZE", 100
+        )
+        self.pending = []
+
+    def open(self):
+        DocumentVersion.objects.filter(pk=self.version.pk).update(indexed=False)
+        get_backend().clear_version(self.version.pk)
+
+    def write(self, chunk):
+        self.pending.append((chunk.page_number, chunk.text))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            get_backend().index_pages(self.version, self.pending)
+            self.pending = []
+
+    def close(self, error=None):
+        self.flush()
+        if error is None:
+            DocumentVersion.objects.filter(pk=self.version.pk).update(indexed=True)
+            self.version.indexed = True
+
+
+def index_document_version(version_id):
+    """(re)index the stored pages of a version"""
+    version = DocumentVersion.objects.get(pk=version_id)
+    sink = SearchIndexSink(version)
+    # pages have the page_number / text of the extracted chunks
+    pages = DocumentPage.objects.filter(version=version).only("page_number", "text")
+    drain(pages.iterator(chunk_size=sink.batch_size), [sink])
+
+
+def unindex_versions(version_ids):
+    """drop versions from the search index, e.g. once they are quarantined"""
+    backend = get_backend()
+    for version_id in version_ids:
+        backend.clear_version(version_id)
+    DocumentVersion.objects.filter(pk__in=version_ids).update(indexed=False)
+
+
+def search_documents(user, query, limit=20, offset=0, all_versions=False):
+    versions = searchable_versions(user, all_versions=all_versions)
+    return get_backend().search(query, versions, limit=limit, offset=offset)
@@ -46,6 +46,27 @@ class DocumentSerializer(serializers.ModelSerializer):
         ]
 
 
+class DocumentListSerializer(serializers.ModelSerializer):
+    """compact list representation, only the latest version is included"""
+
+    latest_version = DocumentVersionSerializer(read_only=True)
+    tags = TagSerializer(many=True, read_only=True)
+    owner = serializers.StringRelatedField(read_only=True)
+
+    class Meta:
+        model = Document
+        fields = [
+            "id",
+            "title",
+            "description",
+            "owner",
+            "created_at",
+            "updated_at",
+            "tags",
+            "latest_version",
+        ]
+
+
 class SimpleDocumentCreateSerializer(serializers.ModelSerializer):
     """serializer for creating document entry and requesting presigned URL"""
 
@@ -61,8 +82,21 @@ class PresignedUploadResponseSerializer(serializers.Serializer):
 
 
 class AuditLogSerializer(serializers.ModelSerializer):
-    model = AuditLog
-    fields = "__all__"
+    user = serializers.StringRelatedField(read_only=True)
+
+    class Meta:
+        model = AuditLog
+        fields = [
+            "id",
+            "timestamp",
+            "action",
+            "user",
+            "document",
+            "version",
+            "details",
+            "ip_address",
+            "extra",
+        ]
 
 
 class SharedDocumentSerializer(serializers.ModelSerializer):
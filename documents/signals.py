@@ -0,0 +1,58 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .blobs import detach_blob
+from .cache import get_document_cache
+from .models import Document, DocumentVersion, SharedDocument, Tag
+
+
+@receiver(post_delete, sender=DocumentVersion)
+def release_blob(sender, instance, **kwargs):
+    # also runs for versions removed by a cascading Document delete
+    if instance.blob_id:
+        detach_blob(instance.blob_id)
+
+
+def invalidate_documents(document_ids):
+    # after commit, so a concurrent read cannot cache the old rows again
+    def invalidate():
+        cache = get_document_cache()
+        for document_id in document_ids:
+            cache.invalidate(document_id)
+
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_save, sender=Document)
+@receiver(post_delete, sender=Document)
+def document_changed(sender, instance, **kwargs):
+    invalidate_documents([instance.pk])
+
+
+@receiver(post_save, sender=DocumentVersion)
+@receiver(post_delete, sender=DocumentVersion)
+@receiver(post_save, sender=SharedDocument)
+@receiver(post_delete, sender=SharedDocument)
+def document_child_changed(sender, instance, **kwargs):
+    invalidate_documents([instance.document_id])
+
+
+@receiver(m2m_changed, sender=Document.tags.through)
+def document_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        invalidate_documents([instance.pk])
+    elif pk_set:
+        invalidate_documents(list(pk_set))
+    else:
+        # tag.documents.clear()
+        invalidate_documents(list(instance.documents.values_list("pk", flat=True)))
+
+
+@receiver(post_save, sender=Tag)
+@receiver(pre_delete, sender=Tag)
+def tag_changed(sender, instance, **kwargs):
+    # renamed or removed, every document showing the tag changes
+    invalidate_documents(list(instance.documents.values_list("pk", flat=True)))
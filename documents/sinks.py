@@ -0,0 +1,91 @@
+import logging
+
+from django.conf import settings
+
+from .models import DocumentPage
+
+
+logger = logging.getLogger(__name__)
+
+
+class TextSink:
+    """receives the text chunks of a document version, in page order"""
+
+    def __init__(self, version):
+        self.version = version
+
+    def open(self):
+        pass
+
+    def write(self, chunk):
+        raise NotImplementedError
+
+    def close(self, error=None):
+        pass
+
+
+class PageTableSink(TextSink):
+    """writes every chunk as a DocumentPage row, in batches"""
+
+    def __init__(self, version, batch_size=None):
+        super().__init__(version)
+        self.batch_size = batch_size or getattr(
+            settings, "DOCUMENT_PAGE_BATCH_SIZE", 100
+        )
+        self.pending = []
+        self.last_page = 0
+
+    def write(self, chunk):
+        self.pending.append(
+            DocumentPage(
+                version=self.version,
+                page_number=chunk.page_number,
+                text=chunk.text,
+                source=chunk.source,
+            )
+        )
+        self.last_page = max(self.last_page, chunk.page_number)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        DocumentPage.objects.bulk_create(
+            self.pending,
+            update_conflicts=True,
+            unique_fields=["version", "page_number"],
+            update_fields=["text", "source"],
+        )
+        self.pending = []
+
+    def close(self, error=None):
+        self.flush()
+        if error is None:
+            # drop pages left over from an earlier, longer extraction
+            DocumentPage.objects.filter(
+                version=self.version, page_number__gt=self.last_page
+            ).delete()
+
+
+def drain(chunks, sinks):
+    """feed every chunk to every sink, returns the number of chunks"""
+    for sink in sinks:
+        sink.open()
+    count = 0
+    error = None
+    try:
+        for chunk in chunks:
+            for sink in sinks:
+                sink.write(chunk)
+            count += 1
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        for sink in sinks:
+            try:
+                sink.close(error=error)
+            except Exception as e:
+                logger.error(f"Failed to close {type(sink).__name__}: {e}")
+    return count
@@ -0,0 +1,435 @@
+import hashlib
+import io
+import os
+import shutil
+import threading
+import uuid
+from collections import namedtuple
+from contextlib import closing
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+# 1 byte .. 500MB, the limit enforced on presigned POST uploads
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024 * 10
+
+# S3 multipart limits: parts of 5MB (except the last one) .. 5GB, 10000 parts
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+
+# an uploaded part of a multipart upload, etag without quotes
+Part = namedtuple("Part", ["number", "etag", "size"])
+
+
+class NoSuchUpload(Exception):
+    """the multipart upload is unknown, or was completed or aborted"""
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def _create_s3_client():
+    import boto3
+    from botocore.config import Config
+
+    config = Config(
+        max_pool_connections=getattr(settings, "AWS_S3_MAX_POOL_CONNECTIONS", 50),
+        retries={"max_attempts": 5, "mode": "standard"},
+        tcp_keepalive=True,
+        signature_version="s3v4",
+    )
+    return boto3.session.Session().client(
+        "s3",
+        region_name=getattr(settings, "AWS_S3_REGION_NAME", None),
+        endpoint_url=getattr(settings, "AWS_S3_ENDPOINT_URL", None),
+        aws_access_key_id=getattr(settings, "AWS_ACCESS_KEY_ID", None),
+        aws_secret_access_key=getattr(settings, "AWS_SECRET_ACCESS_KEY", None),
+        config=config,
+    )
+
+
+def get_s3_client():
+    """
+    process wide S3 client. boto3 clients are thread safe, building one costs
+    milliseconds of CPU and a fresh connection pool, so it is built once per
+    process on first use.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = _create_s3_client()
+    return _s3_client
+
+
+def reset_s3_client(**kwargs):
+    """drop the client, its pooled sockets must not be shared with a fork"""
+    global _s3_client, _s3_client_lock
+    _s3_client = None
+    _s3_client_lock = threading.Lock()
+
+
+# celery prefork children (and gunicorn workers) build their own client
+os.register_at_fork(after_in_child=reset_s3_client)
+
+
+class BaseStorage:
+    """where document versions are stored, keys are relative paths"""
+
+    # whether the multipart methods below are implemented
+    supports_multipart = False
+
+    def presigned_post(self, key, content_type, expiration=3600) -> dict:
+        raise NotImplementedError
+
+    def presigned_get(self, key, expiration=3600, filename=None) -> str:
+        raise NotImplementedError
+
+    def save(self, key, fileobj, content_type=None):
+        raise NotImplementedError
+
+    def download_fileobj(self, key, fileobj):
+        raise NotImplementedError
+
+    def copy(self, source, key):
+        """copy the object at `source` to `key`"""
+        with closing(self.open(source)) as body:
+            self.save(key, body)
+
+    def open(self, key):
+        """readable binary stream of the object, close it when done"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def size(self, key):
+        """size in bytes, None when the object does not exist"""
+        raise NotImplementedError
+
+    # multipart uploads, the client uploads parts to presigned urls
+
+    def create_multipart_upload(self, key, content_type) -> str:
+        """start a multipart upload, returns its upload id"""
+        raise NotImplementedError
+
+    def presigned_upload_part(self, key, upload_id, part_number, expiration=3600):
+        raise NotImplementedError
+
+    def list_parts(self, key, upload_id):
+        """
+        [Part] uploaded so far, ordered by part number. Raises NoSuchUpload
+        once the upload is gone
+        """
+        raise NotImplementedError
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        raise NotImplementedError
+
+    def abort_multipart_upload(self, key, upload_id):
+        raise NotImplementedError
+
+
+class S3Storage(BaseStorage):
+    supports_multipart = True
+
+    def __init__(self, bucket=None):
+        self.bucket = bucket or getattr(settings, "AWS_STORAGE_BUCKET_NAME", None)
+
+    @property
+    def client(self):
+        return get_s3_client()
+
+    def presigned_post(self, key, content_type, expiration=3600) -> dict:
+        fields = {"Content-Type": content_type, "key": key}
+        conditions = [
+            {"key": key},
+            {"Content-Type": content_type},
+            ["content-length-range", 1, MAX_UPLOAD_SIZE],
+        ]
+        return self.client.generate_presigned_post(
+            Bucket=self.bucket,
+            Key=key,
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=expiration,
+        )
+
+    def presigned_get(self, key, expiration=3600, filename=None) -> str:
+        params = {"Bucket": self.bucket, "Key": key}
+        if filename:
+            params["ResponseContentDisposition"] = f'attachment; filename="{filename}"'
+        return self.client.generate_presigned_url(
+            "get_object", Params=params, ExpiresIn=expiration
+        )
+
+    def save(self, key, fileobj, content_type=None):
+        extra = {"ContentType": content_type} if content_type else None
+        self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs=extra)
+
+    def download_fileobj(self, key, fileobj):
+        self.client.download_fileobj(self.bucket, key, fileobj)
+
+    def copy(self, source, key):
+        # server side, in parts for objects above the 5GB of a single copy
+        self.client.copy({"Bucket": self.bucket, "Key": source}, self.bucket, key)
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def size(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)[
+                "ContentLength"
+            ]
+        except self.client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return None
+            raise
+
+    def create_multipart_upload(self, key, content_type) -> str:
+        return self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key, ContentType=content_type
+        )["UploadId"]
+
+    def presigned_upload_part(self, key, upload_id, part_number, expiration=3600):
+        return self.client.generate_presigned_url(
+            "upload_part",
+            Params={
+                "Bucket": self.bucket,
+                "Key": key,
+                "UploadId": upload_id,
+                "PartNumber": part_number,
+            },
+            ExpiresIn=expiration,
+        )
+
+    def list_parts(self, key, upload_id):
+        paginator = self.client.get_paginator("list_parts")
+        parts = []
+        try:
+            pages = paginator.paginate(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            for page in pages:
+                for part in page.get("Parts", []):
+                    parts.append(
+                        Part(part["PartNumber"], part["ETag"].strip('"'), part["Size"])
+                    )
+        except self.client.exceptions.NoSuchUpload as e:
+            raise NoSuchUpload(upload_id) from e
+        return sorted(parts)
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": part.number, "ETag": f'"{part.etag}"'}
+                    for part in parts
+                ]
+            },
+        )
+
+    def abort_multipart_upload(self, key, upload_id):
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id
+            )
+        except self.client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "NoSuchUpload":
+                raise
+
+
+class LocalStorage(BaseStorage):
+    """
+    stores objects under DOCUMENT_STORAGE_ROOT, for running the pipeline
+    offline. Presigned urls point at the files directly.
+    """
+
+    supports_multipart = True
+
+    def __init__(self, root=None):
+        self.root = Path(
+            root
+            or getattr(settings, "DOCUMENT_STORAGE_ROOT", None)
+            or Path(settings.BASE_DIR) / "storage"
+        )
+
+    def path(self, key):
+        path = (self.root / key).resolve()
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"Invalid key: {key}")
+        return path
+
+    def presigned_post(self, key, content_type, expiration=3600) -> dict:
+        return {
+            "url": self.path(key).as_uri(),
+            "fields": {"Content-Type": content_type, "key": key},
+        }
+
+    def presigned_get(self, key, expiration=3600, filename=None) -> str:
+        return self.path(key).as_uri()
+
+    def save(self, key, fileobj, content_type=None):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(fileobj, f)
+
+    def download_fileobj(self, key, fileobj):
+        with open(self.path(key), "rb") as f:
+            shutil.copyfileobj(f, fileobj)
+
+    def copy(self, source, key):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(self.path(source), path)
+
+    def open(self, key):
+        return open(self.path(key), "rb")
+
+    def delete(self, key):
+        self.path(key).unlink(missing_ok=True)
+
+    def size(self, key):
+        path = self.path(key)
+        return path.stat().st_size if path.exists() else None
+
+    # parts are files under .multipart/<upload id>/, named by part number
+
+    def part_path(self, upload_id, part_number):
+        return self.path(f".multipart/{upload_id}/{part_number}")
+
+    def create_multipart_upload(self, key, content_type) -> str:
+        upload_id = uuid.uuid4().hex
+        self.path(f".multipart/{upload_id}").mkdir(parents=True)
+        return upload_id
+
+    def presigned_upload_part(self, key, upload_id, part_number, expiration=3600):
+        return self.part_path(upload_id, part_number).as_uri()
+
+    def upload_part(self, key, upload_id, part_number, data):
+        """what a client does with a presigned part url, returns the etag"""
+        self.part_path(upload_id, part_number).write_bytes(data)
+        return hashlib.md5(data).hexdigest()
+
+    def list_parts(self, key, upload_id):
+        directory = self.path(f".multipart/{upload_id}")
+        if not directory.is_dir():
+            raise NoSuchUpload(upload_id)
+        parts = []
+        for path in directory.iterdir():
+            md5 = hashlib.md5()
+            with open(path, "rb") as f:
+                for data in iter(lambda: f.read(1024 * 1024), b""):
+                    md5.update(data)
+            parts.append(Part(int(path.name), md5.hexdigest(), path.stat().st_size))
+        return sorted(parts)
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            for part in parts:
+                with open(self.part_path(upload_id, part.number), "rb") as data:
+                    shutil.copyfileobj(data, f)
+        self.abort_multipart_upload(key, upload_id)
+
+    def abort_multipart_upload(self, key, upload_id):
+        shutil.rmtree(self.path(f".multipart/{upload_id}"), ignore_errors=True)
+
+
+class InMemoryStorage(BaseStorage):
+    """process local dict of objects, for tests and benchmarks"""
+
+    supports_multipart = True
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}  # upload id -> {part number: bytes}
+        self.lock = threading.Lock()
+
+    def presigned_post(self, key, content_type, expiration=3600) -> dict:
+        return {
+            "url": f"memory://{key}",
+            "fields": {"Content-Type": content_type, "key": key},
+        }
+
+    def presigned_get(self, key, expiration=3600, filename=None) -> str:
+        return f"memory://{key}"
+
+    def save(self, key, fileobj, content_type=None):
+        data = fileobj if isinstance(fileobj, bytes) else fileobj.read()
+        with self.lock:
+            self.objects[key] = data
+
+    def download_fileobj(self, key, fileobj):
+        with self.lock:
+            data = self.objects[key]
+        shutil.copyfileobj(io.BytesIO(data), fileobj)
+
+    def copy(self, source, key):
+        with self.lock:
+            self.objects[key] = self.objects[source]
+
+    def open(self, key):
+        with self.lock:
+            return io.BytesIO(self.objects[key])
+
+    def delete(self, key):
+        with self.lock:
+            self.objects.pop(key, None)
+
+    def size(self, key):
+        with self.lock:
+            data = self.objects.get(key)
+        return None if data is None else len(data)
+
+    def create_multipart_upload(self, key, content_type) -> str:
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = {}
+        return upload_id
+
+    def presigned_upload_part(self, key, upload_id, part_number, expiration=3600):
+        return f"memory://{key}?uploadId={upload_id}&partNumber={part_number}"
+
+    def upload_part(self, key, upload_id, part_number, data):
+        """what a client does with a presigned part url, returns the etag"""
+        with self.lock:
+            self.uploads[upload_id][part_number] = data
+        return hashlib.md5(data).hexdigest()
+
+    def list_parts(self, key, upload_id):
+        with self.lock:
+            if upload_id not in self.uploads:
+                raise NoSuchUpload(upload_id)
+            parts = dict(self.uploads[upload_id])
+        return [
+            Part(number, hashlib.md5(data).hexdigest(), len(data))
+            for number, data in sorted(parts.items())
+        ]
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        with self.lock:
+            uploaded = self.uploads.pop(upload_id)
+            self.objects[key] = b"".join(uploaded[part.number] for part in parts)
+
+    def abort_multipart_upload(self, key, upload_id):
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+
+
+@lru_cache(maxsize=None)
+def get_storage():
+    """the configured storage backend, one instance per process"""
+    path = getattr(settings, "DOCUMENT_STORAGE_BACKEND", None)
+    return import_string(path or "documents.storage.S3Storage")()
@@ -0,0 +1,49 @@
+import hashlib
+import tempfile
+import time
+
+from django.conf import settings
+
+
+def get_spool_max_size():
+    return getattr(settings, "DOCUMENT_SPOOL_MAX_SIZE", 32 * 1024 * 1024)
+
+
+def spooled_file():
+    """in memory buffer that only rolls over to a temp file when it gets big"""
+    return tempfile.SpooledTemporaryFile(max_size=get_spool_max_size())
+
+
+class HashingReader:
+    """
+    reads `source` once. Every byte read is hashed, so a consumer such as
+    clamd INSTREAM can read the stream while the hash is produced in the
+    same pass. `read_time` and `hash_time` are the seconds spent waiting on
+    `source` and hashing
+    """
+
+    def __init__(self, source, hasher=None):
+        self.source = source
+        self.hasher = hasher or hashlib.sha256()
+        self.size = 0
+        self.read_time = 0.0
+        self.hash_time = 0.0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.source.read(size)
+        read = time.perf_counter()
+        self.read_time += read - start
+        if data:
+            self.hasher.update(data)
+            self.hash_time += time.perf_counter() - read
+            self.size += len(data)
+        return data
+
+    def drain(self, chunk_size=1024 * 1024):
+        """read whatever the consumer left unread"""
+        while self.read(chunk_size):
+            pass
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
@@ -1,149 +1,517 @@
-import os
-from celery import shared_task
+import shutil
+import time
+from celery import Task, shared_task
+from celery.signals import (
+    task_failure,
+    task_postrun,
+    task_prerun,
+    task_retry,
+    worker_init,
+    worker_process_init,
+    worker_process_shutdown,
+    worker_shutdown,
+)
 import logging
-from .models import DocumentVersion
-import boto3
+from .models import Blob, MultipartUpload, DocumentPage, DocumentVersion
 from django.conf import settings
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
 import io
-import tempfile
-import hashlib
-import pdfplumber
-import pytesseract
-import clamd
+from contextlib import closing
+from datetime import timedelta
 from django.core.files.base import ContentFile
+from . import audit, blobs, metrics, scheduling, warmup
+from .audit import flush_audit_log, log_event
+from .blobs import (
+    attach_blob,
+    blob_key,
+    copy_extracted_text,
+    has_current_verdict,
+    incoming_key,
+    place_blob,
+    record_scan,
+)
+from .chunking import (
+    chunk_blob,
+    collect_unreferenced_chunks,
+    open_blob,
+    restore_blob,
+    superseded_blobs,
+)
+from .diff import forget_diffs
+from .extractors import extract_chunks
+from .previews import generate_previews
+from .scanner import ScanLimitError, get_scanner, raise_for_error
+from .scheduling import stage_queue
+from .search import index_document_version, unindex_versions
+from .sinks import PageTableSink, drain
+from .storage import get_storage
+from .streams import HashingReader, spooled_file
+from .uploads import abort_multipart_upload
 
 
 logger = logging.getLogger(__name__)
 
+# write buffered audit entries before a worker (or prefork child) exits
+worker_process_shutdown.connect(flush_audit_log)
+worker_shutdown.connect(flush_audit_log)
 
-@shared_task(
+# prometheus task metrics
+task_prerun.connect(metrics.task_started)
+task_postrun.connect(metrics.task_finished)
+task_retry.connect(metrics.task_retried)
+task_failure.connect(metrics.task_failed)
+worker_init.connect(metrics.start_worker_server)
+worker_process_shutdown.connect(metrics.mark_process_dead)
+
+# workers cap the OCR threads, load the extraction stack and their clients
+# before the first task
+worker_init.connect(warmup.limit_ocr_threads)
+worker_init.connect(warmup.preload_modules)
+worker_process_init.connect(warmup.preload_clients)
+
+
+def record_stage_error(version_id, exc):
+    """the version stays at its stage until it is processed again"""
+    DocumentVersion.objects.filter(pk=version_id).update(
+        stage_error=f"{type(exc).__name__}: {exc}",
+        stage_updated_at=timezone.now(),
+    )
+
+
+class StageTask(Task):
+    """pipeline stage, records the error once the stage stops retrying"""
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        record_stage_error(args[0], exc)
+
+
+STAGE_OPTIONS = dict(
+    base=StageTask,
     bind=True,
     autoretry_for=(Exception,),  # Auto-retry on any exception
-    retry_kwargs={'max_retries': 5},
+    retry_kwargs={"max_retries": 5},
     retry_backoff=True,  # Exponential backoff
     retry_backoff_max=600,  # Max 10 minutes between retries
-    retry_jitter=True  # Add randomness to avoid thundering herd
+    retry_jitter=True,  # Add randomness to avoid thundering herd
 )
-def process_document_version(self, version_id):
-    """entry point task, runs virus scan, OCR & indexing"""
-    tmp = None
+
+
+def begin_stage(version_id, stage):
+    """the version if it is waiting for `stage`, None otherwise"""
+    dv = DocumentVersion.objects.select_related("blob").filter(pk=version_id).first()
+    if dv is None:
+        logger.error(f"DocumentVersion {version_id} not found")
+        return None
+    if dv.stage != stage:
+        # duplicate delivery or the version was restarted meanwhile
+        logger.info(f"Version {version_id} is at {dv.stage}, skipping {stage}")
+        return None
+    return dv
+
+
+def advance_stage(dv, stage):
+    """record that the version is ready for `stage` and queue that stage"""
+    DocumentVersion.objects.filter(pk=dv.pk).update(
+        stage=stage, stage_error="", stage_updated_at=timezone.now()
+    )
+    dv.stage = stage
+    task = STAGE_TASKS.get(stage)
+    if task is not None:
+        task.apply_async((dv.pk,), queue=stage_queue(task, dv.priority))
+
+
+@shared_task
+def process_document_version(version_id, resume=False):
+    """
+    entry point task, runs the pipeline fetch -> scan -> extract -> index.
+    Each stage is its own task on its own queue and retries on its own.
+    resume=True continues from the stage a version stopped at instead of
+    starting over.
+    """
+    dv = DocumentVersion.objects.filter(pk=version_id).first()
+    if dv is None:
+        logger.error(f"DocumentVersion {version_id} not found")
+        return False
+    stage = dv.stage if resume and dv.stage in STAGE_TASKS else "FETCH"
+    advance_stage(dv, stage)
+    return True
+
+
+@shared_task(**STAGE_OPTIONS)
+def fetch_version(self, version_id):
+    """check the upload landed in storage and record its real size"""
+    dv = begin_stage(version_id, "FETCH")
+    if dv is None:
+        return False
+    # every run starts here, admitted or not. OCR checkpoints only carry over
+    # between retries of one run, a new run OCRs every page again
+    DocumentPage.objects.filter(version=dv, source="OCR").delete()
+    size = get_storage().size(dv.storage_key)
+    if size is None:
+        # retried with backoff until the object shows up
+        raise FileNotFoundError(f"{dv.storage_key} is not in storage")
+    DocumentVersion.objects.filter(pk=dv.pk).update(file_size=size)
+    advance_stage(dv, "SCAN")
+    return True
+
+
+def claim_upload(dv, storage):
+    """
+    key of the uploaded content of a version, moved to its incoming_key.
+    The upload's presigned POST stays valid after the upload completed, the
+    bytes hashed and scanned must be ones the client cannot replace anymore.
+    None when the upload was claimed and stored as the version's blob before
+    (reprocessing)
+    """
+    upload = dv.file if isinstance(dv.file, str) else dv.file.name
+    incoming = incoming_key(dv)
+    if storage.size(upload) is not None:
+        storage.copy(upload, incoming)
+        # blobs stored before blob keys live at their first upload's key
+        if dv.blob is None or dv.blob.key != upload:
+            storage.delete(upload)
+    elif storage.size(incoming) is None:
+        return None
+    return incoming
+
+
+@shared_task(**STAGE_OPTIONS)
+def scan_version(self, version_id):
+    """
+    hash the stored bytes, deduplicate and virus scan. Hashing and clamd
+    INSTREAM share a single pass over the upload, claimed first so the
+    content cannot change under the verdict
+    """
+    dv = begin_stage(version_id, "SCAN")
+    if dv is None:
+        return False
+    name = dv.file if isinstance(dv.file, str) else dv.file.name
+    storage = get_storage()
+    scanner = get_scanner()
     try:
-        dv = DocumentVersion.objects.get(pk=version_id)
-        # download file from S3 to temp
-        key = dv.file if isinstance(dv.file, str) else dv.file.name
-        s3 = boto3.client(
-            "s3",
-            region_name=getattr(settings, "AWS_S3_REGION_NAME", None),
-            aws_access_key_id=getattr(settings, "AWS_ACCESS_KEY_ID", None),
-            aws_secret_access_key=getattr(settings, "AWS_SECRET_ACCESS_KEY", None),
+        signature = scanner.signature_version()
+    except Exception as e:
+        if getattr(settings, "DOCUMENT_SCAN_REQUIRED", True):
+            # retry this stage only, nothing is extracted unscanned
+            raise
+        logger.error(f"Clamd unavailable, not scanning version {dv.id}: {e}")
+        signature = None
+
+    # a blob matching the client supplied hash was most likely scanned with
+    # the current signatures already, so clamd is skipped while hashing. Its
+    # verdict is only reused if the hash computed below matches
+    known = signature is None or (
+        bool(dv.file_hash)
+        and Blob.objects.filter(
+            sha256=dv.file_hash,
+            scan_status__in=("CLEAN", "INFECTED"),
+            scan_signature=signature,
+        ).exists()
+    )
+
+    source = claim_upload(dv, storage)
+    if source is None and dv.blob is None:
+        raise FileNotFoundError(f"{name} is not in storage")
+    scan, scan_error = None, None
+    with closing(storage.open(source) if source else open_blob(dv.blob)) as body:
+        reader = HashingReader(body)
+        if not known:
+            start = time.perf_counter()
+            try:
+                scan = scanner.scan(reader)
+            except Exception as e:
+                scan_error = e
+            # what the scan took besides reading and hashing the stream
+            metrics.observe_step(
+                "clamd",
+                time.perf_counter() - start - reader.read_time - reader.hash_time,
+            )
+        reader.drain()
+    metrics.observe_step("download", reader.read_time)
+    metrics.observe_step("hash", reader.hash_time)
+    metrics.BYTES_PROCESSED.labels("scan").inc(reader.size)
+
+    # always hash the stored bytes, a client supplied hash is not trusted
+    file_hash = reader.hexdigest()
+    if dv.file_hash and dv.file_hash != file_hash:
+        logger.warning(
+            f"Client hash mismatch for version {dv.id}: "
+            f"{dv.file_hash} != {file_hash}"
         )
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        s3.download_file(settings.AWS_STORAGE_BUCKET_NAME, key, tmp.name)
-
-        # compute hash is missing
-        if not dv.file_hash:
-            hasher = hashlib.sha256()
-            with open(tmp.name, "rb") as f:
-                for chunk in iter(lambda: f.read(8192), b""):
-                    hasher.update(chunk)
-            dv.file_hash = hasher.hexdigest()
-            dv.save()
-
-        # virus scan using clamd
+
+    blob, created = attach_blob(dv, file_hash, blob_key(file_hash), size=reader.size)
+    if source is not None:
+        # stored before a verdict is recorded, duplicates drop their copy
+        place_blob(blob, source, storage)
+        storage.delete(source)
+    if not created:
+        logger.info(f"Version {dv.id} deduplicated onto {blob.key}")
+
+    # virus scan using clamd, content scanned with the current signature
+    # database before reuses its verdict
+    deduplicated = has_current_verdict(blob, signature)
+    if not deduplicated and signature is not None:
         try:
-            cd = clamd.ClamdUnixSocket()
-            scan_result = cd.scan(tmp.name)
+            if scan is None and scan_error is None:
+                # skipped above but the client hash was wrong
+                with closing(open_blob(blob)) as body, metrics.timed("clamd"):
+                    scan = scanner.scan(body)
+            if scan is None:
+                raise scan_error
+            raise_for_error(scan)
+        except ScanLimitError as e:
+            if getattr(settings, "DOCUMENT_SCAN_REQUIRED", True):
+                # a retry cannot succeed, the version stops here unscanned
+                logger.error(f"Version {dv.id} is too large to scan: {e}")
+                record_stage_error(dv.pk, e)
+                return False
+            logger.error(f"Clamd scan failed: {e}")
+        except Exception as e:
+            if getattr(settings, "DOCUMENT_SCAN_REQUIRED", True):
+                # clamd errors are retried, nothing is extracted unscanned
+                raise
+            logger.error(f"Clamd scan failed: {e}")
+        else:
+            status, virus_name = scan
+            record_scan(blob, status, virus_name, signature)
 
-            status, virus_name = scan_result[tmp.name]
+    if blob.scan_status == "INFECTED":
+        log_event(
+            "VIRUS_DETECTED",
+            document=dv.document,
+            version=dv,
+            extra={
+                "virus_scan": blob.scan_result,
+                "virus": blob.scan_result.get("virus"),
+                "deduplicated": deduplicated,
+            },
+        )
+        # Handle infected file (delete, quarantine, etc.)
+        metrics.VIRUS_DETECTED.inc()
+        advance_stage(dv, "QUARANTINED")
+        # the text of an earlier run stays stored, but is no longer searched
+        unindex_versions([dv.pk])
+        scheduling.finished(dv)
+        return False
 
-            if status == "FOUND":
-                from .models import AuditLog
+    if blob.scan_status == "CLEAN":
+        log_event(
+            "VIRUS_SCAN_PASSED",
+            document=dv.document,
+            version=dv,
+            extra={
+                "virus_scan": blob.scan_result,
+                "deduplicated": deduplicated,
+            },
+        )
+        logger.info(f"Virus scan passed for {name}")
 
-                AuditLog.objects.create(
-                    user=None,
-                    action="VIRUS_DETECTED",
-                    document=dv.document,
-                    version=dv,
-                    extra={"virus_scan": scan_result, "virus": virus_name},
-                )
-                # Handle infected file (delete, quarantine, etc.)
-                return
-            else:
-                AuditLog.objects.create(
-                    user=None,
-                    action="VIRUS_SCAN_PASSED",
+    advance_stage(dv, "EXTRACT")
+    return True
+
+
+@shared_task(**STAGE_OPTIONS)
+def extract_version(self, version_id):
+    """
+    OCR processing & Text extraction, chunks are streamed to the sinks one
+    page / paragraph group at a time, then page previews are rendered.
+    Duplicates copy the text of the version that was extracted first
+    """
+    dv = begin_stage(version_id, "EXTRACT")
+    if dv is None:
+        return False
+    blob = dv.blob
+    if blob is not None and blob.text_source_id and blob.text_source_id != dv.id:
+        copy_extracted_text(blob.text_source, dv)
+        advance_stage(dv, "INDEX")
+        return True
+
+    name = dv.file if isinstance(dv.file, str) else dv.file.name
+    # buffered in memory, only goes to disk above DOCUMENT_SPOOL_MAX_SIZE
+    with spooled_file() as spool:
+        source = open_blob(blob) if blob else get_storage().open(dv.storage_key)
+        with closing(source) as body, metrics.timed("download"):
+            shutil.copyfileobj(body, spool)
+        metrics.BYTES_PROCESSED.labels("extract").inc(spool.tell())
+        drain(extract_chunks(dv, spool, name), [PageTableSink(dv)])
+        try:
+            generate_previews(dv, spool, name)
+        except Exception as e:
+            # previews are optional, pages without one are rendered on request
+            logger.error(f"Could not render previews of version {dv.id}: {e}")
+
+    if blob is not None:
+        Blob.objects.filter(pk=blob.pk, text_source__isnull=True).update(
+            text_source=dv
+        )
+    # diffs cached with the text of a previous run
+    forget_diffs(dv)
+    advance_stage(dv, "INDEX")
+    return True
+
+
+@shared_task(**STAGE_OPTIONS)
+def index_version(self, version_id):
+    """(re)index the extracted pages of a version, last pipeline stage"""
+    try:
+        index_document_version(version_id)
+    except DocumentVersion.DoesNotExist:
+        logger.error(f"DocumentVersion {version_id} not found")
+        return False
+    done = DocumentVersion.objects.filter(pk=version_id, stage="INDEX").update(
+        stage="DONE", stage_error="", stage_updated_at=timezone.now()
+    )
+    if done:
+        scheduling.finished(
+            DocumentVersion.objects.only("priority", "submitted_at").get(pk=version_id)
+        )
+    return True
+
+
+STAGE_TASKS = {
+    "FETCH": fetch_version,
+    "SCAN": scan_version,
+    "EXTRACT": extract_version,
+    "INDEX": index_version,
+}
+
+
+@shared_task
+def admit_queued_versions():
+    """move bulk versions waiting for admission into the pipeline"""
+    return scheduling.admit_queued_versions()
+
+
+@shared_task
+def collect_unreferenced_blobs(grace_period=None):
+    """delete stored objects that no document version references anymore"""
+    if grace_period is None:
+        grace_period = getattr(settings, "DOCUMENT_BLOB_GC_GRACE_PERIOD", 86400)
+    removed = blobs.collect_unreferenced_blobs(
+        get_storage().delete, timedelta(seconds=grace_period)
+    )
+    chunks = collect_unreferenced_chunks(timedelta(seconds=grace_period))
+    logger.info(f"Removed {removed} unreferenced blobs and {chunks} chunks")
+    return removed
+
+
+@shared_task
+def chunk_superseded_blobs(limit=None):
+    """
+    store blobs only older versions use as content defined chunks, so
+    revisions share their unchanged parts. Off unless DOCUMENT_CHUNKING_ENABLED
+    """
+    if not getattr(settings, "DOCUMENT_CHUNKING_ENABLED", False):
+        return 0
+    limit = limit or getattr(settings, "DOCUMENT_CHUNKING_BATCH_SIZE", 100)
+    saved = 0
+    for blob in superseded_blobs()[:limit]:
+        try:
+            saved += chunk_blob(blob)
+        except Exception as e:
+            logger.error(f"Could not chunk blob {blob.sha256}: {e}")
+    logger.info(f"Chunking saved {saved} bytes")
+    return saved
+
+
+@shared_task(
+    autoretry_for=(Exception,), retry_kwargs={"max_retries": 5}, retry_backoff=True
+)
+def restore_chunked_blob(blob_id):
+    """store the whole object of a chunked blob again, for downloads"""
+    blob = Blob.objects.filter(pk=blob_id, chunked=True).first()
+    if blob is not None:
+        restore_blob(blob)
+
+
+@shared_task
+def rescan_stale_blobs(limit=None, batch_size=50):
+    """
+    rescan small clean blobs whose verdict predates the current signature
+    database. Each batch is pipelined over a single clamd session
+    """
+    limit = limit or getattr(settings, "DOCUMENT_RESCAN_LIMIT", 1000)
+    max_size = getattr(settings, "DOCUMENT_RESCAN_MAX_SIZE", 1024 * 1024)
+    scanner = get_scanner()
+    signature = scanner.signature_version()
+    stale = list(
+        Blob.objects.filter(scan_status="CLEAN", ref_count__gt=0, size__lte=max_size)
+        .exclude(scan_signature=signature)
+        .order_by("pk")[:limit]
+    )
+    infected = 0
+    for start in range(0, len(stale), batch_size):
+        batch = stale[start : start + batch_size]
+        streams = [open_blob(blob) for blob in batch]
+        try:
+            results = scanner.scan_many(streams)
+        finally:
+            for stream in streams:
+                stream.close()
+        for blob, (status, virus_name) in zip(batch, results):
+            record_scan(blob, status, virus_name, signature)
+            if blob.scan_status != "INFECTED":
+                continue
+            infected += 1
+            logger.warning(f"Blob {blob.sha256} is now detected as {virus_name}")
+            versions = list(blob.versions.select_related("document"))
+            for dv in versions:
+                log_event(
+                    "VIRUS_DETECTED",
                     document=dv.document,
                     version=dv,
-                    extra={"virus_scan": scan_result},
+                    extra={"virus_scan": blob.scan_result, "virus": virus_name},
                 )
-                logger.info(f"Virus scan passed for {dv.file.name}")
+            blob.versions.update(stage="QUARANTINED", stage_updated_at=timezone.now())
+            unindex_versions([dv.pk for dv in versions])
+            metrics.VIRUS_DETECTED.inc(len(versions))
+    logger.info(f"Rescanned {len(stale)} blobs, {infected} infected")
+    return len(stale)
 
-        except Exception as e:
-            logger.error(f"Clamd scan failed: {e}")
 
-        # OCR processing & Text extraction
-        text = ""
+@shared_task
+def abort_stale_uploads(max_age=None):
+    """abort multipart uploads that were never completed, S3 keeps their parts"""
+    max_age = max_age or getattr(settings, "DOCUMENT_UPLOAD_MAX_AGE", 24 * 60 * 60)
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    aborted = 0
+    for upload in MultipartUpload.objects.filter(
+        status="PENDING", created_at__lt=cutoff
+    ).iterator():
         try:
-            # For PDFs extract per page images/text via pdfplumber
-            if tmp.name.lower().endswith(".pdf") or key.lower().endswith(".pdf"):
-                with pdfplumber.open(tmp.name) as pdf:
-                    for page in pdf.pages:
-                        page_text = page.extract_text() or ""
-                        text += page_text + "\n"
-                    # If extracted text is empty, run OCR on page images
-                    if not text.strip():
-                        for page in pdf.pages:
-                            im = page.to_image(resolution=300).original
-                            page_ocr = pytesseract.image_to_string(im)
-                            text += page_ocr + "\n"
-            else:
-                # try reading file bytes and run OCR if image; or python-docx for docx
-                if key.lower().endswith(".docx"):
-                    import docx
-
-                    doc = docx.Document(tmp.name)
-                    for p in doc.paragraphs:
-                        text += p.text + "\n"
-                else:
-                    # try read as plain text
-                    try:
-                        with open(tmp.name, "r", encoding="utf-8") as f:
-                            text = f.read()
-                    except Exception:
-                        # fallback: try OCR (if it is an image)
-                        try:
-                            im = Image.open(tmp.name)
-                            text = pytesseract.image_to_string(im)
-                        except:
-                            text = ""
+            abort_multipart_upload(upload)
+            aborted += 1
         except Exception as e:
-            text += f"\n\n[OCR error: {e}]"
+            logger.error(f"Could not abort upload {upload.upload_id}: {e}")
+    logger.info(f"Aborted {aborted} stale multipart uploads")
+    return aborted
 
-        dv.ocr_text = text
-        dv.save()
 
-        # indexing to elasticsearch
-        """
-        try:
-            from .search import (
-                index_document_version,
-            )  # you can implement this using django-elasticsearch-dsl
+@shared_task
+def archive_audit_log(retention_months=None):
+    """move audit months past the retention period to compressed files"""
+    archives = audit.archive_audit_log(retention_months)
+    return [archive.key for archive in archives]
 
-            index_document_version(dv.id)
-        except Exception:
-            pass
 
-        return True
-        """
-    except DocumentVersion.DoesNotExist:
-        # if the document doesn't exist
-        logger.error(f"DocumentVersion {version_id} not found")
-        return False
-    finally:
-        # cleanup temp file, even if task fails or retries
-        if tmp and os.path.exists(tmp.name):
-            try:
-                os.unlink(tmp.name)
-                logger.debug(f"Cleaned up temp file: {tmp.name}")
-            except Exception as e:
-                logger.error(f"Failed to cleanup temp file: {e}")
+@shared_task
+def index_pending_versions(batch_size=None):
+    """index extracted versions that are not in the search index yet"""
+    batch_size = batch_size or getattr(settings, "DOCUMENT_INDEX_BATCH_SIZE", 500)
+    pending = (
+        DocumentVersion.objects.filter(indexed=False)
+        .exclude(stage="QUARANTINED")
+        .filter(Exists(DocumentPage.objects.filter(version=OuterRef("pk"))))
+        .order_by("pk")
+        .values_list("pk", flat=True)[:batch_size]
+    )
+    indexed = 0
+    for version_id in list(pending):
+        try:
+            index_document_version(version_id)
+            indexed += 1
+        except Exception as e:
+            logger.error(f"Indexing failed for version {version_id}: {e}")
+    logger.info(f"Indexed {indexed} pending versions")
+    return indexed
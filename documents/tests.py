@@ -1,3 +1,1628 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+from contextlib import closing
+from importlib import import_module
+from datetime import date, datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection
+from django.core.cache import caches
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from celery.exceptions import Retry
+from celery.signals import worker_init, worker_process_init
+from PIL import Image
+from rest_framework.test import APIClient
+
+from benchmarks import corpus
+from benchmarks.stubs import EICAR, FakeScanner
+from doc_vault.celery import app
+from . import extractors, previews, scheduling, storage, tasks, warmup
+from .audit import (
+    AuditWriter,
+    archive_audit_log,
+    archive_audit_month,
+    get_audit_writer,
+    log_event,
+    month_start,
+    reset_audit_writer,
+)
+from .blobs import blob_key, collect_unreferenced_blobs
+from .cache import get_document_cache
+from .models import (
+    AuditLog,
+    Blob,
+    BlobChunk,
+    ContentChunk,
+    Document,
+    DocumentPage,
+    DocumentVersion,
+    MultipartUpload,
+    PagePreview,
+    SharedDocument,
+    Tag,
+)
+from .chunking import (
+    chunk_blob,
+    collect_unreferenced_chunks,
+    open_blob,
+    restore_blob,
+)
+from .scanner import ClamdConnection, ScanLimitError, ScannerError, reset_scanner
+from .search import get_backend
+from .sinks import PageTableSink, TextSink, drain
+from .storage import MIN_PART_SIZE, InMemoryStorage, NoSuchUpload, get_storage
+from .utils import get_download_url_cache
+
+User = get_user_model()
+
+
+@override_settings(
+    DOCUMENT_STORAGE_BACKEND="documents.storage.InMemoryStorage",
+    DOCUMENT_SCANNER_BACKEND="benchmarks.stubs.FakeScanner",
+    DOCUMENT_INTERACTIVE_RATE=0,
+    DOCUMENT_PREVIEW_PAGES=0,
+    DOCUMENT_OCR_CONCURRENCY=2,
+    AUDIT_LOG_FLUSH_INTERVAL=0,
+)
+class PipelineTestCase(TestCase):
+    """
+    runs the pipeline inline, with in-memory storage and the benchmark
+    scanner stand-in
+    """
+
+    def setUp(self):
+        for reset in (get_storage.cache_clear, reset_scanner, reset_audit_writer):
+            reset()
+            self.addCleanup(reset)
+        caches["default"].clear()
+        get_document_cache().local.clear()
+        get_download_url_cache().clear()
+        eager = app.conf.task_always_eager, app.conf.task_eager_propagates
+        app.conf.task_always_eager = app.conf.task_eager_propagates = True
+        self.addCleanup(
+            app.conf.update, task_always_eager=eager[0], task_eager_propagates=eager[1]
+        )
+        self.user = User.objects.create_user(username="owner", password="pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @property
+    def storage(self):
+        return get_storage()
+
+    def upload(self, data, name="file.pdf", user=None, process=True):
+        """a document with `data` as its first version, processed inline"""
+        doc = Document.objects.create(title=name, owner=user or self.user)
+        return self.add_version(doc, data, name, process)
+
+    def add_version(self, doc, data, name="file.pdf", process=True):
+        """a new latest version of `doc`"""
+        number = doc.versions.count() + 1
+        key = f"document/{doc.id}/v{number}/{name}"
+        dv = DocumentVersion.objects.create(
+            document=doc, file=key, version_number=number, uploaded_by=doc.owner
+        )
+        doc.latest_version = dv
+        doc.save()
+        self.storage.save(key, data)
+        if process:
+            tasks.process_document_version(dv.pk)
+            dv.refresh_from_db()
+        return dv
+
+
+def scanned_pdf(pages=2):
+    """pdf of page images, enough ink on them not to be skipped as blank"""
+    return corpus.scanned_pdf([["scanned page line of text"] * 30] * pages)
+
+
+def ocr_stub(text):
+    """pytesseract.image_to_string answering `text` for every page"""
+    return mock.patch("pytesseract.image_to_string", return_value=text)
+
+
+class DocumentListTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="owner", password="pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.tags = [Tag.objects.create(name=f"tag-{i}") for i in range(3)]
+
+    def create_documents(self, count, versions=3):
+        for i in range(count):
+            doc = Document.objects.create(title=f"doc {i}", owner=self.user)
+            for number in range(1, versions + 1):
+                dv = DocumentVersion.objects.create(
+                    document=doc,
+                    file=f"document/{doc.id}/v{number}/file.pdf",
+                    version_number=number,
+                    uploaded_by=self.user,
+                )
+            doc.latest_version = dv
+            doc.save()
+            doc.tags.set(self.tags)
+
+    def test_list_query_count_is_constant(self):
+        self.create_documents(5)
+        # documents joined with owner and latest version + tags prefetch
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/v1/documents/")
+        self.assertEqual(len(response.json()["results"]), 5)
+
+        self.create_documents(25)
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/v1/documents/")
+        self.assertEqual(len(response.json()["results"]), 30)
+
+    def test_list_returns_latest_version_only(self):
+        self.create_documents(1)
+        result = self.client.get("/api/v1/documents/").json()["results"][0]
+        self.assertEqual(result["latest_version"]["version_number"], 3)
+        self.assertNotIn("versions", result)
+        self.assertEqual(result["owner"], "owner")
+        self.assertEqual(len(result["tags"]), 3)
+
+    def test_list_is_paginated(self):
+        self.create_documents(7, versions=1)
+        first = self.client.get("/api/v1/documents/?page_size=5").json()
+        self.assertEqual(len(first["results"]), 5)
+        second = self.client.get(first["next"]).json()
+        self.assertEqual(len(second["results"]), 2)
+        self.assertIsNone(second["next"])
+
+    def test_list_only_includes_own_documents(self):
+        other = User.objects.create_user(username="other", password="pass")
+        Document.objects.create(title="not mine", owner=other)
+        self.create_documents(1, versions=1)
+        results = self.client.get("/api/v1/documents/").json()["results"]
+        self.assertEqual([r["title"] for r in results], ["doc 0"])
+
+
+class DocumentCacheTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.doc = Document.objects.create(title="cached", owner=self.user)
+        self.url = f"/api/v1/documents/{self.doc.pk}/"
+
+    def retrieve(self, client=None):
+        return (client or self.client).get(self.url)
+
+    def test_hot_document_is_served_without_queries(self):
+        first = self.retrieve().json()
+        with self.assertNumQueries(0):
+            response = self.retrieve()
+        self.assertEqual(response.json(), first)
+
+        # the per-process tier expired, the shared cache still answers
+        get_document_cache().local.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.retrieve().json(), first)
+
+    def test_changes_invalidate_the_cached_document(self):
+        self.retrieve()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.doc.title = "renamed"
+            self.doc.save()
+        self.assertEqual(self.retrieve().json()["title"], "renamed")
+
+        tag = Tag.objects.create(name="tag")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.doc.tags.add(tag)
+        self.assertEqual([t["name"] for t in self.retrieve().json()["tags"]], ["tag"])
+        with self.captureOnCommitCallbacks(execute=True):
+            tag.name = "retagged"
+            tag.save()
+        self.assertEqual(
+            [t["name"] for t in self.retrieve().json()["tags"]], ["retagged"]
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_version(self.doc, b"text", process=False)
+        self.assertEqual(len(self.retrieve().json()["versions"]), 1)
+
+    def test_shares_invalidate_the_cached_permission(self):
+        other = User.objects.create_user(username="other", password="pass")
+        client = APIClient()
+        client.force_authenticate(other)
+        self.assertEqual(self.retrieve(client).status_code, 404)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            share = SharedDocument.objects.create(document=self.doc, user=other)
+        self.assertEqual(self.retrieve(client).status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.retrieve(client).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            share.delete()
+        self.assertEqual(self.retrieve(client).status_code, 404)
+
+    def test_deleted_document_is_not_served(self):
+        self.retrieve()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.doc.delete()
+        self.assertEqual(self.retrieve().status_code, 404)
+
+
+class OCRTests(PipelineTestCase):
+    def test_reprocessing_ocrs_pages_again(self):
+        data = scanned_pdf()
+        with ocr_stub("OLD OCR"):
+            dv = self.upload(data)
+        self.assertEqual(dv.stage, "DONE")
+        pages = DocumentPage.objects.filter(version=dv)
+        self.assertEqual(
+            list(pages.values_list("source", "text")), [("OCR", "OLD OCR")] * 2
+        )
+
+        with ocr_stub("NEW OCR") as image_to_string:
+            tasks.process_document_version(dv.pk)
+        self.assertEqual(image_to_string.call_count, 2)
+        self.assertEqual(list(pages.values_list("text", flat=True)), ["NEW OCR"] * 2)
+
+    def test_retry_reuses_checkpointed_pages(self):
+        data = scanned_pdf()
+        with ocr_stub("OCR"):
+            dv = self.upload(data)
+        DocumentPage.objects.filter(version=dv, page_number=2).delete()
+        DocumentVersion.objects.filter(pk=dv.pk).update(stage="EXTRACT")
+
+        with ocr_stub("RETRIED") as image_to_string:
+            tasks.process_document_version(dv.pk, resume=True)
+        self.assertEqual(image_to_string.call_count, 1)
+        self.assertEqual(
+            list(
+                DocumentPage.objects.filter(version=dv).values_list("text", flat=True)
+            ),
+            ["OCR", "RETRIED"],
+        )
+
+    def test_ocr_streams_with_bounded_look_ahead(self):
+        data = scanned_pdf(pages=8)
+        dv = self.upload(data, process=False)
+        classify = mock.patch.object(
+            extractors, "classify_page", wraps=extractors.classify_page
+        )
+        with ocr_stub("OCR") as image_to_string, classify as classified:
+            chunks = extractors.iter_pdf_chunks(dv, io.BytesIO(data))
+            first = next(chunks)
+            # OCR runs while pages are classified, not after the last one
+            self.assertEqual(first, extractors.Chunk(1, "OCR", "OCR"))
+            self.assertLessEqual(classified.call_count, 1 + 2 * 2)
+            rest = list(chunks)
+        self.assertEqual([chunk.page_number for chunk in rest], list(range(2, 9)))
+        self.assertEqual(image_to_string.call_count, 8)
+
+
+class SinkTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dv = self.upload(b"text", name="a.txt", process=False)
+        self.pages = DocumentPage.objects.filter(version=self.dv)
+        DocumentPage.objects.bulk_create(
+            DocumentPage(version=self.dv, page_number=n, text="old", source="TEXT")
+            for n in range(1, 6)
+        )
+
+    def chunks(self, count, fail=False):
+        for n in range(1, count + 1):
+            yield extractors.Chunk(n, f"page {n}", "OCR")
+        if fail:
+            raise ValueError("extraction failed")
+
+    def test_pages_are_replaced_in_batches(self):
+        sink = PageTableSink(self.dv, batch_size=2)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(drain(self.chunks(3), [sink]), 3)
+        # two batches, and the stale pages beyond the last one
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(
+            list(self.pages.values_list("page_number", "text", "source")),
+            [(n, f"page {n}", "OCR") for n in range(1, 4)],
+        )
+
+    def test_failed_extraction_keeps_later_pages(self):
+        other = mock.Mock(spec=TextSink)
+        with self.assertRaises(ValueError):
+            drain(self.chunks(2, fail=True), [PageTableSink(self.dv), other])
+        # what was extracted is flushed, nothing is deleted
+        self.assertEqual(
+            list(self.pages.values_list("text", flat=True)),
+            ["page 1", "page 2", "old", "old", "old"],
+        )
+        other.open.assert_called_once_with()
+        self.assertEqual(other.write.call_count, 2)
+        error = other.close.call_args.kwargs["error"]
+        self.assertIsInstance(error, ValueError)
+
+    def test_close_errors_are_logged(self):
+        broken = mock.Mock(spec=TextSink)
+        broken.close.side_effect = DatabaseError("gone")
+        sink = PageTableSink(self.dv)
+        with self.assertLogs("documents.sinks", "ERROR"):
+            self.assertEqual(drain(self.chunks(1), [broken, sink]), 1)
+        # the other sinks are closed all the same
+        self.assertEqual(list(self.pages.values_list("text", flat=True)), ["page 1"])
+
+
+class BlobTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create_user(username="other", password="pass")
+
+    def read(self, blob):
+        with closing(open_blob(blob)) as body:
+            return body.read()
+
+    def test_duplicates_share_a_content_addressed_blob(self):
+        first = self.upload(b"same bytes", name="a.txt")
+        second = self.upload(b"same bytes", name="b.txt", user=self.other)
+        blob = Blob.objects.get()
+        self.assertEqual((first.blob_id, second.blob_id), (blob.pk, blob.pk))
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(blob.key, blob_key(blob.sha256))
+        self.assertEqual(blob.scan_status, "CLEAN")
+        self.assertEqual(first.storage_key, blob.key)
+        # only the blob is stored, uploads are moved out of the client's reach
+        self.assertEqual(list(self.storage.objects), [blob.key])
+
+    def test_upload_key_cannot_rewrite_shared_content(self):
+        first = self.upload(b"original", name="a.txt")
+        second = self.upload(b"original", name="b.txt", user=self.other)
+        # the first uploader's presigned POST is still valid
+        self.storage.save(first.file.name, b"tampered")
+        for dv in (first, second):
+            dv.refresh_from_db()
+            self.assertEqual(self.read(dv.blob), b"original")
+
+    def test_retried_scan_does_not_count_twice(self):
+        dv = self.upload(b"content", name="a.txt")
+        DocumentVersion.objects.filter(pk=dv.pk).update(stage="SCAN")
+        tasks.scan_version(dv.pk)
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+    def test_reprocessing_reads_the_blob(self):
+        dv = self.upload(b"content", name="a.txt")
+        tasks.process_document_version(dv.pk)
+        dv.refresh_from_db()
+        self.assertEqual(dv.stage, "DONE")
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+    def test_legacy_blob_is_moved_to_its_blob_key(self):
+        dv = self.upload(b"legacy", name="a.txt")
+        blob = Blob.objects.get()
+        # stored at the first upload's key, as before blob keys
+        self.storage.copy(blob.key, dv.file.name)
+        self.storage.delete(blob.key)
+        Blob.objects.filter(pk=blob.pk).update(key=dv.file.name)
+        self.upload(b"legacy", name="b.txt", user=self.other)
+        blob.refresh_from_db()
+        self.assertEqual(blob.key, blob_key(blob.sha256))
+        self.assertEqual(list(self.storage.objects), [blob.key])
+
+    def test_unreferenced_blobs_are_collected(self):
+        first = self.upload(b"shared", name="a.txt")
+        self.upload(b"shared", name="b.txt", user=self.other)
+        kept = self.upload(b"kept", name="c.txt")
+        shared = Blob.objects.get(pk=first.blob_id)
+
+        first.document.delete()
+        shared.refresh_from_db()
+        self.assertEqual(shared.ref_count, 1)
+        self.assertEqual(collect_unreferenced_blobs(self.storage.delete, timedelta()), 0)
+
+        Document.objects.filter(owner=self.other).delete()
+        shared.refresh_from_db()
+        self.assertEqual(shared.ref_count, 0)
+        # within the grace period the blob may be referenced again
+        self.assertEqual(
+            collect_unreferenced_blobs(self.storage.delete, timedelta(hours=1)), 0
+        )
+        self.assertEqual(collect_unreferenced_blobs(self.storage.delete, timedelta()), 1)
+        self.assertFalse(Blob.objects.filter(pk=shared.pk).exists())
+        self.assertEqual(list(self.storage.objects), [kept.blob.key])
+
+
+class ErrorScanner(FakeScanner):
+    """clamd answering every scan with an error"""
+
+    reply = "stream: Can't allocate memory ERROR"
+    calls = 0
+
+    def scan(self, stream):
+        ErrorScanner.calls += 1
+        stream.read()
+        return "ERROR", self.reply
+
+
+class SizeLimitScanner(ErrorScanner):
+    reply = "INSTREAM size limit exceeded. ERROR"
+
+
+class ScanTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        ErrorScanner.calls = 0
+
+    @override_settings(DOCUMENT_SCANNER_BACKEND="documents.tests.ErrorScanner")
+    def test_scan_error_is_retried_and_not_extracted(self):
+        with self.assertRaises(Retry) as raised:
+            self.upload(b"content", name="a.txt")
+        self.assertIsInstance(raised.exception.exc, ScannerError)
+        dv = DocumentVersion.objects.get()
+        self.assertEqual(dv.stage, "SCAN")
+        self.assertNotEqual(Blob.objects.get().scan_status, "CLEAN")
+        self.assertFalse(DocumentPage.objects.exists())
+
+    @override_settings(DOCUMENT_SCANNER_BACKEND="documents.tests.SizeLimitScanner")
+    def test_size_limit_stops_the_version_without_retries(self):
+        dv = self.upload(b"content", name="a.txt")
+        self.assertEqual(ErrorScanner.calls, 1)
+        self.assertEqual(dv.stage, "SCAN")
+        self.assertIn("ScanLimitError", dv.stage_error)
+        self.assertFalse(DocumentPage.objects.exists())
+
+    def test_stream_above_max_length_is_not_sent(self):
+        connection = ClamdConnection.__new__(ClamdConnection)
+        connection.sock = mock.Mock()
+        with self.assertRaises(ScanLimitError):
+            connection.send_stream(io.BytesIO(b"x" * 10), 4, max_length=8)
+        # the command and the first two chunks only
+        self.assertEqual(connection.sock.sendall.call_count, 3)
+
+
+class SearchTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        get_backend.cache_clear()
+        self.addCleanup(get_backend.cache_clear)
+
+    def search(self, query):
+        response = self.client.get("/api/v1/documents/search/", {"q": query})
+        self.assertEqual(response.status_code, 200)
+        return response.json()["results"]
+
+    def check_highlight_is_escaped(self):
+        dv = self.upload(
+            b"invoice <img src=x onerror=alert(1)> total \x02<script>", name="a.txt"
+        )
+        other = User.objects.create_user(username="other", password="pass")
+        self.upload(b"invoice of someone else", name="b.txt", user=other)
+
+        [hit] = self.search("invoice")
+        self.assertEqual(hit["version_id"], dv.pk)
+        self.assertIn("<mark>invoice</mark>", hit["highlight"])
+        self.assertIn("&lt;img src=x onerror=alert(1)&gt;", hit["highlight"])
+        self.assertIn("&lt;script&gt;", hit["highlight"])
+        self.assertNotIn("<img", hit["highlight"])
+        self.assertNotIn("\x02", hit["highlight"])
+
+    def test_quarantined_versions_are_not_searched(self):
+        dv = self.upload(b"invoice total", name="a.txt")
+        self.assertEqual(len(self.search("invoice")), 1)
+
+        # newer signatures detect the content
+        with (
+            mock.patch.object(FakeScanner, "signature_version", return_value="new"),
+            mock.patch.object(FakeScanner, "scan", return_value=("FOUND", "Virus")),
+        ):
+            tasks.rescan_stale_blobs()
+        dv.refresh_from_db()
+        self.assertEqual((dv.stage, dv.indexed), ("QUARANTINED", False))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*) FROM documents_search WHERE version_id = %s", [dv.pk]
+            )
+            self.assertEqual(cursor.fetchone(), (0,))
+        self.assertEqual(self.search("invoice"), [])
+        # and they are not indexed again
+        tasks.index_pending_versions()
+        self.assertEqual(self.search("invoice"), [])
+
+    def test_fts_highlight_is_escaped(self):
+        self.check_highlight_is_escaped()
+
+    @override_settings(
+        DOCUMENT_SEARCH_BACKEND="documents.search.DatabaseSearchBackend"
+    )
+    def test_database_highlight_is_escaped(self):
+        self.check_highlight_is_escaped()
+
+
+class DownloadTests(PipelineTestCase):
+    def download(self, dv):
+        return self.client.get(
+            f"/api/v1/documents/{dv.document_id}/download/", {"version_id": dv.pk}
+        )
+
+    def async_download(self, dv):
+        client = Client()
+        client.force_login(self.user)
+        return client.get(
+            f"/api/v1/async/documents/{dv.document_id}/download/",
+            {"version_id": dv.pk},
+        )
+
+    def presign(self, *versions):
+        return self.client.post(
+            "/api/v1/documents/presign_downloads/",
+            {"version_ids": [dv.pk for dv in versions]},
+            format="json",
+        ).json()
+
+    def test_unscanned_version_is_not_served(self):
+        pending = self.upload(b"not scanned", name="a.txt", process=False)
+        DocumentVersion.objects.filter(pk=pending.pk).update(stage="SCAN")
+        done = self.upload(b"scanned", name="b.txt")
+        self.assertEqual(self.download(pending).status_code, 409)
+        self.assertEqual(self.async_download(pending).status_code, 409)
+        self.assertEqual(self.download(done).status_code, 200)
+        self.assertEqual(self.async_download(done).status_code, 200)
+
+        result = self.presign(pending, done)
+        self.assertEqual(list(result["urls"]), [str(done.pk)])
+        self.assertEqual(result["unavailable"], [pending.pk])
+
+    def test_quarantined_version_is_not_served(self):
+        dv = self.upload(EICAR, name="eicar.txt")
+        self.assertEqual(dv.stage, "QUARANTINED")
+        self.assertEqual(self.download(dv).status_code, 409)
+        self.assertEqual(self.async_download(dv).status_code, 409)
+        self.assertEqual(self.presign(dv)["unavailable"], [dv.pk])
+
+    def test_invalid_version_id_is_rejected(self):
+        dv = self.upload(b"text", name="a.txt")
+        for action in ("download", "text", "preview"):
+            for version_id in ("abc", "1.5", "-1", "\u00b2", "9" * 20):
+                response = self.client.get(
+                    f"/api/v1/documents/{dv.document_id}/{action}/",
+                    {"version_id": version_id},
+                )
+                self.assertEqual(response.status_code, 400, (action, version_id))
+            response = self.client.get(
+                f"/api/v1/documents/{dv.document_id}/{action}/",
+                {"version_id": 999999},
+            )
+            self.assertEqual(response.status_code, 404, action)
+        client = Client()
+        client.force_login(self.user)
+        response = client.get(
+            f"/api/v1/async/documents/{dv.document_id}/download/",
+            {"version_id": "abc"},
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_document_id_is_not_found(self):
+        for action in ("download", "diff", "text", "preview"):
+            for pk in ("abc", "9" * 20):
+                response = self.client.get(f"/api/v1/documents/{pk}/{action}/")
+                self.assertEqual(response.status_code, 404, (action, pk))
+        response = self.client.post(
+            "/api/v1/documents/abc/complete_upload/", {"version_id": 1}, format="json"
+        )
+        self.assertEqual(response.status_code, 404)
+
+        dv = self.upload(b"text", name="a.txt", process=False)
+        for version_id in ("abc", [1], True, None):
+            response = self.client.post(
+                f"/api/v1/documents/{dv.document_id}/complete_upload/",
+                {"version_id": version_id},
+                format="json",
+            )
+            self.assertEqual(response.status_code, 400, version_id)
+
+    def test_archived_content_is_restored_by_a_task(self):
+        data = b"old revision " * 1000
+        old = self.upload(data, name="a.txt")
+        self.add_version(old.document, b"new revision", name="a.txt")
+        blob = Blob.objects.get(pk=old.blob_id)
+        chunk_blob(blob)
+        self.assertNotIn(blob.key, self.storage.objects)
+
+        with mock.patch.object(tasks.restore_chunked_blob, "delay") as delay:
+            response = self.download(old)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response["Retry-After"], "5")
+            self.assertEqual(self.async_download(old).status_code, 202)
+            self.assertEqual(self.presign(old)["restoring"], [old.pk])
+        # queued once, nothing is reassembled in the requests
+        delay.assert_called_once_with(blob.pk)
+        self.assertNotIn(blob.key, self.storage.objects)
+
+        tasks.restore_chunked_blob(blob.pk)
+        self.assertEqual(self.download(old).status_code, 200)
+        blob.refresh_from_db()
+        self.assertFalse(blob.chunked)
+        with closing(self.storage.open(blob.key)) as body:
+            self.assertEqual(body.read(), data)
+
+
+@override_settings(DOCUMENT_PREVIEW_PAGES=2, DOCUMENT_PREVIEW_SIZES=(100, 200))
+class PreviewTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.cache = previews.DiskLRUCache(root.name, 1024 * 1024)
+        patcher = mock.patch("documents.previews._preview_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pdf(self, pages=3, **kwargs):
+        return self.upload(
+            corpus.text_pdf([[f"page {n}"] for n in range(pages)]), **kwargs
+        )
+
+    def preview(self, dv, **params):
+        return self.client.get(
+            f"/api/v1/documents/{dv.document_id}/preview/",
+            {"version_id": dv.pk, **params},
+        )
+
+    @override_settings(DOCUMENT_PREVIEW_PAGES=3, DOCUMENT_PREVIEW_SIZES=(200, 50))
+    def test_preview_plan(self):
+        self.assertEqual(
+            previews.preview_plan(), {1: (50, 200), 2: (50,), 3: (50,)}
+        )
+        with self.settings(DOCUMENT_PREVIEW_PAGES=0):
+            self.assertEqual(previews.preview_plan(), {})
+
+    def test_first_pages_are_rendered_while_processing(self):
+        dv = self.pdf()
+        stored = PagePreview.objects.filter(blob=dv.blob).order_by(
+            "page_number", "size"
+        )
+        self.assertEqual(
+            [(p.page_number, p.size, p.width, p.height) for p in stored],
+            [(1, 100, 71, 100), (1, 200, 142, 200), (2, 100, 71, 100)],
+        )
+        for preview in stored:
+            # jpeg
+            self.assertEqual(self.storage.objects[preview.key][:2], b"\xff\xd8")
+
+        # shared by duplicates, not rendered again
+        with mock.patch("documents.previews.iter_renders") as iter_renders:
+            self.pdf()
+        iter_renders.assert_not_called()
+        self.assertEqual(PagePreview.objects.count(), 3)
+
+        response = self.preview(dv, page=1, size=200)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], f"memory://{stored[1].key}")
+
+    def test_other_pages_are_rendered_on_request(self):
+        dv = self.pdf()
+        response = self.preview(dv, page=3, size=200)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        with Image.open(io.BytesIO(response.content)) as image:
+            self.assertEqual(image.size, (142, 200))
+        self.assertFalse(PagePreview.objects.filter(page_number=3).exists())
+
+        # served from the disk cache afterwards
+        with mock.patch("documents.previews.iter_renders") as iter_renders:
+            again = self.preview(dv, page=3, size=200)
+        iter_renders.assert_not_called()
+        self.assertEqual(again.content, response.content)
+
+    def test_invalid_requests(self):
+        dv = self.pdf()
+        for params in ({"page": 0}, {"page": "x"}, {"size": 150}, {"size": "x"}):
+            self.assertEqual(self.preview(dv, **params).status_code, 400, params)
+        # past the last page, and files without previews
+        self.assertEqual(self.preview(dv, page=4).status_code, 404)
+        text = self.upload(b"text", name="a.txt")
+        self.assertEqual(self.preview(text).status_code, 404)
+        other = User.objects.create_user(username="other", password="pass")
+        self.assertEqual(self.preview(self.pdf(user=other)).status_code, 404)
+
+        pending = self.pdf(process=False)
+        self.assertEqual(self.preview(pending).status_code, 409)
+
+    def test_disk_cache_evicts_least_recently_used(self):
+        cache = previews.DiskLRUCache(self.cache.root / "lru", max_size=100)
+        cache.set("a", b"a" * 40)
+        cache.set("b", b"b" * 40)
+        os.utime(cache.path("a"), (1000, 1000))
+        os.utime(cache.path("b"), (2000, 2000))
+        # reading refreshes an entry
+        self.assertEqual(cache.get("a"), b"a" * 40)
+        cache.set("c", b"c" * 40)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (b"a" * 40, b"c" * 40))
+        self.assertEqual(cache.size, 80)
+
+
+class MigrationTests(PipelineTestCase):
+    def test_legacy_versions_leave_pending(self):
+        migration = import_module("documents.migrations.0015_legacy_version_stages")
+        clean = self.upload(b"clean", name="a.txt")
+        infected = self.upload(EICAR, name="eicar.txt")
+        unprocessed = self.upload(b"never processed", name="b.txt", process=False)
+        DocumentVersion.objects.update(stage="PENDING")
+
+        migration.set_legacy_stages(apps, None)
+        stages = dict(DocumentVersion.objects.values_list("pk", "stage"))
+        self.assertEqual(
+            stages,
+            {clean.pk: "DONE", infected.pk: "QUARANTINED", unprocessed.pk: "PENDING"},
+        )
+
+
+class ReprocessTests(PipelineTestCase):
+    def reprocess(self, *args):
+        call_command("reprocess_versions", *args, stdout=io.StringIO())
+
+    def test_versions_are_processed_again_as_bulk_work(self):
+        done = [self.upload(b"content %d" % i, name="a.txt") for i in range(2)]
+        missing = self.upload(b"gone", name="b.txt")
+        self.storage.delete(missing.blob.key)
+        pending = self.upload(b"not uploaded", name="c.txt", process=False)
+
+        with mock.patch.object(tasks.fetch_version, "apply_async") as fetch:
+            self.reprocess("--max-queue-depth", "0")
+        # admitted one message per version on the bulk queue
+        self.assertEqual(
+            [call.kwargs["queue"] for call in fetch.call_args_list],
+            ["documents.fetch.bulk"] * 3,
+        )
+        self.assertEqual(
+            sorted(call.args[0][0] for call in fetch.call_args_list),
+            sorted(dv.pk for dv in done + [missing]),
+        )
+        versions = DocumentVersion.objects.exclude(pk=pending.pk)
+        self.assertEqual(
+            set(versions.values_list("stage", "priority")), {("FETCH", "BULK")}
+        )
+        pending.refresh_from_db()
+        self.assertEqual(pending.stage, "PENDING")
+
+        # each version runs and retries on its own
+        with self.assertRaises(FileNotFoundError):
+            tasks.fetch_version(missing.pk)
+        for dv in done:
+            tasks.fetch_version(dv.pk)
+            dv.refresh_from_db()
+            self.assertEqual(dv.stage, "DONE")
+
+    def test_reindexing_sends_a_task_per_version(self):
+        versions = [self.upload(b"content %d" % i, name="a.txt") for i in range(3)]
+        with mock.patch.object(tasks.index_version, "apply_async") as index:
+            self.reprocess(
+                "--task", "index", "--batch-size", "2", "--max-queue-depth", "0"
+            )
+        self.assertEqual(
+            index.call_args_list,
+            [mock.call((dv.pk,), queue="documents.index.bulk") for dv in versions],
+        )
+
+    def test_diff_is_computed_again_after_reprocessing(self):
+        old = self.upload(b"one\ntwo", name="a.txt")
+        new = self.add_version(old.document, b"one\nthree", name="a.txt")
+        url = f"/api/v1/documents/{old.document_id}/diff/"
+        self.assertEqual(self.client.get(url).json()["added"], 1)
+
+        # the same pair of contents in another document shares the entry
+        copy = self.upload(b"one\ntwo", name="b.txt")
+        self.add_version(copy.document, b"one\nthree", name="b.txt")
+        with mock.patch("documents.diff.diff_lines") as diff_lines:
+            self.client.get(f"/api/v1/documents/{copy.document_id}/diff/")
+        diff_lines.assert_not_called()
+
+        # an improved extractor finds more text in the same content
+        chunk = extractors.Chunk(1, "one\nthree\nfour", "TEXT")
+        extracted = mock.Mock(return_value=iter([chunk]))
+        with mock.patch.object(tasks, "extract_chunks", extracted):
+            scheduling.queue_bulk([new.pk])
+        self.assertEqual(self.client.get(url).json()["added"], 2)
+
+
+class PostOnlyStorage(InMemoryStorage):
+    """a backend without multipart uploads"""
+
+    supports_multipart = False
+
+
+@override_settings(DOCUMENT_UPLOAD_PART_SIZE=MIN_PART_SIZE)
+class MultipartUploadTests(PipelineTestCase):
+    def post(self, path, data):
+        return self.client.post(f"/api/v1/documents/{path}", data, format="json")
+
+    def check_upload_flow(self):
+        get_storage.cache_clear()
+        parts = [b"a" * MIN_PART_SIZE, b"b" * 1024]
+        data = b"".join(parts)
+        started = self.post(
+            "initiate_upload/",
+            {"title": "big", "filename": "big.txt", "file_size": len(data)},
+        )
+        self.assertEqual(started.status_code, 201)
+        started = started.json()
+        self.assertEqual(
+            (started["part_size"], started["part_count"]), (MIN_PART_SIZE, 2)
+        )
+        doc_id, version = started["document_id"], started["version_id"]
+        upload = MultipartUpload.objects.get(version_id=version)
+
+        signed = self.post(f"{doc_id}/presign_parts/", {"version_id": version}).json()
+        self.assertEqual(sorted(signed["urls"]), ["1", "2"])
+        etag = self.storage.upload_part(upload.key, upload.upload_id, 1, parts[0])
+        # resuming signs the missing part only
+        signed = self.post(f"{doc_id}/presign_parts/", {"version_id": version}).json()
+        self.assertEqual(list(signed["urls"]), ["2"])
+        self.assertEqual(signed["uploaded"][0]["etag"], etag)
+        etags = [
+            {"part_number": 1, "etag": f'"{etag}"'},
+            {
+                "part_number": 2,
+                "etag": self.storage.upload_part(
+                    upload.key, upload.upload_id, 2, parts[1]
+                ),
+            },
+        ]
+
+        def complete(parts):
+            return self.post(
+                f"{doc_id}/complete_upload/",
+                {"version_id": version, "file_size": len(data), "parts": parts},
+            )
+
+        # every part has to be confirmed, with the etag it was stored with
+        for parts, error in (
+            (None, "parts must list"),
+            (etags[:1], "ETag missing for part 2"),
+            ([etags[0], {"part_number": 2, "etag": etag}], "ETag mismatch"),
+        ):
+            response = complete(parts)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(error, response.json()["error"])
+        response = complete(etags)
+        self.assertEqual(response.status_code, 200, response.content)
+        dv = DocumentVersion.objects.get(pk=version)
+        self.assertEqual(dv.stage, "DONE")
+        with closing(open_blob(dv.blob)) as body:
+            self.assertEqual(body.read(), data)
+
+    def test_in_memory_upload(self):
+        self.check_upload_flow()
+
+    def test_local_upload(self):
+        with tempfile.TemporaryDirectory() as root:
+            with self.settings(
+                DOCUMENT_STORAGE_BACKEND="documents.storage.LocalStorage",
+                DOCUMENT_STORAGE_ROOT=root,
+            ):
+                self.check_upload_flow()
+
+    def check_upload_gone(self):
+        get_storage.cache_clear()
+        started = self.post(
+            "initiate_upload/", {"title": "big", "filename": "big.txt", "file_size": 1}
+        ).json()
+        doc_id, version = started["document_id"], started["version_id"]
+        upload = MultipartUpload.objects.get(version_id=version)
+        # removed behind our back, by the bucket's lifecycle rule
+        get_storage().abort_multipart_upload(upload.key, upload.upload_id)
+        with self.assertRaises(NoSuchUpload):
+            get_storage().list_parts(upload.key, upload.upload_id)
+
+        response = self.post(f"{doc_id}/presign_parts/", {"version_id": version})
+        self.assertEqual(response.status_code, 409)
+        response = self.post(
+            f"{doc_id}/complete_upload/", {"version_id": version, "parts": []}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("upload is gone", response.json()["error"])
+
+    def test_in_memory_upload_gone(self):
+        self.check_upload_gone()
+
+    def test_local_upload_gone(self):
+        with tempfile.TemporaryDirectory() as root:
+            with self.settings(
+                DOCUMENT_STORAGE_BACKEND="documents.storage.LocalStorage",
+                DOCUMENT_STORAGE_ROOT=root,
+            ):
+                self.check_upload_gone()
+
+    def test_bulk_delete_aborts_uploads_once_committed(self):
+        get_storage.cache_clear()
+        started = self.post(
+            "initiate_upload/", {"title": "big", "filename": "big.txt", "file_size": 1}
+        ).json()
+        upload = MultipartUpload.objects.get(version_id=started["version_id"])
+        delete = {"document_ids": [started["document_id"]]}
+
+        # nothing is aborted when the delete fails
+        with (
+            mock.patch("documents.views.detach_blobs", side_effect=DatabaseError),
+            self.captureOnCommitCallbacks(execute=True),
+            self.assertRaises(DatabaseError),
+        ):
+            self.post("bulk_delete/", delete)
+        self.assertIn(upload.upload_id, self.storage.uploads)
+        upload.refresh_from_db()
+        self.assertEqual(upload.status, "PENDING")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post("bulk_delete/", delete)
+        self.assertEqual(response.json()["deleted"], [started["document_id"]])
+        self.assertNotIn(upload.upload_id, self.storage.uploads)
+        self.assertFalse(MultipartUpload.objects.exists())
+
+    @override_settings(DOCUMENT_STORAGE_BACKEND="documents.tests.PostOnlyStorage")
+    def test_storage_without_multipart(self):
+        response = self.post(
+            "initiate_upload/", {"title": "big", "filename": "big.txt", "file_size": 1}
+        )
+        self.assertEqual(response.status_code, 501)
+        self.assertFalse(Document.objects.exists())
+
+
+@override_settings(
+    DOCUMENT_CHUNK_MIN_SIZE=256,
+    DOCUMENT_CHUNK_AVG_SIZE=1024,
+    DOCUMENT_CHUNK_MAX_SIZE=4096,
+)
+class ChunkingTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(0)
+        self.old = rng.randbytes(64 * 1024)
+        # an edit in the middle, the revisions share most of their chunks
+        self.new = self.old[:30000] + b"edited" + self.old[30000:]
+        first = self.upload(self.old, name="a.bin")
+        second = self.add_version(first.document, self.new, name="a.bin")
+        self.add_version(first.document, b"latest", name="a.bin")
+        self.blobs = [Blob.objects.get(pk=dv.blob_id) for dv in (first, second)]
+
+    def read(self, blob):
+        with closing(open_blob(blob)) as body:
+            return body.read()
+
+    def test_chunked_revisions_share_chunks(self):
+        self.assertEqual(chunk_blob(self.blobs[0]), 0)
+        self.assertGreater(chunk_blob(self.blobs[1]), len(self.new) // 2)
+        stored = sum(ContentChunk.objects.values_list("size", flat=True))
+        self.assertLess(stored, len(self.old) * 1.5)
+        for blob, data in zip(self.blobs, (self.old, self.new)):
+            self.assertTrue(blob.chunked)
+            self.assertNotIn(blob.key, self.storage.objects)
+            self.assertEqual(self.read(blob), data)
+        self.assertIn("#0 @0", str(BlobChunk.objects.first()))
+
+    def test_restored_blob_is_stored_whole(self):
+        blob = self.blobs[0]
+        chunk_blob(blob)
+        restore_blob(blob)
+        blob.refresh_from_db()
+        self.assertFalse(blob.chunked)
+        with closing(self.storage.open(blob.key)) as body:
+            self.assertEqual(body.read(), self.old)
+        # still superseded, archived again from the manifest it kept
+        with mock.patch("documents.chunking.iter_content_chunks") as chunks:
+            self.assertEqual(chunk_blob(blob), len(self.old))
+        chunks.assert_not_called()
+        self.assertEqual(self.read(blob), self.old)
+
+    def test_restored_latest_blob_releases_its_chunks(self):
+        blob = self.blobs[0]
+        chunk_blob(blob)
+        version = blob.versions.get()
+        Document.objects.filter(pk=version.document_id).update(
+            latest_version=version
+        )
+        restore_blob(blob)
+        self.assertFalse(BlobChunk.objects.filter(blob=blob).exists())
+        self.assertFalse(ContentChunk.objects.filter(ref_count__gt=0).exists())
+        self.assertEqual(self.read(blob), self.old)
+
+    def test_unreferenced_chunks_are_collected(self):
+        for blob in self.blobs:
+            chunk_blob(blob)
+        self.blobs[0].versions.get().delete()
+        collect_unreferenced_blobs(self.storage.delete, timedelta())
+        # the chunks of the remaining revision are kept
+        self.assertEqual(collect_unreferenced_chunks(timedelta()), 1)
+        self.assertEqual(self.read(self.blobs[1]), self.new)
+
+        Document.objects.all().delete()
+        collect_unreferenced_blobs(self.storage.delete, timedelta())
+        remaining = ContentChunk.objects.count()
+        self.assertEqual(collect_unreferenced_chunks(timedelta()), remaining)
+        self.assertFalse(ContentChunk.objects.exists())
+        self.assertFalse(any(key.startswith("chunks/") for key in self.storage.objects))
+
+
+class SchedulingTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = 1000.0
+        patcher = mock.patch("documents.scheduling.time.time", lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tokens(self, count=10):
+        return [scheduling.take_token(self.user.pk) for _ in range(count)]
+
+    def queue(self, owner, count, stage="QUEUED"):
+        doc = Document.objects.create(title="bulk", owner=owner)
+        start = timezone.now() - timedelta(hours=1)
+        return [
+            DocumentVersion.objects.create(
+                document=doc,
+                file=f"document/{doc.pk}/v{n}/file.txt",
+                version_number=n,
+                stage=stage,
+                priority="BULK",
+                submitted_at=start + timedelta(seconds=n),
+            )
+            for n in range(1, count + 1)
+        ]
+
+    def admit(self):
+        with mock.patch("documents.tasks.advance_stage") as advance_stage:
+            scheduling.admit_queued_versions()
+        return [call.args[0].pk for call in advance_stage.call_args_list]
+
+    @override_settings(DOCUMENT_INTERACTIVE_RATE=60, DOCUMENT_INTERACTIVE_BURST=3)
+    def test_interactive_burst_and_refill(self):
+        self.assertEqual(self.tokens(4), [True, True, True, False])
+        self.clock += 1
+        self.assertEqual(self.tokens(2), [True, False])
+        # refilled up to the burst, not beyond
+        self.clock += 60
+        self.assertEqual(self.tokens(4), [True, True, True, False])
+        # owners have their own bucket
+        self.assertTrue(scheduling.take_token(self.user.pk + 1))
+
+    @override_settings(DOCUMENT_INTERACTIVE_RATE=0)
+    def test_zero_rate_is_unlimited(self):
+        self.assertEqual(self.tokens(100), [True] * 100)
+
+    def test_fair_shares(self):
+        # the owner with the fewest in flight goes first, one at a time
+        self.assertEqual(
+            scheduling.fair_shares(5, {"a": 10, "b": 1, "c": 10}, {"a": 2}),
+            {"a": 1, "b": 1, "c": 3},
+        )
+        # never more than is waiting
+        self.assertEqual(
+            scheduling.fair_shares(10, {"a": 2, "b": 1}, {}), {"a": 2, "b": 1}
+        )
+        self.assertEqual(scheduling.fair_shares(0, {"a": 2}, {}), {})
+
+    @override_settings(DOCUMENT_BULK_MAX_IN_FLIGHT=3)
+    def test_admission_is_capped_and_fair(self):
+        other = User.objects.create_user(username="other", password="pass")
+        big = self.queue(self.user, 4)
+        small = self.queue(other, 1)
+        admitted = self.admit()
+        # oldest first per owner
+        self.assertEqual(
+            sorted(admitted), sorted([big[0].pk, big[1].pk, small[0].pk])
+        )
+        self.assertEqual(
+            DocumentVersion.objects.filter(stage="FETCH").count(), len(admitted)
+        )
+        self.assertEqual(self.admit(), [])
+
+        # a finished version frees its slot, one that gave up retrying too
+        DocumentVersion.objects.filter(pk=big[0].pk).update(stage="DONE")
+        DocumentVersion.objects.filter(pk=small[0].pk).update(stage_error="failed")
+        self.assertEqual(self.admit(), [big[2].pk, big[3].pk])
+
+    def test_admission_is_requested_at_most_once_a_second(self):
+        dv = self.queue(self.user, 1, stage="DONE")[0]
+        with mock.patch.object(tasks.admit_queued_versions, "delay") as delay:
+            scheduling.request_admission()
+            scheduling.finished(dv)
+            self.assertEqual(delay.call_count, 1)
+            caches["default"].delete("docvault:admission")
+            scheduling.finished(dv)
+            self.assertEqual(delay.call_count, 2)
+            caches["default"].delete("docvault:admission")
+            dv.priority = "INTERACTIVE"
+            scheduling.finished(dv)
+            self.assertEqual(delay.call_count, 2)
+
+
+class BulkTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create_user(username="other", password="pass")
+
+    def post(self, action, data):
+        return self.client.post(f"/api/v1/documents/{action}/", data, format="json")
+
+    def create(self, count):
+        documents = [
+            {"title": f"doc {i}", "filename": f"{i}.txt", "tags": [f"tag {i}"]}
+            for i in range(count)
+        ]
+        response = self.post(
+            "bulk_create_meta",
+            {
+                "documents": documents,
+                "tags": ["common"],
+                "shared_with": [{"user_id": self.other.pk, "permission": "VIEW"}],
+            },
+        )
+        self.assertEqual(response.status_code, 201)
+        return [doc["document_id"] for doc in response.json()["documents"]]
+
+    def queries(self, call):
+        with CaptureQueriesContext(connection) as queries:
+            call()
+        return len(queries)
+
+    def test_create_meta(self):
+        ids = self.create(2)
+        self.assertEqual(
+            [doc.title for doc in Document.objects.filter(pk__in=ids).order_by("pk")],
+            ["doc 0", "doc 1"],
+        )
+        doc = Document.objects.get(pk=ids[1])
+        self.assertEqual(
+            sorted(doc.tags.values_list("name", flat=True)), ["common", "tag 1"]
+        )
+        self.assertEqual(doc.latest_version.version_number, 1)
+        self.assertTrue(
+            SharedDocument.objects.filter(document=doc, user=self.other).exists()
+        )
+        self.assertEqual(
+            AuditLog.objects.filter(action="UPLOAD", document_id__in=ids).count(), 2
+        )
+
+    # entries are buffered by the audit writer outside of tests
+    @mock.patch("documents.views.log_event")
+    def test_queries_do_not_grow_with_the_batch(self, log_event):
+        few = self.queries(lambda: self.create(2))
+        with self.assertNumQueries(few):
+            ids = self.create(6)
+        tag = {"document_ids": ids[:2], "tags": ["x", "y"]}
+        share = {
+            "document_ids": ids[:2],
+            "shared_with": [{"user_id": self.other.pk, "permission": "EDIT"}],
+        }
+        for action, data in (("bulk_tag", tag), ("bulk_share", share)):
+            self.post(action, data)  # creates the tags
+            few = self.queries(lambda: self.post(action, data))
+            with self.assertNumQueries(few):
+                self.post(action, {**data, "document_ids": ids})
+
+    def test_only_own_documents_are_changed(self):
+        own = self.create(2)
+        theirs = Document.objects.create(title="theirs", owner=self.other)
+        ids = own + [theirs.pk, 999999]
+        response = self.post("bulk_tag", {"document_ids": ids, "tags": ["x"]})
+        self.assertEqual(
+            response.json(), {"updated": own, "unavailable": [theirs.pk, 999999]}
+        )
+        self.assertFalse(theirs.tags.exists())
+
+        response = self.post(
+            "bulk_share",
+            {"document_ids": ids, "shared_with": [{"user_id": self.other.pk}]},
+        )
+        self.assertEqual(response.json()["unavailable"], [theirs.pk, 999999])
+
+        response = self.post("bulk_delete", {"document_ids": ids})
+        self.assertEqual(
+            response.json(), {"deleted": own, "unavailable": [theirs.pk, 999999]}
+        )
+        self.assertEqual(list(Document.objects.all()), [theirs])
+
+    @override_settings(DOCUMENT_BULK_MAX=3)
+    def test_invalid_requests(self):
+        ids = self.create(1)
+        for action, data in (
+            ("bulk_tag", {"document_ids": [1, 2, 3, 4], "tags": ["x"]}),
+            ("bulk_tag", {"document_ids": ["1"], "tags": ["x"]}),
+            ("bulk_tag", {"document_ids": [], "tags": ["x"]}),
+            ("bulk_tag", {"document_ids": ids, "tags": []}),
+            ("bulk_share", {"document_ids": ids, "shared_with": [{"user_id": 999}]}),
+            ("bulk_share", {"document_ids": ids, "shared_with": [{"user_id": "x"}]}),
+            ("bulk_delete", {"document_ids": "1,2"}),
+            (
+                "bulk_create_meta",
+                {"documents": [{"title": "a", "filename": "a"}] * 4},
+            ),
+            ("bulk_create_meta", {"documents": [{"title": "no filename"}]}),
+        ):
+            response = self.post(action, data)
+            self.assertEqual(response.status_code, 400, (action, data))
+        self.assertEqual(Document.objects.count(), 1)
+
+    @override_settings(DOCUMENT_SEARCH_BACKEND="documents.search.DatabaseSearchBackend")
+    # entries are buffered by the audit writer outside of tests
+    @mock.patch("documents.views.log_event")
+    def test_delete_queries_do_not_grow_with_the_batch(self, log_event):
+        get_backend.cache_clear()
+        self.addCleanup(get_backend.cache_clear)
+        ids = [self.upload(b"words", name=f"{i}.txt").document_id for i in range(6)]
+        few = self.queries(lambda: self.post("bulk_delete", {"document_ids": ids[:1]}))
+        with self.assertNumQueries(few):
+            self.post("bulk_delete", {"document_ids": ids[1:]})
+        self.assertFalse(Document.objects.filter(pk__in=ids).exists())
+
+    def test_delete_releases_blobs_and_search_rows(self):
+        kept = self.upload(b"shared words", name="a.txt")
+        deleted = [self.upload(b"shared words", name="b.txt") for _ in range(2)]
+        deleted.append(self.upload(b"other words", name="c.txt"))
+        self.post("bulk_delete", {"document_ids": [dv.document_id for dv in deleted]})
+        self.assertEqual(Blob.objects.get(pk=kept.blob_id).ref_count, 1)
+        self.assertEqual(Blob.objects.get(pk=deleted[2].blob_id).ref_count, 0)
+        hits = self.client.get("/api/v1/documents/search/", {"q": "words"}).json()
+        self.assertEqual(
+            [hit["document_id"] for hit in hits["results"]], [kept.document_id]
+        )
+
+
+class AuditWriterTests(TestCase):
+    def entries(self, count):
+        return [
+            AuditLog(action="UPLOAD", timestamp=timezone.now(), extra={"n": i})
+            for i in range(count)
+        ]
+
+    def writer(self, **kwargs):
+        writer = AuditWriter(**{"flush_interval": 60, **kwargs})
+        self.addCleanup(setattr, writer, "closed", True)
+        self.addCleanup(writer.wakeup.set)
+        return writer
+
+    def test_synchronous_without_interval(self):
+        writer = AuditWriter(flush_interval=0)
+        for entry in self.entries(2):
+            writer.add(entry)
+        self.assertEqual(AuditLog.objects.count(), 2)
+        self.assertIsNone(writer.thread)
+
+    def test_thread_flushes_full_batches(self):
+        written = []
+        flushed = threading.Event()
+
+        def bulk_create(batch):
+            written.append(len(batch))
+            flushed.set()
+
+        writer = self.writer(batch_size=2)
+        with mock.patch.object(AuditLog.objects, "bulk_create", bulk_create):
+            writer.add(self.entries(1)[0])
+            self.assertFalse(flushed.wait(0.2))
+            writer.add(self.entries(1)[0])
+            self.assertTrue(flushed.wait(5))
+        self.assertEqual(written, [2])
+        self.assertNotEqual(writer.thread.ident, threading.get_ident())
+
+    def test_full_buffer_is_flushed_by_the_logging_thread(self):
+        writer = self.writer(batch_size=100, max_buffer=3)
+        with mock.patch.object(writer, "_ensure_thread"):
+            for entry in self.entries(3):
+                writer.add(entry)
+        # written before add() returned, not by the flush thread
+        self.assertEqual(AuditLog.objects.count(), 3)
+        self.assertEqual(writer.buffer, [])
+
+    def test_close_writes_what_is_buffered(self):
+        writer = self.writer()
+        with mock.patch.object(writer, "_ensure_thread"):
+            for entry in self.entries(3):
+                writer.add(entry)
+        self.assertEqual(AuditLog.objects.count(), 0)
+        writer.close()
+        self.assertEqual(AuditLog.objects.count(), 3)
+        # logging during interpreter shutdown is synchronous
+        writer.add(self.entries(1)[0])
+        self.assertEqual(AuditLog.objects.count(), 4)
+
+    def test_shared_writer_is_closed_at_exit_and_reset_after_fork(self):
+        reset_audit_writer()
+        self.addCleanup(reset_audit_writer)
+        with mock.patch("documents.audit.atexit.register") as register:
+            writer = get_audit_writer()
+        register.assert_called_once_with(writer.close)
+        reset_audit_writer()
+        self.assertIsNot(get_audit_writer(), writer)
+
+    def test_failed_inserts_stay_buffered(self):
+        writer = self.writer(batch_size=2)
+        with mock.patch.object(writer, "_ensure_thread"):
+            for entry in self.entries(3):
+                writer.add(entry)
+        with mock.patch.object(
+            AuditLog.objects, "bulk_create", side_effect=DatabaseError("down")
+        ):
+            self.assertEqual(writer.flush(), 0)
+        self.assertEqual([e.extra["n"] for e in writer.buffer], [0, 1, 2])
+        self.assertEqual(writer.flush(), 3)
+        self.assertEqual(AuditLog.objects.count(), 3)
+
+    def test_rows_that_cannot_be_inserted_are_dropped(self):
+        writer = self.writer(batch_size=10)
+        entries = self.entries(3)
+        entries[1].document_id = 999999  # deleted before the flush
+        real = AuditLog.objects.bulk_create
+
+        def bulk_create(batch):
+            if any(entry.document_id for entry in batch):
+                raise IntegrityError("foreign key")
+            return real(batch)
+
+        with mock.patch.object(writer, "_ensure_thread"):
+            for entry in entries:
+                writer.add(entry)
+        with mock.patch.object(AuditLog.objects, "bulk_create", bulk_create):
+            with self.assertLogs("documents.audit", "ERROR"):
+                self.assertEqual(writer.flush(), 3)
+        self.assertEqual(
+            sorted(AuditLog.objects.values_list("extra__n", flat=True)), [0, 2]
+        )
+
+    def test_entries_left_on_close_are_logged(self):
+        writer = self.writer()
+        with mock.patch.object(writer, "_ensure_thread"):
+            writer.add(self.entries(1)[0])
+        with mock.patch.object(
+            AuditLog.objects, "bulk_create", side_effect=DatabaseError("down")
+        ):
+            with self.assertLogs("documents.audit", "ERROR") as logs:
+                writer.close()
+        self.assertIn("Audit entry not written: UPLOAD", logs.output[-1])
+
+
+class AuditTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create_user(username="other", password="pass")
+        self.doc = Document.objects.create(title="mine", owner=self.user)
+        self.theirs = Document.objects.create(title="theirs", owner=self.other)
+
+    def entries(self, client=None, **params):
+        response = (client or self.client).get("/api/v1/audit/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()["results"]
+
+    def entry(self, action, when, document=None):
+        return AuditLog.objects.create(
+            action=action,
+            timestamp=when,
+            document=document,
+            document_owner=document.owner if document else None,
+        )
+
+    def test_owners_see_the_history_of_their_documents(self):
+        log_event("UPLOAD", user=self.user, document=self.doc)
+        log_event("DOWNLOAD", user=self.other, document=self.doc)
+        log_event("UPLOAD", user=self.other, document=self.theirs)
+        self.assertEqual(
+            [(e["action"], e["document"]) for e in self.entries()],
+            [("DOWNLOAD", self.doc.pk), ("UPLOAD", self.doc.pk)],
+        )
+        staff = User.objects.create_user(username="staff", is_staff=True)
+        client = APIClient()
+        client.force_authenticate(staff)
+        self.assertEqual(len(self.entries(client)), 3)
+
+        # the history outlives the document
+        self.client.post(
+            "/api/v1/documents/bulk_delete/",
+            {"document_ids": [self.doc.pk]},
+            format="json",
+        )
+        entries = self.entries()
+        self.assertEqual(
+            [e["action"] for e in entries], ["DELETE", "DOWNLOAD", "UPLOAD"]
+        )
+        self.assertEqual({e["document"] for e in entries}, {None})
+        self.assertEqual(entries[0]["extra"]["document_id"], self.doc.pk)
+
+    def test_filters(self):
+        start = timezone.now() - timedelta(days=10)
+        for day, action in enumerate(("UPLOAD", "DOWNLOAD", "DOWNLOAD", "TAG")):
+            self.entry(action, start + timedelta(days=day), self.doc)
+        self.entry("DOWNLOAD", start, self.theirs)
+
+        def actions(**params):
+            return [e["action"] for e in self.entries(**params)]
+
+        self.assertEqual(actions(action="UPLOAD,TAG"), ["TAG", "UPLOAD"])
+        self.assertEqual(actions(document=self.theirs.pk), [])
+        self.assertEqual(
+            actions(
+                since=(start + timedelta(days=1)).isoformat(),
+                until=(start + timedelta(days=3)).isoformat(),
+            ),
+            ["DOWNLOAD", "DOWNLOAD"],
+        )
+        for params in ({"document": "x"}, {"since": "yesterday"}):
+            response = self.client.get("/api/v1/audit/", params)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_pagination(self):
+        start = timezone.now() - timedelta(days=10)
+        created = [
+            self.entry("DOWNLOAD", start + timedelta(minutes=i), self.doc).pk
+            for i in range(5)
+        ]
+        response = self.client.get("/api/v1/audit/", {"page_size": 2}).json()
+        ids = []
+        while True:
+            ids += [e["id"] for e in response["results"]]
+            if not response["next"]:
+                break
+            response = self.client.get(response["next"]).json()
+        self.assertEqual(ids, created[::-1])
+
+    def test_archive_month(self):
+        january = timezone.make_aware(datetime(2024, 1, 1))
+        rows = [
+            self.entry("UPLOAD", january, self.doc),
+            self.entry("DOWNLOAD", january + timedelta(days=30, hours=23), self.doc),
+        ]
+        february = self.entry("DOWNLOAD", month_start(january, 1), self.doc)
+
+        archive = archive_audit_month(january)
+        self.assertEqual(
+            (archive.month, archive.row_count, archive.first_id, archive.last_id),
+            (january.date(), 2, rows[0].pk, rows[1].pk),
+        )
+        with closing(self.storage.open(archive.key)) as body:
+            stored = body.read()
+        self.assertEqual(hashlib.sha256(stored).hexdigest(), archive.sha256)
+        data = gzip.decompress(stored)
+        lines = [json.loads(line) for line in data.splitlines()]
+        self.assertEqual(
+            [(line["id"], line["action"], line["document_owner_id"]) for line in lines],
+            [(row.pk, row.action, self.user.pk) for row in rows],
+        )
+        self.assertEqual(list(AuditLog.objects.all()), [february])
+
+    def test_archive_keeps_rows_committed_while_writing(self):
+        january = timezone.make_aware(datetime(2024, 1, 1))
+        for pk in (10, 20):
+            AuditLog.objects.create(pk=pk, action="UPLOAD", timestamp=january)
+
+        save = self.storage.save
+
+        def save_and_commit_late(key, content):
+            # a row of the month that was not visible when it was read
+            AuditLog.objects.create(pk=15, action="UPLOAD", timestamp=january)
+            save(key, content)
+
+        with mock.patch.object(self.storage, "save", save_and_commit_late):
+            archive = archive_audit_month(january)
+        self.assertEqual((archive.first_id, archive.last_id), (10, 20))
+        self.assertEqual(list(AuditLog.objects.values_list("pk", flat=True)), [15])
+
+        # archived on the next run, in a further file
+        archive = archive_audit_month(january)
+        self.assertEqual((archive.row_count, archive.first_id), (1, 15))
+        self.assertFalse(AuditLog.objects.exists())
+
+    def test_retention_keeps_the_last_months(self):
+        now = timezone.make_aware(datetime(2024, 3, 15))
+        cutoff = month_start(now, -1)
+        self.entry("UPLOAD", cutoff - timedelta(days=40))
+        self.entry("UPLOAD", cutoff - timedelta(microseconds=1))
+        kept = self.entry("UPLOAD", cutoff)
+        with mock.patch("documents.audit.timezone.now", return_value=now):
+            archives = archive_audit_log(retention_months=1)
+        self.assertEqual(
+            [(a.month, a.row_count) for a in archives],
+            [(date(2023, 12, 1), 1), (date(2024, 1, 1), 1)],
+        )
+        self.assertEqual(list(AuditLog.objects.all()), [kept])
+
+
+class MetricsAccessTests(TestCase):
+    def scrape(self, address="203.0.113.7", **headers):
+        return Client(REMOTE_ADDR=address).get("/metrics", headers=headers)
+
+    def test_denied_by_default(self):
+        self.assertEqual(self.scrape().status_code, 403)
+        self.assertEqual(self.scrape("127.0.0.1").status_code, 403)
+
+    @override_settings(METRICS_ALLOWED_NETWORKS=["10.0.0.0/8", "::1"])
+    def test_allowed_networks(self):
+        self.assertEqual(self.scrape("10.1.2.3").status_code, 200)
+        self.assertEqual(self.scrape("::1").status_code, 200)
+        self.assertEqual(self.scrape().status_code, 403)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_token(self):
+        self.assertEqual(self.scrape().status_code, 401)
+        wrong = self.scrape(Authorization="Bearer wrong")
+        self.assertEqual(wrong.status_code, 401)
+        response = self.scrape(Authorization="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(DOCUMENT_STORAGE_BACKEND="documents.storage.S3Storage")
+class WarmupTests(TestCase):
+    def setUp(self):
+        get_storage.cache_clear()
+        self.addCleanup(get_storage.cache_clear)
+        self.addCleanup(storage.reset_s3_client)
+        storage.reset_s3_client()
+        patchers = {
+            "create": mock.patch(
+                "documents.storage._create_s3_client", side_effect=object
+            ),
+            "scanner": mock.patch("documents.warmup.get_scanner"),
+            "importlib": mock.patch("documents.warmup.importlib"),
+            "version": mock.patch("pytesseract.get_tesseract_version"),
+        }
+        self.mocks = {name: patcher.start() for name, patcher in patchers.items()}
+        for patcher in patchers.values():
+            self.addCleanup(patcher.stop)
+
+    def test_hooks_are_connected(self):
+        self.assertIn(warmup.limit_ocr_threads, worker_init._live_receivers(None))
+        self.assertIn(warmup.preload_modules, worker_init._live_receivers(None))
+        self.assertIn(
+            warmup.preload_clients, worker_process_init._live_receivers(None)
+        )
+
+    @override_settings(DOCUMENT_WORKER_PRELOAD=False)
+    def test_nothing_is_preloaded_unless_enabled(self):
+        warmup.preload_modules(sender=mock.Mock(pool_cls="solo"))
+        warmup.preload_clients()
+        self.mocks["importlib"].import_module.assert_not_called()
+        self.mocks["create"].assert_not_called()
+        self.mocks["scanner"].assert_not_called()
+
+    def test_worker_preloads_the_stack(self):
+        warmup.preload_modules(sender=mock.Mock(pool_cls="celery.concurrency.prefork"))
+        imported = self.mocks["importlib"].import_module.call_args_list
+        self.assertEqual(
+            [call.args[0] for call in imported], list(warmup.PRELOAD_MODULES)
+        )
+        # pool children build their own clients
+        self.mocks["create"].assert_not_called()
+        warmup.preload_clients()
+        self.mocks["create"].assert_called_once_with()
+        self.mocks["scanner"].assert_called_once_with()
+
+    def test_solo_worker_builds_its_clients(self):
+        warmup.preload_modules(sender=mock.Mock(pool_cls="solo"))
+        self.mocks["create"].assert_called_once_with()
+
+    def test_ocr_threads_are_limited(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop("OMP_THREAD_LIMIT", None)
+            warmup.limit_ocr_threads()
+            self.assertEqual(os.environ["OMP_THREAD_LIMIT"], "1")
+            # an explicit limit is kept
+            os.environ["OMP_THREAD_LIMIT"] = "4"
+            warmup.limit_ocr_threads()
+            self.assertEqual(os.environ["OMP_THREAD_LIMIT"], "4")
+
+    def test_fork_rebuilds_the_s3_client(self):
+        parent = storage.get_s3_client()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                # the parent's pooled sockets are not shared with a child
+                if storage._s3_client is None:
+                    warmup.preload_clients()
+                    child = storage._s3_client
+                    code = 0 if child is not None and child is not parent else 2
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertIs(storage.get_s3_client(), parent)
@@ -0,0 +1,135 @@
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import MultipartUpload
+from .storage import (
+    MAX_PART_SIZE,
+    MAX_PARTS,
+    MIN_PART_SIZE,
+    NoSuchUpload,
+    get_storage,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """the upload is incomplete or does not match what was declared"""
+
+
+def get_part_size(file_size):
+    """
+    DOCUMENT_UPLOAD_PART_SIZE, raised for files that would need more than
+    MAX_PARTS parts. Rounded up to whole MB
+    """
+    part_size = getattr(settings, "DOCUMENT_UPLOAD_PART_SIZE", 16 * 1024 * 1024)
+    part_size = max(part_size, MIN_PART_SIZE, -(-file_size // MAX_PARTS))
+    mb = 1024 * 1024
+    return min(-(-part_size // mb) * mb, MAX_PART_SIZE)
+
+
+def start_multipart_upload(version, file_size):
+    """MultipartUpload for `version`, the object key is the version's file"""
+    key = version.file if isinstance(version.file, str) else version.file.name
+    upload_id = get_storage().create_multipart_upload(key, version.content_type)
+    return MultipartUpload.objects.create(
+        version=version,
+        key=key,
+        upload_id=upload_id,
+        file_size=file_size,
+        part_size=get_part_size(file_size),
+    )
+
+
+def presign_parts(upload, part_numbers, expiration=3600):
+    """{part number: presigned url}"""
+    storage = get_storage()
+    return {
+        n: storage.presigned_upload_part(
+            upload.key, upload.upload_id, n, expiration=expiration
+        )
+        for n in part_numbers
+    }
+
+
+def verify_parts(upload, parts, client_etags):
+    """
+    check the uploaded `parts` (as listed by storage) against the declared
+    size and part layout, and against the etags the client got back from
+    its part uploads, which it has to confirm for every part. Raises
+    UploadError
+    """
+    numbers = [part.number for part in parts]
+    if numbers != list(range(1, upload.part_count + 1)):
+        missing = sorted(set(range(1, upload.part_count + 1)) - set(numbers))
+        if missing:
+            raise UploadError(f"Parts missing: {missing[:20]}")
+        raise UploadError(f"Unexpected parts: {numbers[:20]}")
+    for part in parts[:-1]:
+        if part.size != upload.part_size:
+            raise UploadError(f"Part {part.number} has {part.size} bytes")
+    total = sum(part.size for part in parts)
+    if total != upload.file_size:
+        raise UploadError(f"Uploaded {total} bytes, declared {upload.file_size}")
+    for part in parts:
+        etag = client_etags.get(part.number)
+        if not etag:
+            raise UploadError(f"ETag missing for part {part.number}")
+        if etag.strip('"') != part.etag:
+            raise UploadError(f"ETag mismatch for part {part.number}")
+
+
+def complete_multipart_upload(upload, client_etags):
+    """
+    verify and assemble the object, returns its size. The parts listed by
+    storage are used, the client confirms their etags ({part number: etag})
+    """
+    storage = get_storage()
+    with transaction.atomic():
+        upload = MultipartUpload.objects.select_for_update().get(pk=upload.pk)
+        if upload.status == "COMPLETED":
+            # retried request, the object exists already
+            return storage.size(upload.key)
+        if upload.status != "PENDING":
+            raise UploadError(f"Upload is {upload.status.lower()}")
+        try:
+            parts = storage.list_parts(upload.key, upload.upload_id)
+        except NoSuchUpload:
+            raise UploadError("The upload is gone, it has to be started again")
+        verify_parts(upload, parts, client_etags)
+        storage.complete_multipart_upload(upload.key, upload.upload_id, parts)
+        upload.status = "COMPLETED"
+        upload.save(update_fields=["status", "updated_at"])
+    size = storage.size(upload.key)
+    if size != upload.file_size:
+        raise UploadError(
+            f"Stored object has {size} bytes, declared {upload.file_size}"
+        )
+    return size
+
+
+def abort_multipart_upload(upload):
+    """
+    drop the uploaded parts, the pending version is left to the caller. The
+    row may be gone already, with a version deleted in the meantime
+    """
+    if upload.status == "PENDING":
+        get_storage().abort_multipart_upload(upload.key, upload.upload_id)
+        upload.status = "ABORTED"
+        MultipartUpload.objects.filter(pk=upload.pk).update(
+            status="ABORTED", updated_at=timezone.now()
+        )
+
+
+def abort_uploads(uploads):
+    """abort_multipart_upload for each upload, errors are logged"""
+    for upload in uploads:
+        try:
+            abort_multipart_upload(upload)
+        except Exception as e:
+            # parts left behind are removed by the bucket's lifecycle rule
+            logger.error(f"Could not abort upload {upload.upload_id}: {e}")
@@ -1,10 +1,16 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import DocumentViewSet
+from . import async_views
+from .views import AuditLogViewSet, DocumentViewSet
 
 router = DefaultRouter()
 router.register("documents", DocumentViewSet, basename="document")
+router.register("audit", AuditLogViewSet, basename="audit")
 
 urlpatterns = [
     path("", include(router.urls)),
+    # async read endpoints, served without a thread per request under ASGI
+    path("async/documents/", async_views.document_list),
+    path("async/documents/<int:pk>/", async_views.document_detail),
+    path("async/documents/<int:pk>/download/", async_views.document_download),
 ]
@@ -1,36 +1,112 @@
-import boto3
+import os
+import threading
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from botocore.exceptions import ClientError
+from django.utils import timezone
+
+from .cache import LRUCache
+from .chunking import request_restore
+from .storage import get_storage
 
 
 def generate_presigned_post(key, content_type, expiration=3600) -> dict:
     """
     Generate a presigned POST for S3 so clients upload directly to S3
     """
-    s3_client = boto3.client(
-        "s3",
-        region_name=getattr(settings, "AWS_S3_REGION_NAME", None),
-        aws_access_key_id=getattr(settings, "AWS_ACCESS_KEY_ID", None),
-        aws_secret_access_key=getattr(settings, "AWS_SECRET_ACCESS_KEY", None),
+    return get_storage().presigned_post(key, content_type, expiration=expiration)
+
+
+_download_urls = None
+_download_urls_lock = threading.Lock()
+
+
+def get_download_url_cache():
+    global _download_urls
+    if _download_urls is None:
+        with _download_urls_lock:
+            if _download_urls is None:
+                _download_urls = LRUCache(
+                    max_entries=getattr(
+                        settings, "DOCUMENT_PRESIGN_CACHE_MAX_ENTRIES", 10000
+                    )
+                )
+    return _download_urls
+
+
+class ContentRestoring(Exception):
+    """the content is archived as chunks, a task is storing it whole again"""
+
+
+def generate_presigned_download(version, expiration=None):
+    """
+    (url, expires_at) to download a version, the file keeps its upload name.
+    Signing is local CPU work with the shared client, and a signed url is
+    reused for the first half of its lifetime so callers always get one
+    that is valid for at least expiration / 2 seconds. Raises
+    ContentRestoring for content archived as chunks, until it is restored
+    """
+    if version.blob_id and version.blob.chunked:
+        # the url needs the whole object
+        request_restore(version.blob)
+        raise ContentRestoring(f"version {version.pk} is being restored")
+    name = version.file if isinstance(version.file, str) else version.file.name
+    return generate_presigned_get(
+        version.storage_key, os.path.basename(name), expiration
     )
 
-    bucket = getattr(settings, "AWS_STORAGE_BUCKET_NAME")
-
-    try:
-        fields = {"Content-Type": content_type, "key": key}
-        conditions = [
-            {"key": key},
-            {"Content-Type": content_type},
-            ["content-length-range", 1, 50 * 1024 * 1024 * 10],
-            # limit size to 500MB
-        ]
-        post = s3_client.generate_presigned_post(
-            Bucket=bucket,
-            Key=key,
-            Fields=fields,
-            Condtions=conditions,
-            ExpiresIn=expiration,
+
+def generate_presigned_get(key, filename=None, expiration=None):
+    """
+    (url, expires_at) of a stored object, cached like
+    generate_presigned_download
+    """
+    if expiration is None:
+        expiration = getattr(settings, "DOCUMENT_DOWNLOAD_URL_EXPIRATION", 3600)
+    cache_key = (key, filename, expiration)
+    cache = get_download_url_cache()
+    signed = cache.get(cache_key)
+    if signed is None:
+        url = get_storage().presigned_get(
+            key, expiration=expiration, filename=filename
         )
-    except ClientError as e:
-        raise e
-    return post
+        signed = (url, timezone.now() + timedelta(seconds=expiration))
+        cache.set(cache_key, signed, ttl=expiration / 2)
+    return signed
+
+
+# whether this process signed a url yet, see agenerate_presigned_download
+_signer_ready = False
+
+
+def reset_signer(**kwargs):
+    global _signer_ready
+    _signer_ready = False
+
+
+os.register_at_fork(after_in_child=reset_signer)
+
+
+async def agenerate_presigned_download(version, expiration=None):
+    """
+    generate_presigned_download for async views. Signing is CPU work and
+    runs on the event loop, the first call (building the client, resolving
+    credentials) and queueing a restore of chunked content run in a thread
+    """
+    global _signer_ready
+    if not _signer_ready or (version.blob_id and version.blob.chunked):
+        signed = await sync_to_async(generate_presigned_download)(version, expiration)
+        _signer_ready = True
+        return signed
+    return generate_presigned_download(version, expiration)
+
+
+def parse_id(value):
+    """a url segment or request value as an id, None unless it is one"""
+    if isinstance(value, str) and value.isdecimal():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int):
+        return None
+    # beyond what the database can compare against
+    return value if 0 < value < 2**63 else None
@@ -1,19 +1,65 @@
+from collections import Counter
+from datetime import datetime
+from functools import partial
+
 from django.shortcuts import render
 from rest_framework.decorators import action
 from rest_framework import viewsets, status, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F, Max
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404
-from .models import Document, DocumentVersion, Tag, AuditLog, SharedDocument
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .audit import log_event
+from .blobs import detach_blobs
+from .cache import get_document_cache
+from .diff import EXTRACTED_STAGES, DiffError, diff_versions
+from .models import (
+    AuditLog,
+    Document,
+    DocumentPage,
+    DocumentVersion,
+    MultipartUpload,
+    PagePreview,
+    Tag,
+    SharedDocument,
+)
 from .serializers import (
+    AuditLogSerializer,
     DocumentSerializer,
+    DocumentListSerializer,
     SimpleDocumentCreateSerializer,
     PresignedUploadResponseSerializer,
     DocumentVersionSerializer,
     TagSerializer,
 )
-from .utils import generate_presigned_post
+from .pagination import AuditLogCursorPagination, DocumentCursorPagination
+from .previews import get_preview_sizes, render_preview
+from .scheduling import submit
+from .search import accessible_documents, get_backend, search_documents
+from .signals import invalidate_documents
+from .storage import NoSuchUpload, get_storage
+from .uploads import (
+    UploadError,
+    abort_multipart_upload,
+    abort_uploads,
+    complete_multipart_upload,
+    presign_parts,
+    start_multipart_upload,
+)
+from .utils import (
+    ContentRestoring,
+    generate_presigned_download,
+    generate_presigned_get,
+    generate_presigned_post,
+    parse_id,
+)
 
 
 class DocumentViewSet(viewsets.ViewSet):
@@ -30,16 +76,341 @@ class DocumentViewSet(viewsets.ViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
     def list(self, request):
-        querySet = Document.objects.filter(owner=request.user)
-        serializer = DocumentSerializer(querySet, many=True)
-        return Response(serializer.data)
+        # owner and latest version are joined, tags prefetched per page, so a
+        # page costs the same number of queries however many documents it holds
+        querySet = (
+            Document.objects.filter(owner=request.user)
+            .select_related("owner", "latest_version")
+            .prefetch_related("tags")
+        )
+        paginator = DocumentCursorPagination()
+        page = paginator.paginate_queryset(querySet, request, view=self)
+        serializer = DocumentListSerializer(
+            page, many=True, context={"request": request}
+        )
+        return paginator.get_paginated_response(serializer.data)
 
     def retrieve(self, request, pk=None):
-        doc = get_object_or_404(Document, pk=pk)
-        serializer = DocumentSerializer(doc, context={"request": request})
-        return Response(serializer.data)
+        # permission and payload are both cached, a hot document is served
+        # without a database query. Documents the user may not see are
+        # reported as missing
+        pk = parse_id(pk)
+        if pk is None:
+            raise Http404
+        cache = get_document_cache()
+        if not cache.get_permission(request.user, pk):
+            raise Http404
+        payload = cache.get_payload(
+            pk,
+            lambda doc: DocumentSerializer(doc, context={"request": request}).data,
+        )
+        if payload is None:
+            raise Http404
+        return Response(payload)
 
     # custom endpoints for our ViewSet
+    @action(detail=False, methods=["get"])
+    def search(self, request):
+        """
+        full-text search over the extracted text of documents the user owns
+        or that were shared with them, best matching pages first
+        ?q=invoice total&limit=20&offset=0&all_versions=false
+        """
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            return Response(
+                {"error": "q required."}, status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            limit = min(max(int(request.query_params.get("limit", 20)), 1), 100)
+            offset = max(int(request.query_params.get("offset", 0)), 0)
+        except ValueError:
+            return Response(
+                {"error": "limit and offset must be integers."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        all_versions = request.query_params.get("all_versions", "").lower() in (
+            "1",
+            "true",
+        )
+
+        hits = search_documents(
+            request.user, query, limit=limit, offset=offset, all_versions=all_versions
+        )
+        titles = dict(
+            Document.objects.filter(pk__in={h.document_id for h in hits}).values_list(
+                "id", "title"
+            )
+        )
+        version_numbers = dict(
+            DocumentVersion.objects.filter(
+                pk__in={h.version_id for h in hits}
+            ).values_list("id", "version_number")
+        )
+        results = [
+            {
+                "document_id": hit.document_id,
+                "title": titles.get(hit.document_id),
+                "version_id": hit.version_id,
+                "version_number": version_numbers.get(hit.version_id),
+                "page_number": hit.page_number,
+                "score": hit.score,
+                "highlight": hit.highlight,
+            }
+            for hit in hits
+        ]
+        return Response({"query": query, "results": results})
+
+    @action(detail=True, methods=["get"])
+    def download(self, request, pk=None):
+        """
+        presigned download url of the latest version, or of ?version_id=<id>
+        """
+        doc = get_object_or_404(Document, pk=parse_id(pk))
+        if not get_document_cache().get_permission(request.user, doc.pk):
+            raise Http404
+        version_id, error = parse_version_id(request.query_params, doc)
+        if error:
+            return error
+        dv = get_object_or_404(
+            DocumentVersion.objects.select_related("blob"),
+            pk=version_id,
+            document=doc,
+        )
+        if dv.stage == "QUARANTINED":
+            return Response(
+                {"error": "version is quarantined."}, status=status.HTTP_409_CONFLICT
+            )
+        if dv.stage not in DocumentVersion.SCANNED_STAGES:
+            return Response(
+                {"error": "version has not been scanned yet."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        try:
+            url, expires_at = generate_presigned_download(dv)
+        except ContentRestoring:
+            return restoring_response(dv)
+        log_event("DOWNLOAD", user=request.user, document=doc, version=dv)
+        return Response({"version_id": dv.id, "url": url, "expires_at": expires_at})
+
+    @action(detail=True, methods=["get"])
+    def diff(self, request, pk=None):
+        """
+        diff of the extracted text of two versions
+        ?from=<version_number>&to=<version_number>&granularity=line|word&context=3
+        defaults to the previous and the latest version. Replaced lines carry
+        a word level diff with granularity=word
+        """
+        doc = get_object_or_404(
+            Document.objects.select_related("latest_version"), pk=parse_id(pk)
+        )
+        if not get_document_cache().get_permission(request.user, doc.pk):
+            raise Http404
+        granularity = request.query_params.get("granularity", "line")
+        try:
+            context = min(max(int(request.query_params.get("context", 3)), 0), 50)
+            latest = doc.latest_version.version_number if doc.latest_version else 1
+            to_number = int(request.query_params.get("to", latest))
+            from_number = int(request.query_params.get("from", to_number - 1))
+        except ValueError:
+            return Response(
+                {"error": "from, to and context must be integers."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if granularity not in ("line", "word"):
+            return Response(
+                {"error": "granularity must be line or word."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        versions = {
+            dv.version_number: dv
+            for dv in DocumentVersion.objects.select_related("blob").filter(
+                document=doc, version_number__in=(from_number, to_number)
+            )
+        }
+        if from_number not in versions or to_number not in versions:
+            raise Http404
+        try:
+            result = diff_versions(
+                versions[from_number],
+                versions[to_number],
+                granularity=granularity,
+                context=context,
+            )
+        except DiffError as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response(
+            {
+                "document_id": doc.id,
+                "from": from_number,
+                "to": to_number,
+                "granularity": granularity,
+                **result,
+            }
+        )
+
+    @action(detail=True, methods=["get"])
+    def text(self, request, pk=None):
+        """
+        extracted text of a page range of the latest version, or of
+        ?version_id=<id>. ?start=1&end=10, at most DOCUMENT_TEXT_PAGE_RANGE_MAX
+        pages per call; `next` is the start of the following range
+        """
+        doc = get_object_or_404(Document, pk=parse_id(pk))
+        if not get_document_cache().get_permission(request.user, doc.pk):
+            raise Http404
+        max_pages = getattr(settings, "DOCUMENT_TEXT_PAGE_RANGE_MAX", 50)
+        try:
+            start = max(int(request.query_params.get("start", 1)), 1)
+            end = int(request.query_params.get("end", start + max_pages - 1))
+        except ValueError:
+            return Response(
+                {"error": "start and end must be integers."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if end < start:
+            return Response(
+                {"error": "end must not be before start."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        end = min(end, start + max_pages - 1)
+        version_id, error = parse_version_id(request.query_params, doc)
+        if error:
+            return error
+        dv = get_object_or_404(DocumentVersion, pk=version_id, document=doc)
+        if dv.stage not in EXTRACTED_STAGES:
+            return Response(
+                {"error": "text is not extracted yet."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        pages = DocumentPage.objects.filter(version=dv)
+        page_count = pages.aggregate(count=Max("page_number"))["count"] or 0
+        results = list(
+            pages.filter(page_number__gte=start, page_number__lte=end)
+            .order_by("page_number")
+            .values("page_number", "text", "source")
+        )
+        return Response(
+            {
+                "document_id": doc.id,
+                "version_id": dv.id,
+                "page_count": page_count,
+                "start": start,
+                "end": min(end, page_count),
+                "next": end + 1 if end < page_count else None,
+                "pages": results,
+            }
+        )
+
+    @action(detail=True, methods=["get"])
+    def preview(self, request, pk=None):
+        """
+        jpeg preview of a page of the latest version, or of ?version_id=<id>.
+        ?page=1&size=<one of DOCUMENT_PREVIEW_SIZES, the smallest by default>.
+        Redirects to the stored image when it was rendered while processing,
+        other pages are rendered on request
+        """
+        doc = get_object_or_404(Document, pk=parse_id(pk))
+        if not get_document_cache().get_permission(request.user, doc.pk):
+            raise Http404
+        sizes = get_preview_sizes()
+        try:
+            page_number = int(request.query_params.get("page", 1))
+            size = int(request.query_params.get("size", sizes[0]))
+        except ValueError:
+            return Response(
+                {"error": "page and size must be integers."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if page_number < 1 or size not in sizes:
+            return Response(
+                {"error": f"page must be positive and size one of {list(sizes)}."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        version_id, error = parse_version_id(request.query_params, doc)
+        if error:
+            return error
+        dv = get_object_or_404(
+            DocumentVersion.objects.select_related("blob"),
+            pk=version_id,
+            document=doc,
+        )
+        if dv.stage not in EXTRACTED_STAGES:
+            return Response(
+                {"error": "preview is not available yet."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        stored = PagePreview.objects.filter(
+            blob_id=dv.blob_id, page_number=page_number, size=size
+        ).first()
+        if stored is not None:
+            url, _ = generate_presigned_get(stored.key)
+            # not HttpResponseRedirect, local storages sign file:// urls
+            response = HttpResponse(status=status.HTTP_302_FOUND)
+            response["Location"] = url
+            return response
+        data = render_preview(dv, page_number, size)
+        if data is None:
+            raise Http404
+        response = HttpResponse(data, content_type="image/jpeg")
+        response["Cache-Control"] = "private, max-age=3600"
+        return response
+
+    @action(detail=False, methods=["post"])
+    def presign_downloads(self, request):
+        """
+        presigned download urls for many versions in one call
+        {"version_ids": [1, 2, 3]}
+        versions that do not exist, are not accessible or are not scanned
+        (yet, or quarantined) are listed under "unavailable", archived ones
+        under "restoring" until their content is restored
+        """
+        version_ids, error = parse_id_list(
+            request.data,
+            "version_ids",
+            getattr(settings, "DOCUMENT_PRESIGN_BATCH_MAX", 500),
+        )
+        if error:
+            return error
+
+        versions = (
+            DocumentVersion.objects.filter(
+                pk__in=version_ids,
+                document__in=accessible_documents(request.user),
+                stage__in=DocumentVersion.SCANNED_STAGES,
+            )
+            .select_related("blob")
+            .annotate(document_owner_id=F("document__owner_id"))
+        )
+        urls = {}
+        restoring = []
+        for dv in versions:
+            try:
+                url, expires_at = generate_presigned_download(dv)
+            except ContentRestoring:
+                restoring.append(dv.id)
+                continue
+            urls[dv.id] = {"url": url, "expires_at": expires_at}
+            log_event(
+                "DOWNLOAD",
+                user=request.user,
+                document_id=dv.document_id,
+                document_owner_id=dv.document_owner_id,
+                version=dv,
+                extra={"batch": True},
+            )
+        return Response(
+            {
+                "urls": urls,
+                "restoring": restoring,
+                "unavailable": [
+                    i
+                    for i in dict.fromkeys(version_ids)
+                    if i not in urls and i not in restoring
+                ],
+            }
+        )
+
     @action(detail=False, methods=["post"])
     def create_meta(self, request):
         """
@@ -63,50 +434,429 @@ class DocumentViewSet(viewsets.ViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        doc = Document.objects.create(
-            title=title, description=payload.get("description", ""), owner=request.user
+        doc, dv = create_pending_version(request, title, filename, content_type)
+        # return presigned document
+        post = generate_presigned_post(dv.storage_key, content_type)
+
+        return Response(
+            {
+                "document_id": doc.id,
+                "version_id": dv.id,
+                "presigned_post": post,
+            },
+            status=status.HTTP_201_CREATED,
         )
-        # create first version record (with placeholder file path to be set
-        # when backend completes upload)
-        version_number = 1
-        # construct 3s key
-        key = f"document/{doc.id}/v{version_number}/{filename}"
 
-        # return presigned document
-        post = generate_presigned_post(key, content_type)
-        # save a shadow documentversion record
-        # which we update on "complete_upload" hook run
-        dv = DocumentVersion.objects.create(
-            document=doc,
-            file=key,
-            version_number=version_number,
-            uploaded_by=request.user,
-            file_size=0,
-            content_type=content_type,
-            file_hash="",
+    @action(detail=False, methods=["post"])
+    def bulk_create_meta(self, request):
+        """
+        create_meta for many files in one transaction
+        {
+            "documents": [
+                {
+                    "title": "Document Title",
+                    "filename": "invoice.pdf",
+                    "content_type": "application/pdf",
+                    "description": "Optional description",
+                    "tags": ["optional", "tags"]
+                },
+                ...
+            ],
+            "tags": ["tags of every document"],
+            "shared_with": [{"user_id": 3, "permission": "VIEW"}]
+        }
+        returns the ids and presigned POSTs of the documents in input order
+        """
+        items = request.data.get("documents")
+        max_items = getattr(settings, "DOCUMENT_BULK_MAX", 500)
+        if (
+            not isinstance(items, list)
+            or not items
+            or not all(isinstance(item, dict) for item in items)
+        ):
+            return Response(
+                {"error": "documents must be a list of objects."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(items) > max_items:
+            return Response(
+                {"error": f"at most {max_items} documents per request."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if not all(item.get("title") and item.get("filename") for item in items):
+            return Response(
+                {"error": "title and filename required for every document."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        common_tags, error = parse_tag_names(request.data.get("tags") or [])
+        if error:
+            return error
+        item_tags = []
+        for item in items:
+            names, error = parse_tag_names(item.get("tags") or [])
+            if error:
+                return error
+            item_tags.append(list(dict.fromkeys(common_tags + names)))
+        shares, error = parse_shares(request.data.get("shared_with") or [])
+        if error:
+            return error
+
+        with transaction.atomic():
+            docs = Document.objects.bulk_create(
+                Document(
+                    title=item["title"],
+                    description=item.get("description", ""),
+                    owner=request.user,
+                )
+                for item in items
+            )
+            keys = [
+                upload_key(doc.id, 1, item["filename"])
+                for doc, item in zip(docs, items)
+            ]
+            versions = DocumentVersion.objects.bulk_create(
+                DocumentVersion(
+                    document=doc,
+                    file=key,
+                    version_number=1,
+                    uploaded_by=request.user,
+                    file_size=0,
+                    content_type=item.get("content_type", "application/octet-stream"),
+                    file_hash="",
+                )
+                for doc, key, item in zip(docs, keys, items)
+            )
+            for doc, dv in zip(docs, versions):
+                doc.latest_version = dv
+            Document.objects.bulk_update(docs, ["latest_version"])
+
+            tags = get_or_create_tags(common_tags + sum(item_tags, []))
+            Document.tags.through.objects.bulk_create(
+                Document.tags.through(document_id=doc.id, tag_id=tags[name].id)
+                for doc, names in zip(docs, item_tags)
+                for name in names
+            )
+            SharedDocument.objects.bulk_create(
+                SharedDocument(document=doc, user_id=user_id, permission=permission)
+                for doc in docs
+                for user_id, permission in shares
+            )
+            # bulk_create sends no signals
+            invalidate_documents([doc.id for doc in docs])
+
+        results = []
+        for doc, dv, key in zip(docs, versions, keys):
+            log_event(
+                "UPLOAD",
+                user=request.user,
+                document=doc,
+                version=dv,
+                extra={"s3_key": key, "batch": True},
+            )
+            results.append(
+                {
+                    "document_id": doc.id,
+                    "version_id": dv.id,
+                    "presigned_post": generate_presigned_post(key, dv.content_type),
+                }
+            )
+        return Response({"documents": results}, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=["post"])
+    def bulk_tag(self, request):
+        """
+        add tags to many documents of the user, or remove them
+        {"document_ids": [1, 2], "tags": ["invoices"], "remove": false}
+        documents that do not exist or are not the user's are listed under
+        "unavailable"
+        """
+        ids, error = parse_id_list(
+            request.data, "document_ids", getattr(settings, "DOCUMENT_BULK_MAX", 500)
+        )
+        if error:
+            return error
+        names, error = parse_tag_names(request.data.get("tags"))
+        if error or not names:
+            return error or Response(
+                {"error": "tags required."}, status=status.HTTP_400_BAD_REQUEST
+            )
+        remove = request.data.get("remove") is True
+        owned = owned_document_ids(request.user, ids)
+        links = Document.tags.through.objects
+        with transaction.atomic():
+            if remove:
+                links.filter(document_id__in=owned, tag__name__in=names).delete()
+            else:
+                tags = get_or_create_tags(names)
+                links.bulk_create(
+                    (
+                        Document.tags.through(document_id=pk, tag_id=tags[name].id)
+                        for pk in owned
+                        for name in names
+                    ),
+                    ignore_conflicts=True,
+                )
+            invalidate_documents(owned)
+        for pk in owned:
+            log_event(
+                "REMOVETAG" if remove else "ADDTAG",
+                user=request.user,
+                document_id=pk,
+                document_owner=request.user,
+                extra={"tags": names, "batch": True},
+            )
+        return Response(
+            {"updated": owned, "unavailable": [i for i in ids if i not in owned]}
         )
 
-        doc.latest_version = dv
-        doc.save()
+    @action(detail=False, methods=["post"])
+    def bulk_share(self, request):
+        """
+        share many documents of the user, or stop sharing them
+        {
+            "document_ids": [1, 2],
+            "shared_with": [{"user_id": 3, "permission": "VIEW"}],
+            "remove": false
+        }
+        existing shares get the new permission. Documents that do not exist
+        or are not the user's are listed under "unavailable"
+        """
+        ids, error = parse_id_list(
+            request.data, "document_ids", getattr(settings, "DOCUMENT_BULK_MAX", 500)
+        )
+        if error:
+            return error
+        shares, error = parse_shares(request.data.get("shared_with"))
+        if error or not shares:
+            return error or Response(
+                {"error": "shared_with required."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        remove = request.data.get("remove") is True
+        owned = owned_document_ids(request.user, ids)
+        with transaction.atomic():
+            if remove:
+                SharedDocument.objects.filter(
+                    document_id__in=owned, user_id__in=[user for user, _ in shares]
+                ).delete()
+            else:
+                SharedDocument.objects.bulk_create(
+                    (
+                        SharedDocument(
+                            document_id=pk, user_id=user_id, permission=permission
+                        )
+                        for pk in owned
+                        for user_id, permission in shares
+                    ),
+                    update_conflicts=True,
+                    unique_fields=["document", "user"],
+                    update_fields=["permission"],
+                )
+            invalidate_documents(owned)
+        for pk in owned:
+            log_event(
+                "UPDATE",
+                user=request.user,
+                document_id=pk,
+                document_owner=request.user,
+                extra={
+                    "unshared" if remove else "shared_with": [
+                        {"user_id": user_id, "permission": permission}
+                        for user_id, permission in shares
+                    ],
+                    "batch": True,
+                },
+            )
+        return Response(
+            {"updated": owned, "unavailable": [i for i in ids if i not in owned]}
+        )
 
-        # audit
-        AuditLog.objects.create(
-            user=request.user,
-            action="UPLOAD",
-            document=doc,
-            document_version=dv,
-            extra={"s3_key": key},
+    @action(detail=False, methods=["post"])
+    def bulk_delete(self, request):
+        """
+        delete many documents of the user with all their versions
+        {"document_ids": [1, 2]}
+        documents that do not exist or are not the user's are listed under
+        "unavailable"
+        """
+        ids, error = parse_id_list(
+            request.data, "document_ids", getattr(settings, "DOCUMENT_BULK_MAX", 500)
+        )
+        if error:
+            return error
+        documents = dict(
+            Document.objects.filter(pk__in=ids, owner=request.user).values_list(
+                "pk", "title"
+            )
+        )
+        backend = get_backend()
+        versions = DocumentVersion.objects.filter(document_id__in=documents)
+        with transaction.atomic():
+            # S3 keeps the parts of unfinished uploads until they are aborted,
+            # which is only done once the documents are gone
+            uploads = list(
+                MultipartUpload.objects.select_for_update().filter(
+                    version__document_id__in=documents, status="PENDING"
+                )
+            )
+            transaction.on_commit(partial(abort_uploads, uploads))
+            references = Counter()
+            for version_id, blob_id in versions.select_for_update().values_list(
+                "pk", "blob_id"
+            ):
+                backend.clear_version(version_id)
+                if blob_id:
+                    references[blob_id] += 1
+            # blobs are released in one update instead of per version by the
+            # post_delete signal, which then finds no blob
+            versions.update(blob=None)
+            detach_blobs(references)
+            # per object signals invalidate the cache
+            Document.objects.filter(pk__in=documents).delete()
+        for pk, title in documents.items():
+            # the row is gone, the entry keeps its id and title
+            log_event(
+                "DELETE",
+                user=request.user,
+                document_owner=request.user,
+                extra={"document_id": pk, "title": title, "batch": True},
+            )
+        return Response(
+            {
+                "deleted": list(documents),
+                "unavailable": [i for i in ids if i not in documents],
+            }
         )
 
+    @action(detail=False, methods=["post"])
+    def initiate_upload(self, request):
+        """
+        create a document entry and start a multipart upload, for files too
+        large for a single presigned POST
+        {
+            "title": "Document Title",
+            "description": "Optional description",
+            "filename": "scan.pdf",
+            "content_type": "application/pdf",
+            "file_size": 734003200
+        }
+        the file is uploaded in `part_count` parts of `part_size` bytes (the
+        last one may be smaller) to urls from presign_parts
+        """
+        payload = request.data
+        title = payload.get("title")
+        filename = payload.get("filename")
+        content_type = payload.get("content_type", "application/octet-stream")
+        file_size = payload.get("file_size")
+        max_size = getattr(settings, "DOCUMENT_MULTIPART_MAX_SIZE", 50 * 1024**3)
+
+        if not title or not filename:
+            return Response(
+                {"error": "title and filename required."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if not isinstance(file_size, int) or not 0 < file_size <= max_size:
+            return Response(
+                {"error": f"file_size must be between 1 and {max_size} bytes."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if not get_storage().supports_multipart:
+            return Response(
+                {"error": "storage does not support multipart uploads."},
+                status=status.HTTP_501_NOT_IMPLEMENTED,
+            )
+
+        doc, dv = create_pending_version(request, title, filename, content_type)
+        upload = start_multipart_upload(dv, file_size)
         return Response(
             {
                 "document_id": doc.id,
                 "version_id": dv.id,
-                "presigned_post": post,
+                "upload_id": upload.upload_id,
+                "part_size": upload.part_size,
+                "part_count": upload.part_count,
             },
             status=status.HTTP_201_CREATED,
         )
 
+    @action(detail=True, methods=["post"])
+    def presign_parts(self, request, pk=None):
+        """
+        presigned part upload urls of a multipart upload
+        {"version_id": <id>, "part_numbers": [1, 2, 3]}
+        without part_numbers every part that is not uploaded yet is signed,
+        which is how an interrupted upload is resumed. Parts can be uploaded
+        in parallel, keep the ETag header of each response for
+        complete_upload
+        """
+        upload = self.get_multipart_upload(request, pk)
+        if upload.status != "PENDING":
+            return Response(
+                {"error": f"upload is {upload.status.lower()}."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        part_numbers = request.data.get("part_numbers")
+        try:
+            uploaded = get_storage().list_parts(upload.key, upload.upload_id)
+        except NoSuchUpload:
+            return Response(
+                {"error": "upload is gone."}, status=status.HTTP_409_CONFLICT
+            )
+        if part_numbers is None:
+            done = {part.number for part in uploaded}
+            part_numbers = [
+                n for n in range(1, upload.part_count + 1) if n not in done
+            ]
+        elif not isinstance(part_numbers, list) or not all(
+            isinstance(n, int) and 1 <= n <= upload.part_count for n in part_numbers
+        ):
+            return Response(
+                {"error": f"part_numbers must be within 1..{upload.part_count}."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(
+            {
+                "upload_id": upload.upload_id,
+                "part_size": upload.part_size,
+                "part_count": upload.part_count,
+                "urls": presign_parts(upload, part_numbers),
+                "uploaded": [
+                    {"part_number": p.number, "etag": p.etag, "size": p.size}
+                    for p in uploaded
+                ],
+            }
+        )
+
+    @action(detail=True, methods=["post"])
+    def abort_upload(self, request, pk=None):
+        """
+        abort a multipart upload, its parts and the pending version are
+        removed (and the document, if it has no other version)
+        {"version_id": <id>}
+        """
+        upload = self.get_multipart_upload(request, pk)
+        if upload.status == "COMPLETED":
+            return Response(
+                {"error": "upload is completed."}, status=status.HTTP_409_CONFLICT
+            )
+        abort_multipart_upload(upload)
+        doc = upload.version.document
+        upload.version.delete()
+        if not doc.versions.exists():
+            doc.delete()
+        else:
+            doc.latest_version = doc.versions.order_by("-version_number").first()
+            doc.save()
+        return Response({"status": "aborted"}, status=status.HTTP_200_OK)
+
+    def get_multipart_upload(self, request, pk):
+        return get_object_or_404(
+            MultipartUpload.objects.select_related("version__document"),
+            version_id=parse_id(request.data.get("version_id")),
+            version__document_id=parse_id(pk),
+            version__document__owner=request.user,
+        )
+
     @action(detail=True, methods=["post"])
     def complete_upload(self, request, pk=None):
         """
@@ -115,38 +865,274 @@ class DocumentViewSet(viewsets.ViewSet):
         {
             "version_id": <id>,
             "file_size": 12345,
-            "file_hash": "sha256..."
+            "file_hash": "sha256...",
+            "parts": [{"part_number": 1, "etag": "..."}, ...],
+            "bulk": false
         }
         This endpoint will:
+        - complete the multipart upload, verifying its parts (etags, sizes)
+        - check the size of the stored object
         - update DocumentVersion metadata
-        - enqueue OCR/indexing/virus-scan tasks
+        - enqueue OCR/indexing/virus-scan tasks, or queue them for admission
+          for bulk imports (asked for, or beyond the owner's interactive rate)
         """
-        doc = get_object_or_404(Document, pk=pk)
-        version_id = request.data.get("version_id")
+        doc = get_object_or_404(Document, pk=parse_id(pk), owner=request.user)
+        version_id = parse_id(request.data.get("version_id"))
+        if version_id is None:
+            return Response(
+                {"error": "version_id must be an integer."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
         file_size = request.data.get("file_size")
         file_hash = request.data.get("file_hash", "")
         dv = get_object_or_404(DocumentVersion, pk=version_id, document=doc)
+
+        upload = MultipartUpload.objects.filter(version=dv).first()
+        try:
+            if upload is not None:
+                parts = request.data.get("parts")
+                if not isinstance(parts, list) or not all(
+                    isinstance(part, dict) and isinstance(part.get("etag"), str)
+                    for part in parts
+                ):
+                    raise UploadError("parts must list the etag of every part")
+                client_etags = {part.get("part_number"): part["etag"] for part in parts}
+                stored_size = complete_multipart_upload(upload, client_etags)
+            else:
+                stored_size = get_storage().size(dv.storage_key)
+                if stored_size is None:
+                    raise UploadError("The file was not uploaded")
+        except UploadError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if file_size is not None and str(file_size) != str(stored_size):
+            return Response(
+                {"error": f"Stored object has {stored_size} bytes, not {file_size}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
         # file field currently stores the S3 key string
         # If using Django storages to manage S3, you can set dv.file.name = key and save
-        dv.file_size = file_size
+        dv.file_size = stored_size
         dv.file_hash = file_hash
         dv.save()
 
-        # queue background tasks here
-        """
-        TODO: (OCR, indexing, virus-scan)
-        """
-        from .tasks import (
-            process_document_version,
-        )  # import here to avoid circular imports at module load
-
-        process_document_version.delay(dv.id)
+        # queue background tasks here, bulk imports wait for admission
+        bulk = str(request.data.get("bulk", "")).lower() in ("1", "true")
+        priority = submit(dv, doc.owner_id, bulk=bulk)
 
-        AuditLog.objects.create(
+        log_event(
+            "UPDATE",
             user=request.user,
-            action="UPDATE",
-            Document=doc,
+            document=doc,
             version=dv,
-            extra={"file_size": file_size, "file_hash": file_hash},
+            extra={"file_size": stored_size, "file_hash": file_hash},
+        )
+        return Response(
+            {"status": "ok", "priority": priority.lower()}, status=status.HTTP_200_OK
+        )
+
+
+def create_pending_version(request, title, filename, content_type):
+    """
+    create a document with a shadow first version, which is updated by the
+    "complete_upload" hook once the client uploaded the file
+    """
+    doc = Document.objects.create(
+        title=title,
+        description=request.data.get("description", ""),
+        owner=request.user,
+    )
+    version_number = 1
+    key = upload_key(doc.id, version_number, filename)
+    dv = DocumentVersion.objects.create(
+        document=doc,
+        file=key,
+        version_number=version_number,
+        uploaded_by=request.user,
+        file_size=0,
+        content_type=content_type,
+        file_hash="",
+    )
+    doc.latest_version = dv
+    doc.save()
+
+    # audit
+    log_event(
+        "UPLOAD",
+        user=request.user,
+        document=doc,
+        version=dv,
+        extra={"s3_key": key},
+    )
+    return doc, dv
+
+
+def upload_key(document_id, version_number, filename):
+    """storage key a version is uploaded to"""
+    return f"document/{document_id}/v{version_number}/{filename}"
+
+
+def restoring_response(version):
+    """202 while the archived content of a version is restored, see ContentRestoring"""
+    response = Response(
+        {"version_id": version.id, "status": "restoring"},
+        status=status.HTTP_202_ACCEPTED,
+    )
+    response["Retry-After"] = str(getattr(settings, "DOCUMENT_RESTORE_RETRY_AFTER", 5))
+    return response
+
+
+def parse_version_id(params, doc):
+    """?version_id or the latest version, (id, None) or (None, error response)"""
+    version_id = params.get("version_id")
+    if not version_id:
+        return doc.latest_version_id, None
+    version_id = parse_id(version_id)
+    if version_id is None:
+        return None, Response(
+            {"error": "version_id must be an integer."},
+            status=status.HTTP_400_BAD_REQUEST,
         )
-        return Response({"status": "ok"}, status=status.HTTP_200_OK)
+    return version_id, None
+
+
+def parse_id_list(data, name, max_ids):
+    """the list of ids under `name`, (ids, None) or (None, error response)"""
+    ids = data.get(name)
+    if not isinstance(ids, list) or not ids or not all(isinstance(i, int) for i in ids):
+        return None, Response(
+            {"error": f"{name} must be a list of ids."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    if len(ids) > max_ids:
+        return None, Response(
+            {"error": f"at most {max_ids} {name} per request."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    return ids, None
+
+
+def parse_tag_names(names):
+    """a list of tag names, (names, None) or (None, error response)"""
+    max_length = Tag._meta.get_field("name").max_length
+    if not isinstance(names, list) or not all(
+        isinstance(name, str) and 0 < len(name.strip()) <= max_length
+        for name in names
+    ):
+        return None, Response(
+            {"error": "tags must be a list of names."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    return list(dict.fromkeys(name.strip() for name in names)), None
+
+
+def parse_shares(shares):
+    """
+    [{"user_id": 3, "permission": "VIEW"}] -> [(3, "VIEW")] of existing
+    users, (shares, None) or (None, error response)
+    """
+    choices = {choice for choice, _ in SharedDocument.PERMISSION_CHOICES}
+    if not isinstance(shares, list) or not all(
+        isinstance(share, dict)
+        and isinstance(share.get("user_id"), int)
+        and share.get("permission", "VIEW") in choices
+        for share in shares
+    ):
+        return None, Response(
+            {
+                "error": "shared_with must be a list of user_id and permission "
+                f"({', '.join(sorted(choices))})."
+            },
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    parsed = {share["user_id"]: share.get("permission", "VIEW") for share in shares}
+    found = set(
+        get_user_model().objects.filter(pk__in=parsed).values_list("pk", flat=True)
+    )
+    if len(found) < len(parsed):
+        return None, Response(
+            {"error": f"unknown users {sorted(set(parsed) - found)}."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    return list(parsed.items()), None
+
+
+def owned_document_ids(user, ids):
+    """the ids of documents owned by `user`, in request order"""
+    owned = set(
+        Document.objects.filter(pk__in=ids, owner=user).values_list("pk", flat=True)
+    )
+    return [pk for pk in dict.fromkeys(ids) if pk in owned]
+
+
+def get_or_create_tags(names):
+    """{name: Tag}, the missing tags are created with one insert"""
+    names = list(dict.fromkeys(names))
+    tags = {tag.name: tag for tag in Tag.objects.filter(name__in=names)}
+    missing = [name for name in names if name not in tags]
+    if missing:
+        Tag.objects.bulk_create(
+            [Tag(name=name) for name in missing], ignore_conflicts=True
+        )
+        tags.update(
+            (tag.name, tag) for tag in Tag.objects.filter(name__in=missing)
+        )
+    return tags
+
+
+def parse_time_filter(value):
+    """date or datetime query param -> aware datetime, None if invalid"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            return None
+        parsed = datetime.combine(day, datetime.min.time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class AuditLogViewSet(viewsets.ViewSet):
+    """
+    audit entries, newest first. Staff see every entry, other users the
+    entries of documents they own.
+    ?document=<id>&version=<id>&user=<id>&action=DOWNLOAD,UPLOAD
+    &since=2024-01-01&until=2024-02-01T12:00:00Z
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request):
+        querySet = AuditLog.objects.select_related("user")
+        if not request.user.is_staff:
+            querySet = querySet.filter(document_owner=request.user)
+
+        params = request.query_params
+        for param in ("document", "version", "user"):
+            value = params.get(param)
+            if value is None:
+                continue
+            if not value.isdigit():
+                return Response(
+                    {"error": f"{param} must be an id."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            querySet = querySet.filter(**{f"{param}_id": int(value)})
+        if params.get("action"):
+            querySet = querySet.filter(action__in=params["action"].split(","))
+        for param, lookup in (("since", "timestamp__gte"), ("until", "timestamp__lt")):
+            if not params.get(param):
+                continue
+            value = parse_time_filter(params[param])
+            if value is None:
+                return Response(
+                    {"error": f"{param} must be a date or datetime."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            querySet = querySet.filter(**{lookup: value})
+
+        paginator = AuditLogCursorPagination()
+        page = paginator.paginate_queryset(querySet, request, view=self)
+        serializer = AuditLogSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
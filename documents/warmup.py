@@ -0,0 +1,84 @@
+"""
+warm start of celery workers.
+
+The extraction stack (pdfplumber / pdfminer, pdfium, the tesseract bindings,
+python-docx, Pillow) and boto3 are imported where they are used, so web
+processes and management commands never load them. A worker imports them
+once in its main process when it starts, prefork children inherit the
+loaded modules, and every child builds its clients before its first task
+instead of during it.
+"""
+
+import importlib
+import logging
+import os
+import time
+
+from django.conf import settings
+
+from .scanner import get_scanner
+from .storage import S3Storage, get_s3_client, get_storage
+
+
+logger = logging.getLogger(__name__)
+
+PRELOAD_MODULES = (
+    "pdfplumber",
+    "pypdfium2",
+    "pytesseract",
+    "docx",
+    "PIL.Image",
+    "PIL.ImageOps",
+    "boto3",
+    "botocore.config",
+)
+
+
+def preload_enabled():
+    return getattr(settings, "DOCUMENT_WORKER_PRELOAD", True)
+
+
+def limit_ocr_threads(**kwargs):
+    """
+    worker_init: pages are OCR'd in parallel by separate tesseract
+    processes, an OpenMP thread pool in every one of them would
+    oversubscribe the cores. Inherited by the pool children
+    """
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+def preload_modules(sender=None, **kwargs):
+    """worker_init: import the extraction stack in the worker main process"""
+    if not preload_enabled():
+        return
+    start = time.perf_counter()
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning(f"Could not preload {name}: {e}")
+    from PIL import Image
+
+    # registers every format plugin, done on the first unusual image otherwise
+    Image.init()
+    try:
+        import pytesseract
+
+        pytesseract.get_tesseract_version()
+    except Exception as e:
+        logger.warning(f"tesseract is not available, OCR will fail: {e}")
+    logger.info(f"Preloaded the extraction stack in {time.perf_counter() - start:.2f}s")
+
+    # without prefork children the tasks run in this process
+    pool = getattr(sender, "pool_cls", "")
+    if "prefork" not in str(getattr(pool, "__module__", pool)):
+        preload_clients()
+
+
+def preload_clients(**kwargs):
+    """worker_process_init: build the per-process clients of a pool child"""
+    if not preload_enabled():
+        return
+    if isinstance(get_storage(), S3Storage):
+        get_s3_client()
+    get_scanner()
@@ -0,0 +1,10 @@
+# read by gunicorn from the working directory
+import os
+
+
+def child_exit(server, worker):
+    # drop the live gauges of the exited worker from the prometheus files
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)